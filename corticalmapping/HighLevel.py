@@ -3,6 +3,7 @@ __author__ = 'junz'
 import os
 import json
 import h5py
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import itertools
 import pandas as pd
@@ -160,14 +161,16 @@ def threshold_mask_by_energe(mask, sigma=1., thr_high=0.0, thr_low=0.1):
     return mask_dict
 
 
-def translateMovieByVasculature(mov, parameterPath, matchingDecimation=2, referenceDecimation=2, verbose=True):
+def getVasculatureTransformParams(parameterPath, matchingDecimation=2, referenceDecimation=2):
     '''
+    read the translation parameters generated by VasculatureMapMatching GUI
 
-    :param mov: movie before translation (could be 2d (just one frame) or 3d)
     :param parameterPath: path to the json file with translation parameters generated by VasculatureMapMatching GUI
-    :param movDecimation: decimation factor from movie vasculature image to movie
-    :param mappingDecimation: decimation factor from mapping vasculature image to mapped areas, usually 2
-    :return: translated movie
+    :param matchingDecimation: decimation factor on the matching side (usually 2)
+    :param referenceDecimation: decimation factor on the reference side
+    :return: dictionary of 'zoom', 'rotation', 'offset' and 'outputShape' of the transformation from the movie to
+             reference map, and 'decimationZoom', zoom of the following resampling from matching decimation to
+             reference decimation (None if not needed)
     '''
 
     with open(parameterPath) as f:
@@ -192,34 +195,80 @@ def translateMovieByVasculature(mov, parameterPath, matchingDecimation=2, refere
     outputShape = [int(matchingParams['ReferenceMapHeight'] / matchingDecimation),
                    int(matchingParams['ReferenceMapHeight'] / matchingDecimation)]
 
-    movT = ia.rigid_transform_cv2(mov, zoom=matchingParams['Zoom'], rotation=matchingParams['Rotation'], offset=offset,
-                                  outputShape=outputShape)
+    if matchingDecimation / referenceDecimation != 1: decimationZoom = matchingDecimation / referenceDecimation
+    else: decimationZoom = None
+
+    return {'zoom': matchingParams['Zoom'], 'rotation': matchingParams['Rotation'], 'offset': offset,
+            'outputShape': outputShape, 'decimationZoom': decimationZoom}
+
 
-    if matchingDecimation / referenceDecimation != 1:
-        movT = ia.rigid_transform_cv2(movT, zoom=matchingDecimation / referenceDecimation)
+def translateMovieByVasculature(mov, parameterPath, matchingDecimation=2, referenceDecimation=2, verbose=True,
+                                threadNum=None):
+    '''
+
+    :param mov: movie before translation (could be 2d (just one frame) or 3d)
+    :param parameterPath: path to the json file with translation parameters generated by VasculatureMapMatching GUI
+    :param movDecimation: decimation factor from movie vasculature image to movie
+    :param mappingDecimation: decimation factor from mapping vasculature image to mapped areas, usually 2
+    :param threadNum: positive int, number of threads to translate a 3d movie, if None, the number of cpus
+    :return: translated movie
+    '''
+
+    params = getVasculatureTransformParams(parameterPath, matchingDecimation=matchingDecimation,
+                                           referenceDecimation=referenceDecimation)
+
+    movT = ia.rigid_transform_cv2(mov, zoom=params['zoom'], rotation=params['rotation'], offset=params['offset'],
+                                  outputShape=params['outputShape'], threadNum=threadNum)
+
+    if params['decimationZoom'] is not None:
+        movT = ia.rigid_transform_cv2(movT, zoom=params['decimationZoom'], threadNum=threadNum)
 
     if verbose: print('shape of output movie:', movT.shape)
 
     return movT
 
 
+def _translateChunkByWarpMaps(inputMov, outputMov, indStart, indEnd, warpMaps):
+    '''
+    translate frames [indStart:indEnd] of inputMov with precomputed warp maps and write them into outputMov
+    '''
+    chunk = np.array(inputMov[indStart:indEnd, :, :], dtype=np.float32)
+    chunkT = np.empty((chunk.shape[0],) + outputMov.shape[1:], dtype=outputMov.dtype)
+    for i in range(chunk.shape[0]):
+        chunkT[i] = ia.remap_image(chunk[i], warpMaps)
+    outputMov[indStart:indEnd, :, :] = chunkT
+
+
 def translateHugeMovieByVasculature(inputPath, outputPath, parameterPath, outputDtype=None, matchingDecimation=2,
-                                    referenceDecimation=2, chunkLength=100, verbose=True):
+                                    referenceDecimation=2, chunkLength=None, verbose=True, threadNum=None,
+                                    memoryFraction=0.25):
     '''
     translate huge .npy matrix with alignment parameters into another huge .npy matrix without loading everything into memory
+
+    the transformation (zoom, rotation, offset and the following decimation zoom) is combined into one affine
+    transformation, its warp maps are computed once and each frame is transformed by a single linear remapping. the
+    chunks of frames are translated by a pool of threads and written into a preallocated .npy file
+    (np.lib.format.open_memmap). because the steps are combined, the result may slightly differ from
+    translateMovieByVasculature, which interpolates after each step, and all pixels outside of the input frame are
+    filled with the minimum of the frame (translateMovieByVasculature fills the corners uncovered by rotation with 0).
+
     :param inputPath: path of input movie (.npy file)
     :param outputPath: path of output movie (.npy file)
     :param outputDtype: data type of output movie
     :param parameterPath: path to the json file with translation parameters generated by VasculatureMapMatching GUI
     :param matchingDecimation: decimation factor on the matching side (usually 2)
     :param referenceDecimation: decimation factor on the reference side (if using standard retinotopic mapping pkl file, should be 2)
-    :param chunkLength: frame number of chunks
+    :param chunkLength: frame number of chunks, if None, it is chosen so that the chunks being processed by all
+                        threads take about memoryFraction of available memory
+    :param threadNum: positive int, number of threads, if None, the number of cpus
+    :param memoryFraction: float, (0., 1.], fraction of available memory used when chunkLength is None
     :return:
     '''
 
-    chunkLength = int(chunkLength)
+    if threadNum is None: threadNum = os.cpu_count() or 1
+    if threadNum < 1: raise ValueError('threadNum should be a positive integer!')
 
-    inputMov = BinarySlicer(inputPath)
+    inputMov = np.load(inputPath, mmap_mode='r')
 
     if outputDtype is None: outputDtype = inputMov.dtype.str
 
@@ -231,6 +280,31 @@ def translateHugeMovieByVasculature(inputPath, outputPath, parameterPath, output
 
     if verbose: print('\nInput movie shape:', inputMov.shape)
 
+    params = getVasculatureTransformParams(parameterPath, matchingDecimation=matchingDecimation,
+                                           referenceDecimation=referenceDecimation)
+    matrix, outputShape = ia.get_rigid_transform_matrix(inputMov.shape[1:], zoom=params['zoom'],
+                                                        rotation=params['rotation'], offset=params['offset'],
+                                                        outputShape=params['outputShape'])
+    if params['decimationZoom'] is not None:
+        decimationMatrix, outputShape = ia.get_rigid_transform_matrix(outputShape, zoom=params['decimationZoom'])
+        matrix = decimationMatrix.dot(matrix)
+    warpMaps = ia.get_warp_maps(matrix, outputShape)
+
+    if chunkLength is None:
+        if not 0. < memoryFraction <= 1.: raise ValueError('memoryFraction should be in the range of (0., 1.]!')
+        availableMemory = ft.get_available_memory()
+        if availableMemory is None:
+            chunkLength = 100
+        else:
+            # input frame and output frame in float32, plus output frame in output dtype
+            frameBytes = (np.prod(inputMov.shape[1:]) * 4 +
+                          np.prod(outputShape) * (4 + np.dtype(outputDtype).itemsize))
+            chunkLength = int(availableMemory * memoryFraction // (frameBytes * threadNum))
+        chunkLength = max(1, min(chunkLength, int(np.ceil(float(frameNum) / threadNum))))
+
+    chunkLength = int(chunkLength)
+    if chunkLength < 1: raise ValueError('chunkLength should be a positive integer!')
+
     chunkNum = frameNum // chunkLength
     if frameNum % chunkLength == 0:
         if verbose:
@@ -240,30 +314,31 @@ def translateHugeMovieByVasculature(inputPath, outputPath, parameterPath, output
         if verbose: print('Translating in chunks: ' + str(chunkNum - 1) + ' x ' + str(
             chunkLength) + ' frame(s)' + ' + ' + str(frameNum % chunkLength) + ' frame(s)')
 
-    frameT1 = translateMovieByVasculature(inputMov[0, :, :], parameterPath=parameterPath,
-                                          matchingDecimation=matchingDecimation,
-                                          referenceDecimation=referenceDecimation, verbose=False)
+    frameT1 = ia.remap_image(inputMov[0, :, :], warpMaps)
     plt.imshow(frameT1, cmap='gray')
     plt.show()
 
-    if verbose: print('Output movie shape:', (frameNum, frameT1.shape[0], frameT1.shape[1]), '\n')
+    if verbose: print('Output movie shape:', (frameNum, outputShape[0], outputShape[1]), '\n')
 
-    with open(outputPath, 'wb') as f:
-        np.lib.format.write_array_header_1_0(f, {'descr': outputDtype, 'fortran_order': False,
-                                                 'shape': (frameNum, frameT1.shape[0], frameT1.shape[1])})
+    outputMov = np.lib.format.open_memmap(outputPath, mode='w+', dtype=outputDtype,
+                                          shape=(frameNum, outputShape[0], outputShape[1]))
 
-        for i in range(chunkNum):
-            indStart = i * chunkLength
-            indEnd = (i + 1) * chunkLength
-            if indEnd > frameNum: indEnd = frameNum
-            currMov = inputMov[indStart:indEnd, :, :]
-            if verbose: print('Translating frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
-                i * 100. / chunkNum) + '%')
-            currMovT = translateMovieByVasculature(currMov, parameterPath=parameterPath,
-                                                   matchingDecimation=matchingDecimation,
-                                                   referenceDecimation=referenceDecimation, verbose=False)
-            currMovT = currMovT.astype(outputDtype)
-            currMovT.reshape((np.prod(currMovT.shape),)).tofile(f)
+    try:
+        with ThreadPoolExecutor(max_workers=threadNum) as pool:
+            futures = []
+            for i in range(chunkNum):
+                indStart = i * chunkLength
+                indEnd = min((i + 1) * chunkLength, frameNum)
+                futures.append((indStart, indEnd, pool.submit(_translateChunkByWarpMaps, inputMov, outputMov,
+                                                              indStart, indEnd, warpMaps)))
+
+            for i, (indStart, indEnd, future) in enumerate(futures):
+                future.result()
+                if verbose: print('Translated frame ' + str(indStart) + ' to frame ' + str(indEnd) + '.\t' + str(
+                    (i + 1) * 100. / chunkNum) + '%')
+    finally:
+        outputMov.flush()
+        del outputMov
 
 
 def segmentPhotodiodeSignal(pd, digitizeThr=0.9, filterSize=0.01, segmentThr=0.02, Fs=10000.,
@@ -613,6 +688,31 @@ def getAverageDfMovie(movPath, frameTS, onsetTimes, chunkDur, startTime=0., temp
     :return: averageed movie of all chunks
     '''
 
+    aveMovs = getAverageDfMovies(movPath, frameTS, {'onsets': onsetTimes}, {'onsets': chunkDur},
+                                 startTimes={'onsets': startTime}, temporalDownSampleRate=temporalDownSampleRate,
+                                 is_load_all=is_load_all)
+
+    return aveMovs['onsets']
+
+
+def getAverageDfMovies(movPath, frameTS, onsetTimes, chunkDurs, startTimes=None, temporalDownSampleRate=1,
+                       is_load_all=True):
+    '''
+    average movies of multiple conditions with a single pass through the movie (see ia.get_average_movies)
+
+    :param movPath: path to the image movie
+    :param frameTS: the timestamps for each frame of the raw movie
+    :param onsetTimes: dictionary, {condition: time stamps of onset of each sweep}
+    :param chunkDurs: dictionary, {condition: duration of each chunk}
+    :param startTimes: dictionary, {condition: chunck start time relative to the sweep onset time (length of pre gray
+                       period)}, if None, 0. for all conditions
+    :param temporalDownSampleRate: decimation factor in time after recording
+    :return: dictionary, {condition: (averageed movie of all chunks, normalized averaged movie)}
+    '''
+
+    if startTimes is None:
+        startTimes = dict((cond, 0.) for cond in onsetTimes.keys())
+
     if temporalDownSampleRate == 1:
         frameTS_real = frameTS
     elif temporalDownSampleRate > 1:
@@ -634,15 +734,21 @@ def getAverageDfMovie(movPath, frameTS, onsetTimes, chunkDur, startTime=0., temp
     else:
         mov = BinarySlicer(movPath)
 
-    aveMov = ia.get_average_movie(mov, frameTS_real, onsetTimes + startTime, chunkDur)
+    aveMovs, _ = ia.get_average_movies(mov, frameTS_real,
+                                       dict((cond, np.asarray(onsets) + startTimes[cond])
+                                            for cond, onsets in onsetTimes.items()),
+                                       chunkDurs)
 
     meanFrameDur = np.mean(np.diff(frameTS_real))
-    baselineFrameDur = int(abs(startTime) / meanFrameDur)
 
-    baselinePicture = np.mean((aveMov[0:baselineFrameDur, :, :]).astype(np.float32), axis=0)
-    _, aveMovNor, _ = ia.normalize_movie(aveMov, baselinePicture)
+    results = {}
+    for cond, aveMov in aveMovs.items():
+        baselineFrameDur = int(abs(startTimes[cond]) / meanFrameDur)
+        baselinePicture = np.mean((aveMov[0:baselineFrameDur, :, :]).astype(np.float32), axis=0)
+        _, aveMovNor = ia.normalize_movie_chunked(aveMov, baselinePicture, outputType='dF')
+        results.update({cond: (aveMov, aveMovNor)})
 
-    return aveMov, aveMovNor
+    return results
 
 
 def getAverageDfMovieFromH5Dataset(dset, frameTS, onsetTimes, chunkDur, startTime=0., temporalDownSampleRate=1):
@@ -707,9 +813,10 @@ def getMappingMovies(movPath, frameTS, displayOnsets, displayInfo, temporalDownS
     else:
         raise LookupError('FFTmode should be either "peak" or "valley"!')
 
-    for dir in ['B2U', 'U2B', 'L2R', 'R2L']:
-        print('\nAnalyzing sweeps with direction:', dir)
+    dirs = ['B2U', 'U2B', 'L2R', 'R2L']
 
+    onsetTimes = {}
+    for dir in dirs:
         onsetInd = list(displayInfo[dir]['ind'])
 
         for ind in displayInfo[dir]['ind']:
@@ -718,13 +825,21 @@ def getMappingMovies(movPath, frameTS, displayOnsets, displayInfo, temporalDownS
                     ind) + ' was not displayed. Remove from averageing.')
                 onsetInd.remove(ind)
 
-        aveMov, aveMovNor = getAverageDfMovie(movPath=movPath,
-                                              frameTS=frameTS,
-                                              onsetTimes=displayOnsets[onsetInd],
-                                              chunkDur=displayInfo[dir]['sweepDur'],
-                                              startTime=displayInfo[dir]['startTime'],
-                                              temporalDownSampleRate=temporalDownSampleRate,
-                                              is_load_all=is_load_all)
+        onsetTimes.update({dir: displayOnsets[onsetInd]})
+
+    # average all directions with one pass through the movie
+    aveMovs = getAverageDfMovies(movPath=movPath,
+                                 frameTS=frameTS,
+                                 onsetTimes=onsetTimes,
+                                 chunkDurs=dict((dir, displayInfo[dir]['sweepDur']) for dir in dirs),
+                                 startTimes=dict((dir, displayInfo[dir]['startTime']) for dir in dirs),
+                                 temporalDownSampleRate=temporalDownSampleRate,
+                                 is_load_all=is_load_all)
+
+    for dir in dirs:
+        print('\nAnalyzing sweeps with direction:', dir)
+
+        aveMov, aveMovNor = aveMovs[dir]
 
         print('aveMov.shape = ' + str(aveMov.shape))
         print('aveMovNor.shape = ' + str(aveMovNor.shape))
@@ -763,11 +878,14 @@ def getMappingMovies(movPath, frameTS, displayOnsets, displayInfo, temporalDownS
     return altPosMap, aziPosMap, altPowerMap, aziPowerMap
 
 
-def regression_detrend(mov, roi, verbose=True):
+def regression_detrend(mov, roi, verbose=True, chunk_size=1000):
     """
     detrend a movie by subtracting global trend as average activity in side the roi. It work on a pixel by pixel bases
     and use linear regress to determine the contribution of the global signal to the pixel activity.
 
+    the least square regressions of all pixels are solved in closed form from the sums accumulated over chunks of
+    frames, so the movie is read chunk by chunk (twice: once for the regression, once for the detrended movie).
+
     ref:
     1. J Neurosci. 2016 Jan 27;36(4):1261-72. doi: 10.1523/JNEUROSCI.2744-15.2016. Resolution of High-Frequency
     Mesoscale Intracortical Maps Using the Genetically Encoded Glutamate Sensor iGluSnFR. Xie Y, Chan AW, McGirr A,
@@ -775,8 +893,9 @@ def regression_detrend(mov, roi, verbose=True):
     2. Neuroimage. 1998 Oct;8(3):302-6. The inferential impact of global signal covariates in functional neuroimaging
     analyses. Aguirre GK1, Zarahn E, D'Esposito M.
 
-    :param mov: input movie
+    :param mov: input movie, 3-d array_like (np.array, BinarySlicer object, hdf5 dataset, etc)
     :param roi: binary, weight and binaryNan roi to define global signal
+    :param chunk_size: int, the number of frames of each chunk of processing
     :return: detrended movie, trend, amp_map, rvalue_map
     """
 
@@ -784,29 +903,52 @@ def regression_detrend(mov, roi, verbose=True):
         raise ValueError
 
     roi = ia.WeightedROI(roi)
-    trend = roi.get_weighted_trace(mov)
+    weighted_mask = roi.get_weighted_mask().astype(np.float64)
+    weight_sum = roi.get_weight_sum()
+
+    frame_num = mov.shape[0]
+    trend = np.empty(frame_num, dtype=np.float64)
+
+    # pixel values are taken relative to the first frame to keep the sums numerically stable
+    ref_frame = np.array(mov[0, :, :], dtype=np.float64)
+    sum_y = np.zeros(ref_frame.shape, dtype=np.float64)
+    sum_yy = np.zeros(ref_frame.shape, dtype=np.float64)
+    sum_ty = np.zeros(ref_frame.shape, dtype=np.float64)
+
+    for chunk_start, chunk_end, chunk in ft.ChunkReader(mov, chunk_length=chunk_size, dtype=np.float64):
+        curr_trend = np.tensordot(chunk, weighted_mask, axes=([1, 2], [0, 1])) / weight_sum
+        trend[chunk_start:chunk_end] = curr_trend
+        chunk -= ref_frame
+        sum_y += np.sum(chunk, axis=0)
+        sum_yy += np.sum(chunk ** 2, axis=0)
+        sum_ty += np.tensordot(curr_trend, chunk, axes=(0, 0))
 
-    mov_new = np.empty(mov.shape, dtype=np.float32)
-    slopes = np.empty((mov.shape[1], mov.shape[2]), dtype=np.float32)
-    rvalues = np.empty((mov.shape[1], mov.shape[2]), dtype=np.float32)
+        if verbose:
+            print('regression progress:', int(round(float(chunk_end) * 100 / frame_num)), '%')
 
-    pixel_num = mov.shape[1] * mov.shape[2]
+    trend_mean = np.mean(trend)
+    ss_t = np.sum((trend - trend_mean) ** 2)
+    if ss_t == 0:
+        raise ValueError('The global trend is constant. Can not regress pixel traces against it!')
 
-    n = 0
+    cov = sum_ty - trend_mean * sum_y
+    ss_y = sum_yy - sum_y ** 2 / frame_num
 
-    for i, j in itertools.product(list(range(mov.shape[1])), list(range(mov.shape[2]))):
-        pixel_trace = mov[:, i, j]
-        slope, intercept, r_value, p_value, stderr = stats.linregress(trend, pixel_trace)
-        slopes[i, j] = slope
-        rvalues[i, j] = r_value
-        mov_new[:, i, j] = pixel_trace - trend * slope
+    slopes = (cov / ss_t).astype(np.float32)
+
+    rvalues = np.zeros(ss_y.shape, dtype=np.float64)
+    is_var = ss_y > 0
+    rvalues[is_var] = cov[is_var] / np.sqrt(ss_t * ss_y[is_var])
+    rvalues = np.clip(rvalues, -1., 1.).astype(np.float32)
+
+    mov_new = np.empty(mov.shape, dtype=np.float32)
+    for chunk_start, chunk_end, chunk in ft.ChunkReader(mov, chunk_length=chunk_size, dtype=np.float32):
+        mov_new[chunk_start:chunk_end] = chunk - trend[chunk_start:chunk_end, None, None].astype(np.float32) * slopes
 
         if verbose:
-            if n % (pixel_num // 10) == 0:
-                print('progress:', int(round(float(n) * 100 / pixel_num)), '%')
-        n += 1
+            print('detrending progress:', int(round(float(chunk_end) * 100 / frame_num)), '%')
 
-    return mov_new, trend, slopes, rvalues
+    return mov_new, trend.astype(np.float32), slopes, rvalues
 
 
 def neural_pil_subtraction(trace_center, trace_surround, lam=0.05):
@@ -890,19 +1032,19 @@ def array_to_rois(input_folder, overlap_threshold=0.9, neuropil_limit=(5, 10), i
 
     mask_frames = tf.imread(os.path.join(input_folder, 'maxInt_masks2.tif'))
 
-    center_masks = {}
+    # center masks are kept as ia.CompactMask objects, they are expanded into full frame masks only for the overlap
+    # detection by MaskSet
+    center_masks = []
 
     for i in range(mask_frames.shape[0]):
         curr_mask_frame = mask_frames[i]
         curr_mask_frame[curr_mask_frame > 0] = 1
         curr_labeled, curr_n = ni.label(curr_mask_frame)
-        curr_masks = ia.get_masks(curr_labeled, isSort=False, keyPrefix='masks_layer_' + str(i), labelLength=None)
-        center_masks.update(curr_masks)
+        curr_masks = ia.get_masks(curr_labeled, isSort=False, keyPrefix='masks_layer_' + str(i), labelLength=None,
+                                  isCompact=True)
+        center_masks += list(curr_masks.values())
 
-    center_mask_array = []
-    for mask in list(center_masks.values()):
-        center_mask_array.append(mask)
-    center_mask_array = np.array(center_mask_array, dtype=np.uint8)
+    center_mask_array = np.array([np.asarray(mask) for mask in center_masks], dtype=np.uint8)
 
     #  remvoe duplicates
     ms = mask_set.MaskSet(center_mask_array.astype(bool))
@@ -910,6 +1052,7 @@ def array_to_rois(input_folder, overlap_threshold=0.9, neuropil_limit=(5, 10), i
     # print 'number of duplicates:', len(duplicates)
     if len(duplicates) > 0:
         inds = list(duplicates.keys())
+        center_masks = [center_masks[i] for i in range(len(center_masks)) if i not in inds]
         center_mask_array = np.array([center_mask_array[i] for i in range(len(center_mask_array)) if i not in inds])
 
     # removing unions
@@ -918,19 +1061,21 @@ def array_to_rois(input_folder, overlap_threshold=0.9, neuropil_limit=(5, 10), i
     # print 'number of unions:', len(unions)
     if len(unions) > 0:
         inds = list(unions.keys())
+        center_masks = [center_masks[i] for i in range(len(center_masks)) if i not in inds]
         center_mask_array = np.array([center_mask_array[i] for i in range(len(center_mask_array)) if i not in inds])
 
     # get total mask
     total_mask = np.sum(center_mask_array, axis=0).astype(np.bool)
     total_mask = np.logical_not(total_mask).astype(np.uint8)
 
-    neuropil_mask_array = []
-    for center_mask in center_mask_array:
-        curr_surround = ni.binary_dilation(center_mask, iterations=neuropil_limit[1]) - \
-                        ni.binary_dilation(center_mask, iterations=neuropil_limit[0])
-        curr_surround = np.logical_and(curr_surround, total_mask)
-        neuropil_mask_array.append(curr_surround)
-    neuropil_mask_array = np.array(neuropil_mask_array, dtype=np.uint8)
+    # the dilation of a center mask can not reach further than neuropil_limit[1] pixels from its bounding box, so the
+    # neuropil mask is generated within the bounding box extended by neuropil_limit[1] pixels
+    neuropil_mask_array = np.zeros(center_mask_array.shape, dtype=np.uint8)
+    for i, center_mask in enumerate(center_masks):
+        local_mask, bounding_box = center_mask.get_local_mask(padding=neuropil_limit[1])
+        curr_surround = np.logical_and(ni.binary_dilation(local_mask, iterations=neuropil_limit[1]),
+                                       np.logical_not(ni.binary_dilation(local_mask, iterations=neuropil_limit[0])))
+        neuropil_mask_array[i][bounding_box] = np.logical_and(curr_surround, total_mask[bounding_box])
 
     center_areas = np.sum(np.sum(center_mask_array, axis=-1), axis=-1)
     if np.min(center_areas) == 0:
@@ -1,10 +1,15 @@
 __author__ = 'junz'
 
 import os
+import hashlib
+import functools
+import multiprocessing
 import numpy as np
+import h5py
+import scipy.ndimage as ni
 import tifffile as tf
-from . import core.ImageAnalysis as ia
-from . import core.FileTools as ft
+from .core import ImageAnalysis as ia
+from .core import FileTools as ft
 import matplotlib.pyplot as plt
 
 
@@ -75,6 +80,103 @@ def iamstupid(imgMat, imgRef, maxDisplacement=10, normFunc=ia.array_diff):
     return np.array(prevOffset,dtype=np.int), hitLimitFlag
 
 
+def upsampledDft(data, regionSize, upsampleFactor, regionOffset):
+    '''
+    upsampled discrete fourier transform of a 2d spectrum, evaluated only in a small region by matrix multiplication
+
+    :param data: 2d complex array, spectrum to be inverse transformed
+    :param regionSize: int, size of the output region (in upsampled pixels) for both rows and columns
+    :param upsampleFactor: int, upsampling factor
+    :param regionOffset: [rowOffset, columnOffset], the upsampled coordinates of the first output pixel
+    :return: 2d complex array with shape (regionSize, regionSize)
+    '''
+
+    rowKernel = np.exp(-2j * np.pi * np.outer(np.arange(regionSize) - regionOffset[0],
+                                              np.fft.fftfreq(data.shape[0], upsampleFactor)))
+    columnKernel = np.exp(-2j * np.pi * np.outer(np.arange(regionSize) - regionOffset[1],
+                                                 np.fft.fftfreq(data.shape[1], upsampleFactor)))
+    return rowKernel.dot(data).dot(columnKernel.transpose())
+
+
+# fraction of the maximum cross-power amplitude added to the amplitude before normalization in phaseCorrelation
+PHASE_CORRELATION_REGULARIZATION = 0.2
+
+
+def phaseCorrelation(imgMat, imgRef, maxDisplacement=10, normFunc=None, upsampleFactor=1):
+    '''
+
+    align two images with rigid transformation by phase correlation (normalized cross-power spectrum, regularized by
+    PHASE_CORRELATION_REGULARIZATION). It has the same signature and output format as MotionCorrection.iamstupid so it
+    can be used as the alignFunc of all alignment functions in this module.
+
+    for subpixel registration use functools.partial(phaseCorrelation, upsampleFactor=10)
+
+    ref: Guizar-Sicairos M, Thurman ST, Fienup JR. Efficient subpixel image registration algorithms. Opt Lett. 2008
+    Jan 15;33(2):156-8.
+
+    :param imgMat: matching image
+    :param imgRef: reference image, should have same shape as imgMat
+    :param maxDisplacement: maximum displacement, same format as in MotionCorrection.iamstupid, if single value, it
+    will be apply to both offset[0] and offset[1]. if two values, they will be applied to offset[0] and offset[1]
+    respectively
+    :param normFunc: not used, only for compatibility with MotionCorrection.iamstupid
+    :param upsampleFactor: positive int, if 1, the offset will be integer pixels. if larger than 1, the integer peak
+    will be refined to 1/upsampleFactor pixel by upsampled DFT around the peak
+    :return:
+    : offSet: final offSet, [xOffset, yOffset], same convention as the offset of ImageAnalysis.rigid_transform
+    : hitLimitFlag: the Flag to mark if the maxDisplacement limit was hit for row and column
+    '''
+
+    if imgMat.shape != imgRef.shape: raise ValueError('imgMat and imgRef should have same shape!')
+    if len(imgRef.shape) != 2: raise ValueError('imgMat and imgRef should be 2d!')
+    if upsampleFactor < 1: raise ValueError('upsampleFactor should be a positive integer!')
+
+    try:
+        xMaxDisplacement = int(abs(maxDisplacement[0]))
+        yMaxDisplacement = int(abs(maxDisplacement[1]))
+    except TypeError: xMaxDisplacement = yMaxDisplacement = int(abs(maxDisplacement))
+
+    height, width = imgRef.shape
+    xMaxDisplacement = min(xMaxDisplacement, (width - 1) // 2)
+    yMaxDisplacement = min(yMaxDisplacement, (height - 1) // 2)
+
+    # hanning window to suppress the edge artifacts from image borders
+    taper = np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+    imgRef = imgRef.astype(np.float32); imgRef = (imgRef - np.mean(imgRef)) * taper
+    imgMat = imgMat.astype(np.float32); imgMat = (imgMat - np.mean(imgMat)) * taper
+
+    # regularized whitening: the amplitude is normalized only where it is large compared to the strongest frequency.
+    # full whitening amplifies the noise dominated high frequencies of smooth images and makes the peak unreliable
+    crossPower = np.fft.fft2(imgRef) * np.conj(np.fft.fft2(imgMat))
+    crossPowerAmp = np.abs(crossPower)
+    crossPower /= crossPowerAmp + PHASE_CORRELATION_REGULARIZATION * np.max(crossPowerAmp) + np.finfo(np.float32).eps
+    corr = np.real(np.fft.ifft2(crossPower))
+
+    # only search the peak within maxDisplacement
+    yShifts = np.arange(-yMaxDisplacement, yMaxDisplacement + 1)
+    xShifts = np.arange(-xMaxDisplacement, xMaxDisplacement + 1)
+    window = corr[np.ix_(yShifts % height, xShifts % width)]
+    peakY, peakX = np.unravel_index(np.argmax(window), window.shape)
+    yOffset = yShifts[peakY]; xOffset = xShifts[peakX]
+
+    if upsampleFactor == 1:
+        offset = np.array([xOffset, yOffset], dtype=np.int)
+    else:
+        regionSize = int(np.ceil(upsampleFactor * 1.5))
+        regionCenter = regionSize // 2
+        upCorr = upsampledDft(np.conj(crossPower), regionSize, upsampleFactor,
+                              [regionCenter - yOffset * upsampleFactor, regionCenter - xOffset * upsampleFactor])
+        upPeak = np.unravel_index(np.argmax(np.abs(upCorr)), upCorr.shape)
+        yOffset = yOffset + float(upPeak[0] - regionCenter) / upsampleFactor
+        xOffset = xOffset + float(upPeak[1] - regionCenter) / upsampleFactor
+        offset = np.array([np.clip(xOffset, -xMaxDisplacement, xMaxDisplacement),
+                           np.clip(yOffset, -yMaxDisplacement, yMaxDisplacement)], dtype=np.float64)
+
+    hitLimitFlag = [int(abs(offset[0]) >= xMaxDisplacement), int(abs(offset[1]) >= yMaxDisplacement)]
+
+    return offset, hitLimitFlag
+
+
 def getDistanceList(img, imgRef, normFunc=ia.array_diff, isPlot = False):
     '''
     get the list of distances from each frame in img to the reference image, imgRef
@@ -94,7 +196,8 @@ def getDistanceList(img, imgRef, normFunc=ia.array_diff, isPlot = False):
     else: return distanceList
 
 
-def alignSingleMovie(mov, imgRef, badFrameDistanceThr=100, maxDisplacement=10, normFunc=ia.array_diff, verbose=False, alignOrder=1):
+def alignSingleMovie(mov, imgRef, badFrameDistanceThr=100, maxDisplacement=10, normFunc=ia.array_diff, verbose=False, alignOrder=1,
+                     alignFunc=iamstupid, isUpdateRef=False):
     '''
     align the frames in a single movie to the imgRef
 
@@ -104,6 +207,13 @@ def alignSingleMovie(mov, imgRef, badFrameDistanceThr=100, maxDisplacement=10, n
     if order is 1: alignment goes from the first frame to the last
     if order is -1: alignment goes from the last frame to the first, this is faster in the alignSingleMovieLoop function
 
+    alignFunc: function to register one frame to imgRef, should have the signature and output of
+               MotionCorrection.iamstupid. options: MotionCorrection.iamstupid (greedy search of distance minimum)
+                                                    MotionCorrection.phaseCorrelation (FFT phase correlation)
+
+    isUpdateRef: if True, the reference is refined while aligning: each good frame is registered to the running mean of
+                 imgRef and all good frames aligned before it. if False, every frame is registered to imgRef
+
     return: offsetList, alignedMov, meanFrame
     '''
 
@@ -112,54 +222,471 @@ def alignSingleMovie(mov, imgRef, badFrameDistanceThr=100, maxDisplacement=10, n
     offsetList = []
     alignedMov = np.empty(mov.shape,dtype=dataType)
     validFrameNum = []
+    if isUpdateRef: currRef = imgRef.astype(np.float64)
+    else: currRef = imgRef
 
     if alignOrder == 1: iterFrames = list(range(mov.shape[0]))
     if alignOrder == -1: iterFrames = list(range(mov.shape[0]))[::-1]
 
     for i in iterFrames:
-        if normFunc(mov[i,:,:],imgRef)<=badFrameDistanceThr:
+        if normFunc(mov[i,:,:],currRef)<=badFrameDistanceThr:
             if np.array_equal(currOffset,np.array([0,0])):initCurrFrame = mov[i,:,:]
             else: initCurrFrame = rigid_transform(mov[i, :, :], offset=currOffset, outputShape=imgRef.shape)
-            additionalOffset, hitFlag = iamstupid(initCurrFrame,imgRef,maxDisplacement=maxDisplacement,normFunc=normFunc)
+            additionalOffset, hitFlag = alignFunc(initCurrFrame,currRef,maxDisplacement=maxDisplacement,normFunc=normFunc)
             currOffset = currOffset+additionalOffset
             alignedMov[i,:,:] = rigid_transform(mov[i, :, :], offset=currOffset, outputShape=imgRef.shape)
             offsetList.append(currOffset)
             validFrameNum.append(i)
+            if isUpdateRef: currRef += (alignedMov[i,:,:] - currRef) / (len(validFrameNum) + 1)
             if verbose:
-                print('Frame'+ft.int2str(i,5)+'\tdistance:'+str(normFunc(mov[i,:,:],imgRef))+'\tgood Frame'+'\tOffset:'+str(currOffset))
+                print('Frame'+ft.int2str(i,5)+'\tdistance:'+str(normFunc(mov[i,:,:],currRef))+'\tgood Frame'+'\tOffset:'+str(currOffset))
         else:
             alignedMov[i,:,:] = rigid_transform(mov[i, :, :], offset=currOffset, outputShape=imgRef.shape)
             offsetList.append(currOffset)
             if verbose:
-                print('Frame'+ft.int2str(i,5)+'\tdistance:'+str(normFunc(mov[i,:,:],imgRef))+'\tbad  Frame'+'\tOffset:'+str(currOffset))
+                print('Frame'+ft.int2str(i,5)+'\tdistance:'+str(normFunc(mov[i,:,:],currRef))+'\tbad  Frame'+'\tOffset:'+str(currOffset))
 
     meanFrame = np.mean(alignedMov[np.array(validFrameNum),:,:],axis=0)
     if alignOrder == -1: offsetList = offsetList[::-1]
     return offsetList, alignedMov, meanFrame
 
 
-def alignSingleMovieLoop(mov, iterations=2, badFrameDistanceThr=100, maxDisplacement=10, normFunc=ia.array_diff, verbose=False):
+def _getFunctionName(func):
+    '''
+    get a name of a function (or functools.partial of a function) which is stable across python sessions
+    '''
+    if isinstance(func, functools.partial):
+        return _getFunctionName(func.func) + repr(func.args) + repr(sorted(func.keywords.items()))
+    return str(getattr(func, '__module__', '')) + '.' + str(getattr(func, '__name__', repr(func)))
+
+
+def _getMovieFingerprint(mov):
+    '''
+    get a cheap fingerprint of a movie from its shape, dtype and its first and last frames
+    '''
+    md5 = hashlib.md5()
+    md5.update(str((mov.shape, str(mov.dtype))).encode('utf-8'))
+    md5.update(np.ascontiguousarray(mov[0]).tobytes())
+    md5.update(np.ascontiguousarray(mov[-1]).tobytes())
+    return md5.hexdigest()
+
+
+def alignSingleMovieLoop(mov, iterations=2, badFrameDistanceThr=100, maxDisplacement=10, normFunc=ia.array_diff, verbose=False,
+                         alignFunc=iamstupid, isUpdateRef=False, offsetTol=None, checkpointPath=None,
+                         isRemoveCheckpoint=True):
     '''
     align a single movie with iterations, every time it will use mean frame from last iteration as imgRef
 
     For every iteration it calls MotionCorrection.alignSingleMovie function
 
     the imgRef for first iteration is the last frame of the movie
+
+    alignFunc: function to register one frame to reference, see MotionCorrection.alignSingleMovie
+    isUpdateRef: if True, the reference is refined with a running mean within each iteration, see
+                 MotionCorrection.alignSingleMovie
+    offsetTol: if not None, iterations will stop early once the largest change of offsets of an iteration is not larger
+               than offsetTol (in pixels). in this case iterations is the maximum number of iterations
+    checkpointPath: path of a .pkl file. if not None, the accumulated offsets and the mean frame are saved into this
+                    file after every iteration, together with the alignment parameters and a fingerprint of mov. if
+                    this file already exists and was saved with the same parameters and movie, the alignment resumes
+                    after the last iteration saved in it, otherwise it is ignored and overwritten. in every iteration
+                    the aligned movie is generated from mov with the accumulated offsets by a single transformation, so
+                    a resumed alignment gives the same results as an uninterrupted one
+    isRemoveCheckpoint: if True, the checkpoint file is removed once the alignment completes
+
+    return: offsetList (2d array, frameNum x 2. if iterations is 1, a list of the offset of each frame as returned by
+            MotionCorrection.alignSingleMovie), alignedMov, meanFrame
     '''
 
     if iterations < 1: raise ValueError('Iterations should be an integer larger than 0!')
 
-    else:
-        offsetList, alignedMov, meanFrame = alignSingleMovie(mov,mov[-1,:,:],badFrameDistanceThr=badFrameDistanceThr,maxDisplacement=maxDisplacement,normFunc=normFunc,verbose=verbose,alignOrder=-1)
-
-        if iterations == 1:
-            return offsetList, alignedMov, meanFrame
+    alignParams = {'badFrameDistanceThr':badFrameDistanceThr,
+                   'maxDisplacement':maxDisplacement,
+                   'normFunc':normFunc,
+                   'verbose':verbose,
+                   'alignFunc':alignFunc,
+                   'isUpdateRef':isUpdateRef}
+
+    startIteration = 0
+    isConverged = False
+    if checkpointPath is not None:
+        checkpointParams = {'iterations':iterations,
+                            'badFrameDistanceThr':badFrameDistanceThr,
+                            'maxDisplacement':maxDisplacement,
+                            'normFunc':_getFunctionName(normFunc),
+                            'alignFunc':_getFunctionName(alignFunc),
+                            'isUpdateRef':isUpdateRef,
+                            'offsetTol':offsetTol}
+        movieFingerprint = _getMovieFingerprint(mov)
+
+    if checkpointPath is not None and os.path.isfile(checkpointPath):
+        checkpoint = ft.loadFile(checkpointPath)
+        if checkpoint.get('parameters') != checkpointParams or checkpoint.get('movieFingerprint') != movieFingerprint:
+            print('Warning: the checkpoint file '+checkpointPath+' was saved with different alignment parameters or a '
+                  'different movie. It is ignored and the alignment starts from the first iteration.')
         else:
+            startIteration = checkpoint['iteration']
+            isConverged = checkpoint['isConverged']
+            allOffsetList = np.array(checkpoint['offset'])
+            meanFrame = checkpoint['meanFrame']
+            if allOffsetList.shape != (mov.shape[0], 2):
+                raise ValueError('The offsets saved in checkpoint file do not match the input movie!')
+            print('Resuming alignment after iteration '+str(startIteration)+' from checkpoint file: '+checkpointPath)
+            alignedMov = ia.rigid_transform_cv2_3d(mov, offset=allOffsetList, outputShape=mov.shape[1:])
+
+    for i in range(startIteration, iterations):
+        if isConverged: break
+
+        if i == 0:
+            offsetList, alignedMov, meanFrame = alignSingleMovie(mov,mov[-1,:,:],alignOrder=-1,**alignParams)
             allOffsetList = np.array(offsetList)
-            for i in range(iterations-1):
-                offsetList, alignedMov, meanFrame = alignSingleMovie(alignedMov,meanFrame,badFrameDistanceThr=badFrameDistanceThr,maxDisplacement=maxDisplacement,normFunc=normFunc,verbose=verbose)
-                allOffsetList += offsetList
-            return allOffsetList, alignedMov,meanFrame
+        else:
+            offsetList, _, meanFrame = alignSingleMovie(alignedMov,meanFrame,**alignParams)
+            allOffsetList = allOffsetList + offsetList
+            # transform the raw movie once with the accumulated offsets instead of composing the transformations of
+            # all iterations, this also gives identical results when the alignment is resumed from a checkpoint
+            alignedMov = ia.rigid_transform_cv2_3d(mov, offset=allOffsetList, outputShape=mov.shape[1:])
+            if offsetTol is not None and np.max(np.abs(offsetList)) <= offsetTol:
+                isConverged = True
+                print('Offsets converged after iteration '+str(i+1)+'.')
+
+        if checkpointPath is not None:
+            ft.saveFile(checkpointPath,{'iteration':i+1,'isConverged':isConverged,'offset':allOffsetList,
+                                        'meanFrame':meanFrame,'parameters':checkpointParams,
+                                        'movieFingerprint':movieFingerprint})
+
+    if checkpointPath is not None and isRemoveCheckpoint and os.path.isfile(checkpointPath): os.remove(checkpointPath)
+
+    if iterations == 1: return list(allOffsetList), alignedMov, meanFrame
+    return allOffsetList, alignedMov, meanFrame
+
+
+def getTileStarts(length, tileSize=128, tileOverlap=32):
+    '''
+    get the start indices of overlapping tiles along one dimension, the last tile is aligned to the end
+
+    :param length: int, length of the dimension
+    :param tileSize: int, length of each tile
+    :param tileOverlap: int, overlap between adjacent tiles, should be smaller than tileSize
+    :return: 1d array of start indices
+    '''
+
+    stride = int(tileSize) - int(tileOverlap)
+    if stride < 1: raise ValueError('tileOverlap should be smaller than tileSize!')
+    if tileSize >= length: return np.array([0])
+    starts = list(range(0, length - tileSize + 1, stride))
+    if starts[-1] != length - tileSize: starts.append(length - tileSize)
+    return np.array(starts)
+
+
+def getTileOffsets(img, imgRef, tileSize=128, tileOverlap=32, maxTileDisplacement=5, normFunc=ia.array_diff,
+                   alignFunc=iamstupid):
+    '''
+    split a (rigidly aligned) frame and the reference frame into overlapping tiles and get the offset of each tile
+
+    :param img: 2d array, matching frame
+    :param imgRef: 2d array, reference frame
+    :param tileSize: int, size of each square tile, will be cut at frame size
+    :param tileOverlap: int, overlap between adjacent tiles
+    :param maxTileDisplacement: maximum displacement of each tile, same format as maxDisplacement in
+                                MotionCorrection.iamstupid
+    :param alignFunc: function to register each tile, MotionCorrection.iamstupid or MotionCorrection.phaseCorrelation
+    :return: 3d array, tileRowNum x tileColumnNum x 2, [xOffset, yOffset] of each tile
+    '''
+
+    rowStarts = getTileStarts(img.shape[0], tileSize, tileOverlap)
+    colStarts = getTileStarts(img.shape[1], tileSize, tileOverlap)
+    tileOffsets = np.zeros((len(rowStarts), len(colStarts), 2))
+    for i, rowStart in enumerate(rowStarts):
+        for j, colStart in enumerate(colStarts):
+            rowEnd = rowStart + tileSize; colEnd = colStart + tileSize
+            tileOffsets[i, j, :], _ = alignFunc(img[rowStart:rowEnd, colStart:colEnd],
+                                                imgRef[rowStart:rowEnd, colStart:colEnd],
+                                                maxDisplacement=maxTileDisplacement, normFunc=normFunc)
+    return tileOffsets
+
+
+def applyTileOffsets(img, tileOffsets, tileSize=128, tileOverlap=32):
+    '''
+    warp a frame by tile offsets. the offsets at tile centers are bilinearly interpolated into smooth x and y shift
+    fields over the whole frame (constant beyond the outermost tile centers), then the frame is resampled by
+    scipy.ndimage.map_coordinates.
+
+    :param img: 2d array
+    :param tileOffsets: 3d array, tileRowNum x tileColumnNum x 2, output of MotionCorrection.getTileOffsets
+    :param tileSize: int, should be the same as used in MotionCorrection.getTileOffsets
+    :param tileOverlap: int, should be the same as used in MotionCorrection.getTileOffsets
+    :return: warped frame, same shape and dtype as img
+    '''
+
+    height, width = img.shape
+    rowCenters = getTileStarts(height, tileSize, tileOverlap) + (min(tileSize, height) - 1) / 2.
+    colCenters = getTileStarts(width, tileSize, tileOverlap) + (min(tileSize, width) - 1) / 2.
+    if tileOffsets.shape[:2] != (len(rowCenters), len(colCenters)):
+        raise ValueError('the shape of tileOffsets does not match the tile grid of the frame!')
+
+    # fractional tile index of each pixel row and column
+    rowInd = np.interp(np.arange(height), rowCenters, np.arange(len(rowCenters)))
+    colInd = np.interp(np.arange(width), colCenters, np.arange(len(colCenters)))
+    gridInd = np.meshgrid(rowInd, colInd, indexing='ij')
+    xShift = ni.map_coordinates(tileOffsets[:, :, 0].astype(np.float64), gridInd, order=1, mode='nearest')
+    yShift = ni.map_coordinates(tileOffsets[:, :, 1].astype(np.float64), gridInd, order=1, mode='nearest')
+
+    rows, cols = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
+    newImg = ni.map_coordinates(img.astype(np.float32), [rows - yShift, cols - xShift], order=1, mode='nearest')
+    return newImg.astype(img.dtype)
+
+
+def alignSingleMoviePiecewise(mov, imgRef, tileSize=128, tileOverlap=32, maxTileDisplacement=5, badFrameDistanceThr=100,
+                              maxDisplacement=10, normFunc=ia.array_diff, verbose=False, alignOrder=1,
+                              alignFunc=iamstupid, savePath=None):
+    '''
+    piecewise rigid alignment of the frames in a single movie to the imgRef. the movie is first aligned rigidly by
+    MotionCorrection.alignSingleMovie, then each rigidly aligned frame is split into overlapping tiles, the offset of
+    each tile relative to the same tile of imgRef is estimated by alignFunc, and the frame is reconstructed with the
+    interpolated shift field (MotionCorrection.applyTileOffsets).
+
+    the frame with distance from imgRef larger than badFramdDistanceThr will not be included in the mean frame
+
+    :param tileSize: int, size of each square tile
+    :param tileOverlap: int, overlap between adjacent tiles
+    :param maxTileDisplacement: maximum displacement of each tile after rigid alignment
+    :param alignFunc: function to register the frame and each tile, see MotionCorrection.alignSingleMovie
+    :param savePath: str, if not None, the rigid offsets, the tile offsets and the tile parameters will be saved into
+                     this .pkl file
+    :return: offsetList, tileOffsets (4d array, frameNum x tileRowNum x tileColumnNum x 2), alignedMov, meanFrame
+    '''
+
+    offsetList, rigidMov, _ = alignSingleMovie(mov, imgRef, badFrameDistanceThr=badFrameDistanceThr,
+                                               maxDisplacement=maxDisplacement, normFunc=normFunc, verbose=verbose,
+                                               alignOrder=alignOrder, alignFunc=alignFunc)
+
+    alignedMov = np.empty(rigidMov.shape, dtype=rigidMov.dtype)
+    tileOffsets = []
+    validFrameNum = []
+    for i in range(rigidMov.shape[0]):
+        currTileOffsets = getTileOffsets(rigidMov[i, :, :], imgRef, tileSize=tileSize, tileOverlap=tileOverlap,
+                                         maxTileDisplacement=maxTileDisplacement, normFunc=normFunc,
+                                         alignFunc=alignFunc)
+        alignedMov[i, :, :] = applyTileOffsets(rigidMov[i, :, :], currTileOffsets, tileSize=tileSize,
+                                               tileOverlap=tileOverlap)
+        tileOffsets.append(currTileOffsets)
+        if normFunc(mov[i, :, :], imgRef) <= badFrameDistanceThr: validFrameNum.append(i)
+        if verbose:
+            print('Frame'+ft.int2str(i,5)+'\tmean tile offset:'+str(np.mean(currTileOffsets.reshape((-1, 2)), axis=0)))
+
+    tileOffsets = np.array(tileOffsets)
+    meanFrame = np.mean(alignedMov[np.array(validFrameNum),:,:],axis=0)
+
+    if savePath is not None:
+        ft.saveFile(savePath,{'offset':np.array(offsetList),'tileOffset':tileOffsets,'tileSize':tileSize,
+                              'tileOverlap':tileOverlap,'meanFrame':meanFrame.astype(np.float32),'status':'piecewise'})
+
+    return offsetList, tileOffsets, alignedMov, meanFrame
+
+
+def getMovieShape(movSource):
+    '''
+    get the shape and data type of a movie without loading its frames
+
+    :param movSource: path to a .tif file or a 3-d array_like object (BinarySlicer, hdf5 dataset, np.ndarray, etc.)
+    :return: shape (frameNum, height, width), dtype
+    '''
+
+    if isinstance(movSource, str):
+        tif = tf.TiffFile(movSource)
+        try:
+            firstFrame = tif.asarray(key=0)
+            return (len(tif.pages),) + firstFrame.shape[-2:], firstFrame.dtype
+        finally: tif.close()
+    else:
+        if len(movSource.shape) != 3: raise ValueError('Input movie should be 3-d!')
+        return tuple(movSource.shape), movSource.dtype
+
+
+def getMovieChunks(movSource, chunkLength=1000):
+    '''
+    generator of consecutive chunks of a movie, only one chunk is loaded into memory each time
+
+    :param movSource: path to a .tif file (read page by page through tifffile.TiffFile) or a 3-d array_like object
+                      supporting slicing along the first axis (BinarySlicer, hdf5 dataset, np.ndarray, np.memmap)
+    :param chunkLength: positive int, frame number of each chunk
+    :return: yield (indStart, indEnd, chunk), chunk is a 3-d np.ndarray of frames [indStart:indEnd]
+    '''
+
+    chunkLength = int(chunkLength)
+    if chunkLength < 1: raise ValueError('chunkLength should be a positive integer!')
+
+    if isinstance(movSource, str):
+        tif = tf.TiffFile(movSource)
+        try:
+            frameNum = len(tif.pages)
+            for indStart in range(0, frameNum, chunkLength):
+                indEnd = min(indStart + chunkLength, frameNum)
+                chunk = tif.asarray(key=slice(indStart, indEnd))
+                yield indStart, indEnd, chunk.reshape((indEnd - indStart,) + chunk.shape[-2:])
+        finally: tif.close()
+    else:
+        if len(movSource.shape) != 3: raise ValueError('Input movie should be 3-d!')
+        frameNum = movSource.shape[0]
+        for indStart in range(0, frameNum, chunkLength):
+            indEnd = min(indStart + chunkLength, frameNum)
+            yield indStart, indEnd, np.array(movSource[indStart:indEnd, :, :])
+
+
+def alignSingleMovieStreaming(movSource, imgRef, savePath=None, chunkLength=1000, badFrameDistanceThr=100,
+                              maxDisplacement=10, normFunc=ia.array_diff, verbose=False, alignFunc=iamstupid,
+                              hdf5Path='corrected', outputDtype=None):
+    '''
+    align the frames of a movie to a fixed reference frame chunk by chunk, without holding the whole movie or its
+    corrected copy in memory. Peak memory is bounded by chunkLength instead of the movie length.
+
+    frames are aligned from the first to the last as MotionCorrection.alignSingleMovie with alignOrder=1, the current
+    offset is carried across chunk borders. the frame with distance from imgRef larger than badFramdDistanceThr will
+    not be used to update current offset, nor will be included in calculation of mean frame
+
+    :param movSource: path to a .tif file or a 3-d array_like object (BinarySlicer, hdf5 dataset, np.ndarray, etc.),
+                      see MotionCorrection.getMovieChunks
+    :param imgRef: 2d array, fixed reference frame
+    :param savePath: str, path of the corrected movie. if ends with '.npy', the corrected frames are written into a
+                     preallocated .npy file (np.lib.format.open_memmap). if ends with '.hdf5' or '.h5', they are
+                     written into the dataset defined by hdf5Path. if None, the corrected movie will not be saved
+    :param chunkLength: positive int, frame number of each chunk
+    :param alignFunc: function to register one frame to imgRef, see MotionCorrection.alignSingleMovie
+    :param hdf5Path: str, path of the corrected dataset within the hdf5 file, only used for hdf5 output
+    :param outputDtype: data type of the corrected movie, if None, the same as the input movie
+    :return: offsetList (2d array, frameNum x 2), meanFrame
+    '''
+
+    movShape, movDtype = getMovieShape(movSource)
+    if movShape[1:] != imgRef.shape:
+        raise ValueError('the frame shape of the movie should be the same as the shape of imgRef!')
+    if outputDtype is None: outputDtype = movDtype
+
+    if savePath is None: outMov = saveFile = None
+    else: outMov, saveFile = _createMovieOutput(savePath, movShape, outputDtype, hdf5Path=hdf5Path)
+
+    if verbose: print('\nInput movie shape:', movShape)
+
+    currOffset = np.array([0,0]).astype(np.int)
+    offsetList = []
+    sumFrame = np.zeros(imgRef.shape, dtype=np.float64)
+    validFrameCount = 0
+
+    try:
+        for indStart, indEnd, chunk in getMovieChunks(movSource, chunkLength=chunkLength):
+            if verbose:
+                print('Aligning frame '+str(indStart)+' to frame '+str(indEnd)+'.\t'+str(indStart*100./movShape[0])+'%')
+            alignedChunk = np.empty(chunk.shape, dtype=chunk.dtype)
+            for i in range(chunk.shape[0]):
+                if normFunc(chunk[i,:,:],imgRef)<=badFrameDistanceThr:
+                    if np.array_equal(currOffset,np.array([0,0])): initCurrFrame = chunk[i,:,:]
+                    else: initCurrFrame = rigid_transform(chunk[i, :, :], offset=currOffset, outputShape=imgRef.shape)
+                    additionalOffset, hitFlag = alignFunc(initCurrFrame,imgRef,maxDisplacement=maxDisplacement,normFunc=normFunc)
+                    currOffset = currOffset+additionalOffset
+                    alignedChunk[i,:,:] = rigid_transform(chunk[i, :, :], offset=currOffset, outputShape=imgRef.shape)
+                    sumFrame += alignedChunk[i,:,:]
+                    validFrameCount += 1
+                else:
+                    alignedChunk[i,:,:] = rigid_transform(chunk[i, :, :], offset=currOffset, outputShape=imgRef.shape)
+                offsetList.append(currOffset)
+
+            if outMov is not None: outMov[indStart:indEnd, :, :] = alignedChunk.astype(outputDtype)
+    finally:
+        if saveFile is not None: saveFile.close()
+        elif outMov is not None: outMov.flush(); del outMov
+
+    if validFrameCount == 0: raise ValueError('No valid frame found! Try larger badFrameDistanceThr.')
+
+    return np.array(offsetList), sumFrame / validFrameCount
+
+
+def _createMovieOutput(savePath, movShape, outputDtype, hdf5Path='corrected'):
+    '''
+    preallocate a movie on disk, a .npy file (np.lib.format.open_memmap) or a dataset in a .hdf5/.h5 file
+
+    return: outMov (np.memmap or hdf5 dataset), saveFile (the opened h5py.File to be closed, None for .npy)
+    '''
+    if savePath[-4:] == '.npy':
+        return np.lib.format.open_memmap(savePath, mode='w+', dtype=outputDtype, shape=movShape), None
+    elif os.path.splitext(savePath)[1] in ['.hdf5', '.h5']:
+        saveFile = h5py.File(savePath, 'a')
+        return saveFile.create_dataset(hdf5Path, movShape, dtype=outputDtype, chunks=(1,) + movShape[1:]), saveFile
+    else: raise ValueError('savePath should end with ".npy", ".hdf5" or ".h5"!')
+
+
+def applyOffsetsStreaming(movSource, offsets, savePath, chunkLength=1000, hdf5Path='corrected', outputDtype=None,
+                          cameraBias=0):
+    '''
+    apply motion correction offsets to a movie chunk by chunk and write the corrected frames into a preallocated .npy
+    file or hdf5 dataset, only one chunk is held in memory
+
+    :param movSource: path to a .tif file or a 3-d array_like object, see MotionCorrection.getMovieChunks
+    :param offsets: 2d array, frameNum x 2, [xOffset, yOffset] of each frame
+    :param savePath: str, path of the corrected movie, ends with '.npy', '.hdf5' or '.h5', see
+                     MotionCorrection.alignSingleMovieStreaming
+    :param cameraBias: value subtracted from the corrected frames
+    '''
+
+    movShape, movDtype = getMovieShape(movSource)
+    offsets = np.array(offsets)
+    if offsets.shape != (movShape[0], 2): raise ValueError('offsets should have shape (frameNum, 2)!')
+    if outputDtype is None: outputDtype = movDtype
+
+    outMov, saveFile = _createMovieOutput(savePath, movShape, outputDtype, hdf5Path=hdf5Path)
+    try:
+        for indStart, indEnd, chunk in getMovieChunks(movSource, chunkLength=chunkLength):
+            chunk = ia.rigid_transform_cv2_3d(chunk, offset=offsets[indStart:indEnd], output=chunk)
+            outMov[indStart:indEnd, :, :] = (chunk - cameraBias).astype(outputDtype)
+    finally:
+        if saveFile is not None: saveFile.close()
+        else: outMov.flush(); del outMov
+
+
+def alignSingleTiff(path, iterations=2, badFrameDistanceThr=100, maxDisplacement=10, normFunc=ia.array_diff, verbose=False,
+                    alignFunc=iamstupid, isUpdateRef=False, offsetTol=None, checkpointPath=None, isStreaming=False,
+                    chunkLength=1000):
+    '''
+    read a single tif file and align it by MotionCorrection.alignSingleMovieLoop. This is the per-file step of
+    MotionCorrection.alignMultipleTiffs, defined at module level so it can be sent to worker processes. the checkpoint
+    file is kept after the alignment, MotionCorrection.alignMultipleTiffs removes it once all files are aligned
+
+    isStreaming: if True, the tif file is not loaded into memory, instead it is aligned by
+                 MotionCorrection.alignSingleMovieStreaming chunk by chunk (chunkLength frames each time) in every
+                 iteration. the reference of the first iteration is the last frame of the movie, the reference of the
+                 following iterations is the mean frame of the last iteration. the offsets of every iteration are
+                 estimated from the raw frames, offsetTol is compared to the change of offsets between iterations.
+                 isUpdateRef and checkpointPath are not supported in this mode
+
+    return: offsetList, meanFrame
+    '''
+
+    if isStreaming:
+        if isUpdateRef or checkpointPath is not None:
+            raise ValueError('isUpdateRef and checkpointPath are not supported by streaming alignment!')
+        print('\nStart streaming alignment of file:', path,'...')
+        tif = tf.TiffFile(path)
+        try: meanFrame = tif.asarray(key=len(tif.pages) - 1)
+        finally: tif.close()
+        currOffset = None
+        for i in range(iterations):
+            lastOffset = currOffset
+            currOffset, meanFrame = alignSingleMovieStreaming(path, meanFrame.reshape(meanFrame.shape[-2:]),
+                                                              chunkLength=chunkLength,
+                                                              badFrameDistanceThr=badFrameDistanceThr,
+                                                              maxDisplacement=maxDisplacement, normFunc=normFunc,
+                                                              verbose=verbose, alignFunc=alignFunc)
+            if offsetTol is not None and lastOffset is not None and np.max(np.abs(currOffset - lastOffset)) <= offsetTol:
+                print('Offsets converged after iteration '+str(i+1)+'.')
+                break
+        return currOffset, meanFrame
+
+    print('\nStart alignment of file:', path,'...')
+    currMov = tf.imread(path)
+    currOffset, _, currMeanFrame = alignSingleMovieLoop(currMov,iterations=iterations,badFrameDistanceThr=badFrameDistanceThr,maxDisplacement=maxDisplacement,normFunc=normFunc,verbose=verbose,alignFunc=alignFunc,
+                                                        isUpdateRef=isUpdateRef,offsetTol=offsetTol,checkpointPath=checkpointPath,
+                                                        isRemoveCheckpoint=False)
+    return currOffset, currMeanFrame
 
 
 def alignMultipleTiffs(paths,
@@ -171,7 +698,14 @@ def alignMultipleTiffs(paths,
                        output=False,
                        saveFolder=None,
                        fileNameSurfix='corrected',
-                       cameraBias=0):
+                       cameraBias=0,
+                       alignFunc=iamstupid,
+                       processNum=1,
+                       isUpdateRef=False,
+                       offsetTol=None,
+                       isCheckpoint=False,
+                       isStreaming=False,
+                       chunkLength=1000):
     '''
     motion correction of mulitiple tif file by using rigid plane transformation. Motion correction will be applied both
     within and across tif files
@@ -185,10 +719,32 @@ def alignMultipleTiffs(paths,
               options: corticalmapping.core.ImageAnalysis.array_diff (mean of absolute difference across all pixels)
                        corticalmapping.core.ImageAnalysis.distance (Frobenius distance or Euclidean norm)
 
+    alignFunc: function to register one frame to reference frame.
+               options: corticalmapping.MotionCorrection.iamstupid (greedy search of distance minimum)
+                        corticalmapping.MotionCorrection.phaseCorrelation (FFT phase correlation)
+
     verbose: if True, print alignment information for each frame
     output: if True, generate and save motion corrected tif files
     saveFolder: if None, corrected files will be saved in the same folder of original data
     fileNameSurfix: surfix of corrected file names
+    processNum: number of worker processes for the alignment within each file. if 1, files will be aligned one by one
+                in current process. if larger than 1, files will be aligned in parallel, results are collected in the
+                order of paths and are identical to the serial alignment. alignment across files is always done in
+                current process after all files are aligned. normFunc and alignFunc should be picklable (module level
+                functions or functools.partial of them)
+    isUpdateRef: if True, refine reference with running mean within each iteration, see MotionCorrection.alignSingleMovie
+    offsetTol: if not None, stop iterations of each file early when offsets change less than offsetTol pixels
+    isCheckpoint: if True, the alignment of each file is checkpointed after every iteration into
+                  '<file name>_correction_checkpoint.pkl' next to the correction results, an interrupted run called
+                  again with the same parameters resumes from the last completed iteration of each file. checkpoints
+                  saved with different parameters or for a different movie are ignored. all checkpoint files are
+                  removed once the alignment of all files (including the alignment across files) completes
+    isStreaming: if True, the tif files and their corrected copies are never held in memory as a whole. each file is
+                 aligned by MotionCorrection.alignSingleMovieStreaming (see MotionCorrection.alignSingleTiff) and the
+                 output files are written chunk by chunk by MotionCorrection.applyOffsetsStreaming as .npy files
+                 ('<file name>_<fileNameSurfix>.npy') instead of .tif files. peak memory is bounded by chunkLength.
+                 isUpdateRef and isCheckpoint are not supported in this mode
+    chunkLength: frame number of each chunk in streaming mode
     '''
 
     if saveFolder is not None:
@@ -196,23 +752,59 @@ def alignMultipleTiffs(paths,
         if len(set(fileNameList))<len(fileNameList):
             raise ValueError('If a save folder is declared, file names in paths should be unique!')
 
+    if processNum < 1: raise ValueError('processNum should be a positive integer!')
+
+    if isStreaming and (isUpdateRef or isCheckpoint):
+        raise ValueError('isUpdateRef and isCheckpoint are not supported by streaming alignment!')
+
+    alignParams = {'iterations':iterations,
+                   'badFrameDistanceThr':badFrameDistanceThr,
+                   'maxDisplacement':maxDisplacement,
+                   'normFunc':normFunc,
+                   'verbose':verbose,
+                   'alignFunc':alignFunc,
+                   'isUpdateRef':isUpdateRef,
+                   'offsetTol':offsetTol}
+    if isStreaming: alignParams.update({'isStreaming':True, 'chunkLength':chunkLength})
+
+    checkpointPaths = []
+    for path in paths:
+        if isCheckpoint:
+            fileFolder, fileName = os.path.split(path)
+            checkpointName = os.path.splitext(fileName)[0]+'_correction_checkpoint.pkl'
+            if saveFolder is not None: checkpointPaths.append(os.path.join(saveFolder,checkpointName))
+            else: checkpointPaths.append(os.path.join(fileFolder,checkpointName))
+        else: checkpointPaths.append(None)
+
+    pool = None
+    if processNum > 1 and len(paths) > 1:
+        print('\nAligning '+str(len(paths))+' files with '+str(processNum)+' processes ...')
+        pool = multiprocessing.Pool(processes=processNum)
+        asyncResults = [pool.apply_async(alignSingleTiff, (path,), dict(alignParams, checkpointPath=checkpointPaths[i]))
+                        for i, path in enumerate(paths)]
+
     offsets = []
     meanFrames = []
-    for path in paths:
-        print('\nStart alignment of file:', path,'...')
-        currMov = tf.imread(path)
-        currOffset, _, currMeanFrame = alignSingleMovieLoop(currMov,iterations=iterations,badFrameDistanceThr=badFrameDistanceThr,maxDisplacement=maxDisplacement,normFunc=normFunc,verbose=verbose)
-        offsets.append(currOffset)
-        meanFrames.append(currMeanFrame)
-
-        # temporally save results
-        print('Saving temporary motion correction results for file:', path)
-        fileFolder, fileName = os.path.split(path)
-        newFileName = os.path.splitext(fileName)[0]+'_correction_results.pkl'
-        if saveFolder is not None: savePath = os.path.join(saveFolder,newFileName)
-        else: savePath = os.path.join(fileFolder,newFileName)
-        ft.saveFile(savePath,{'offset':currOffset,'meanFrame':currMeanFrame.astype(np.float32),'path':path,'status':'single_file'})
-        print('End of alignment for file:',path)
+    try:
+        for i, path in enumerate(paths):
+            if pool is None: currOffset, currMeanFrame = alignSingleTiff(path, checkpointPath=checkpointPaths[i], **alignParams)
+            else: currOffset, currMeanFrame = asyncResults[i].get()
+            offsets.append(currOffset)
+            meanFrames.append(currMeanFrame)
+
+            # temporally save results
+            print('Saving temporary motion correction results for file:', path)
+            fileFolder, fileName = os.path.split(path)
+            newFileName = os.path.splitext(fileName)[0]+'_correction_results.pkl'
+            if saveFolder is not None: savePath = os.path.join(saveFolder,newFileName)
+            else: savePath = os.path.join(fileFolder,newFileName)
+            ft.saveFile(savePath,{'offset':currOffset,'meanFrame':currMeanFrame.astype(np.float32),'path':path,'status':'single_file'})
+            print('End of alignment for file:',path)
+    except:
+        if pool is not None: pool.terminate()
+        raise
+    finally:
+        if pool is not None: pool.close(); pool.join()
 
     meanFrames = np.array(meanFrames)
     if len(paths) > 1:
@@ -220,7 +812,7 @@ def alignMultipleTiffs(paths,
         _, f = getDistanceList(meanFrames,meanFrames[0,:,:],normFunc=normFunc,isPlot=True)
         f.suptitle('Distances across files'); plt.show()
         print('Start alignment across files...')
-        fileOffset, allMeanFrames, aveMeanFrame = alignSingleMovieLoop(meanFrames,iterations=5,badFrameDistanceThr=65535,maxDisplacement=maxDisplacement,normFunc=normFunc,verbose=verbose)
+        fileOffset, allMeanFrames, aveMeanFrame = alignSingleMovieLoop(meanFrames,iterations=5,badFrameDistanceThr=65535,maxDisplacement=maxDisplacement,normFunc=normFunc,verbose=verbose,alignFunc=alignFunc)
         print('Plotting mean frame of each file before and after cross file alignment ...')
         tf.imshow(np.dstack((np.array(meanFrames), np.array(allMeanFrames))),photometric='miniswhite', cmap='gray'); plt.show()
 
@@ -235,22 +827,107 @@ def alignMultipleTiffs(paths,
         print('End of cross file alignment.\n')
     else: print('\nThere is only one file in the list. No need to align across files\n'); aveMeanFrame = meanFrames[0]
 
+    for checkpointPath in checkpointPaths:
+        if checkpointPath is not None and os.path.isfile(checkpointPath): os.remove(checkpointPath)
+
     if output:
         for i, path in enumerate(paths):
             print('Generating output image file for '+path)
             fileFolder, fileName = os.path.split(path)
             newFileName = ('_'+fileNameSurfix).join(os.path.splitext(fileName))
+            if isStreaming: newFileName = os.path.splitext(newFileName)[0]+'.npy'
             if saveFolder is None: newPath = os.path.join(fileFolder,newFileName)
             else: newPath = os.path.join(saveFolder,newFileName)
+            if isStreaming:
+                applyOffsetsStreaming(path, offsets[i], newPath, chunkLength=chunkLength, cameraBias=cameraBias)
+                continue
             mov = tf.imread(path)
-            for j in range(mov.shape[0]):
-                if not np.array_equal(offsets[i][j,:], np.array([0,0])):
-                    mov[j,:,:] = rigid_transform(mov[j, :, :], offset=offsets[i][j, :])
+            mov = ia.rigid_transform_cv2_3d(mov, offset=offsets[i], output=mov)
             tf.imsave(newPath, mov-cameraBias)
 
     return offsets, aveMeanFrame
 
 
+class CorrectedMovie(object):
+    '''
+    read-only view of a raw movie with motion correction offsets applied on the fly. The corrected movie is never
+    materialized, only the requested frames are read from the raw movie and shifted when it is sliced.
+
+    it supports numpy style slicing in the same way as BinarySlicer (integer, slice, list of frames, and spatial
+    indices) and has .shape and .dtype, so it can be passed to functions expecting a BinarySlicer or array, for
+    example ImageAnalysis.get_trace_binaryslicer3 and ImageAnalysis.get_average_movie. the corrected frames are the
+    same as the output files generated by MotionCorrection.alignMultipleTiffs (without camera bias subtraction)
+    '''
+
+    def __init__(self, mov, offsets, chunkLength=100):
+        '''
+        :param mov: 3-d array_like, raw movie (np.ndarray, np.memmap, BinarySlicer, hdf5 dataset, etc.)
+        :param offsets: 2-d array, frameNum x 2, [xOffset, yOffset] of each frame, output of the alignment functions
+                        in this module
+        :param chunkLength: positive int, maximum number of raw frames loaded into memory at once when slicing
+        '''
+
+        if len(mov.shape) != 3: raise ValueError('Input movie should be 3-d!')
+        offsets = np.array(offsets)
+        if offsets.shape != (mov.shape[0], 2): raise ValueError('offsets should have shape (frameNum, 2)!')
+        if chunkLength < 1: raise ValueError('chunkLength should be a positive integer!')
+
+        self.mov = mov
+        self.offsets = offsets
+        self.chunkLength = int(chunkLength)
+        self.shape = tuple(mov.shape)
+        self.dtype = mov.dtype
+        self.ndim = 3
+
+    def __str__(self):
+        return 'corticalmapping.MotionCorrection.CorrectedMovie object'
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_corrected_frame(self, frame, frameInd):
+        '''
+        apply the offset of frame number frameInd to a raw frame
+        '''
+        offset = self.offsets[frameInd]
+        if np.array_equal(offset, np.array([0,0])): return np.array(frame)
+        else: return rigid_transform(frame, offset=list(offset))
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple): key = (key,)
+        if len(key) > 3: raise IndexError('too many indices for a 3-d movie!')
+        frameKey = key[0]; spatialKey = key[1:]
+
+        if isinstance(frameKey, (int, np.integer)):
+            frameInd = int(frameKey)
+            if frameInd < 0: frameInd += self.shape[0]
+            if frameInd < 0 or frameInd >= self.shape[0]: raise IndexError('frame index out of range!')
+            return self.get_corrected_frame(np.array(self.mov[frameInd, :, :]), frameInd)[spatialKey]
+
+        frameInds = np.arange(self.shape[0])[frameKey]
+        outShape = (len(frameInds),) + np.empty(self.shape[1:], dtype=np.bool_)[spatialKey].shape
+        corrected = np.empty(outShape, dtype=self.dtype)
+
+        isContinuous = len(frameInds) > 0 and np.array_equal(frameInds, np.arange(frameInds[0], frameInds[-1] + 1))
+        for chunkStart in range(0, len(frameInds), self.chunkLength):
+            chunkInds = frameInds[chunkStart:chunkStart + self.chunkLength]
+            if isContinuous: rawChunk = np.array(self.mov[chunkInds[0]:chunkInds[-1] + 1, :, :])
+            else: rawChunk = np.array([self.mov[int(i), :, :] for i in chunkInds])
+            for i, frameInd in enumerate(chunkInds):
+                corrected[chunkStart + i] = self.get_corrected_frame(rawChunk[i], frameInd)[spatialKey]
+
+        return corrected
+
+    @staticmethod
+    def from_correction_results(mov, resultPath, chunkLength=100):
+        '''
+        create a CorrectedMovie from a raw movie and the '_correction_results.pkl' file saved by
+        MotionCorrection.alignMultipleTiffs
+        '''
+        return CorrectedMovie(mov, ft.loadFile(resultPath)['offset'], chunkLength=chunkLength)
+
+
 if __name__=='__main__':
 
     #======================================================================================================
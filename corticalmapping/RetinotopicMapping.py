@@ -6,6 +6,7 @@ import scipy.ndimage as ni
 import scipy.stats as stats
 import scipy.sparse as sparse
 import math
+import hashlib
 import matplotlib.pyplot as plt
 from itertools import combinations
 from operator import itemgetter
@@ -133,7 +134,49 @@ def findPhaseIndex(trace, harmonic=1):
     return index
 
 
-def generatePhaseMap(movie,cycles = 1,isReverse = False,isFilter = False,sigma = 3.,isplot = False):
+def getSingleHarmonic(movie, harmonic, isReverse=False, chunkLength=100):
+    '''
+    get one harmonic component of a 3-d movie along the time axis (axis 0), same as
+    np.fft.fft(movie, axis=0)[harmonic, :, :], but without computing the full spectrum. Frames are read chunk by chunk
+    and projected onto the complex exponential of the given harmonic, so memory is proportional to chunkLength frames
+    instead of the whole movie.
+
+    :param movie: 3-d array_like, np.ndarray, BinarySlicer object or hdf5 dataset
+    :param harmonic: non-negative int, the harmonic to be computed (number of cycles in the movie)
+    :param isReverse: bool, if True, the spectrum of (np.amax(movie) - movie) is returned
+    :param chunkLength: positive int, number of frames loaded each time
+    :return: 2-d complex array, the fourier component of each pixel at the given harmonic
+    '''
+
+    if len(movie.shape) != 3: raise ValueError('Input movie should be 3-d!')
+    if chunkLength < 1: raise ValueError('chunkLength should be a positive integer!')
+
+    frameNum = movie.shape[0]
+    realPart = np.zeros(movie.shape[1:], dtype=np.float64)
+    imagPart = np.zeros(movie.shape[1:], dtype=np.float64)
+    movMax = None
+
+    for indStart in range(0, frameNum, int(chunkLength)):
+        indEnd = min(indStart + int(chunkLength), frameNum)
+        chunk = np.array(movie[indStart:indEnd, :, :]).astype(np.float64)
+        angles = 2 * np.pi * harmonic * np.arange(indStart, indEnd) / float(frameNum)
+        realPart += np.tensordot(np.cos(angles), chunk, axes=(0, 0))
+        imagPart -= np.tensordot(np.sin(angles), chunk, axes=(0, 0))
+        if isReverse:
+            chunkMax = np.amax(chunk)
+            if movMax is None or chunkMax > movMax: movMax = chunkMax
+
+    spectrum = realPart + 1j * imagPart
+
+    if isReverse:
+        # fft is linear, the constant term only contributes to the 0th harmonic
+        spectrum = -spectrum
+        if harmonic % frameNum == 0: spectrum += movMax * frameNum
+
+    return spectrum
+
+
+def generatePhaseMap(movie,cycles = 1,isReverse = False,isFilter = False,sigma = 3.,isplot = False,chunkLength = 100):
     '''
     generating phase map of a 3-d movie, on the frequency defined by cycles.
 
@@ -148,29 +191,34 @@ def generatePhaseMap(movie,cycles = 1,isReverse = False,isFilter = False,sigma =
     for this particular pixel: the power at the desired frequency is bigger
     than 'sigma' standard deviation from the mean power of all frequencies.
 
+    if isFilter is False, only the harmonic defined by cycles is computed by getSingleHarmonic (chunk by chunk,
+    chunkLength frames each time), movie can also be a BinarySlicer object or a hdf5 dataset. sigma filtering needs
+    the power of all frequencies, so the full spectrum is computed if isFilter is True.
+
     '''
-    if isReverse:
-        movie = np.amax(movie) - movie
+    if isFilter == True:
+        if isReverse:
+            movie = np.amax(movie) - movie
 
-    spectrumMovie = np.fft.fft(movie,axis=0)
+        spectrumMovie = np.fft.fft(movie,axis=0)
 
-    #generate power movie
-    powerMovie = (np.abs(spectrumMovie) * 2.) / np.size(movie, 0)
-    powerMap = np.abs(powerMovie[cycles,:,:])
+        #generate power movie
+        powerMovie = (np.abs(spectrumMovie) * 2.) / np.size(movie, 0)
+        powerMap = np.abs(powerMovie[cycles,:,:])
 
-    #generate phase movie
-    phaseMovie = np.angle(spectrumMovie)
-    #phaseMap = phaseMovie[cycles,:,:]
-    phaseMap = -1 * phaseMovie[cycles,:,:]
+        #generate phase movie
+        phaseMovie = np.angle(spectrumMovie)
+        #phaseMap = phaseMovie[cycles,:,:]
+        phaseMap = -1 * phaseMovie[cycles,:,:]
 
-    #remove pixels with not enough power in the ideal frequency
-    if isFilter == True:
+        #remove pixels with not enough power in the ideal frequency
         meanPower = np.mean(powerMovie, axis = 0)
         stdPower = np.std(powerMovie, axis = 0)
-        for i in np.arange(powerMap.shape[0]):
-            for j in np.arange(powerMap.shape[1]):
-                if powerMap[i,j] < meanPower[i,j] + sigma * stdPower[i,j]:
-                    phaseMap[i,j] = np.nan
+        phaseMap[powerMap < meanPower + sigma * stdPower] = np.nan
+    else:
+        spectrumMap = getSingleHarmonic(movie, cycles, isReverse=isReverse, chunkLength=chunkLength)
+        powerMap = (np.abs(spectrumMap) * 2.) / movie.shape[0]
+        phaseMap = -1 * np.angle(spectrumMap)
 
     if isplot == True:
         plt.figure()
@@ -181,24 +229,22 @@ def generatePhaseMap(movie,cycles = 1,isReverse = False,isFilter = False,sigma =
     return phaseMap % (2*np.pi), powerMap #value from -pi to pi
 
 
-def generatePhaseMap2(movie,cycles,isReverse = False,isPlot = False):
+def generatePhaseMap2(movie,cycles,isReverse = False,isPlot = False,chunkLength = 100):
     '''
     generating phase map of a 3-d movie, on the frequency defined by cycles.
     the movie should have the same length of 'cycles' number of cycles.
+
+    only the harmonic defined by cycles is computed by getSingleHarmonic (chunk by chunk, chunkLength frames each
+    time), movie can also be a BinarySlicer object or a hdf5 dataset.
     '''
-    if isReverse:
-        movie = np.amax(movie) - movie
 
-    spectrumMovie = np.fft.fft(movie, axis=0)
+    spectrumMap = getSingleHarmonic(movie, cycles, isReverse=isReverse, chunkLength=chunkLength)
 
-    #generate power movie
-    powerMovie = (np.abs(spectrumMovie) * 2.) / np.size(movie, 0)
-    powerMap = np.abs(powerMovie[cycles,:,:])
+    #generate power map
+    powerMap = (np.abs(spectrumMap) * 2.) / movie.shape[0]
 
-    #generate phase movie
-    phaseMovie = np.angle(spectrumMovie)
-    #phaseMap = phaseMovie[cycles,:,:]
-    phaseMap = -1 * phaseMovie[cycles,:,:]
+    #generate phase map
+    phaseMap = -1 * np.angle(spectrumMap)
     phaseMap = phaseMap % (2 * np.pi)
 
     if isPlot == True:
@@ -642,6 +688,89 @@ def plotVisualSpace(visualSpace, altAxis, aziAxis, tickSpace=10, plotAxis=None,
     ax.invert_yaxis()
 
 
+def getVisualSpaceBinMap(altMap, aziMap, altRange=(-40., 60.), aziRange=(-20., 120.), visualFieldOrigin=None,
+                         pixelSize=1.):
+    '''
+    bin the visual location of every cortical pixel into the visual space grid used by Patch.getVisualSpace. This only
+    needs to be done once for all patches of a trial.
+
+    :param altMap: altitude map, or altitude of a set of cortical pixels (any shape)
+    :param aziMap: azimuth map, or azimuth of a set of cortical pixels, same shape as altMap
+    :return: binMap: int array, same shape as altMap, the flat index of each cortical pixel in the visual space,
+                     -1 for pixels outside altRange and aziRange
+             altAxis: 1-d array, altitude of each row of visual space
+             aziAxis: 1-d array, azimuth of each column of visual space
+    '''
+
+    pixelSize = float(pixelSize)
+
+    if visualFieldOrigin:
+        altMap = altMap - visualFieldOrigin[0]
+        aziMap = aziMap - visualFieldOrigin[1]
+
+    altAxis = np.arange(altRange[0], altRange[1], pixelSize)
+    aziAxis = np.arange(aziRange[0], aziRange[1], pixelSize)
+
+    with np.errstate(invalid='ignore'):
+        isIn = (altMap >= altRange[0]) & (altMap <= altRange[1]) & (aziMap >= aziRange[0]) & (aziMap <= aziRange[1])
+
+    indAlt = np.zeros(altMap.shape, dtype=np.int64)
+    indAzi = np.zeros(aziMap.shape, dtype=np.int64)
+    indAlt[isIn] = ((altMap[isIn] - altRange[0]) // pixelSize).astype(np.int64)
+    indAzi[isIn] = ((aziMap[isIn] - aziRange[0]) // pixelSize).astype(np.int64)
+
+    # locations exactly at the upper limits fall out of the axes
+    isIn = isIn & (indAlt < len(altAxis)) & (indAzi < len(aziAxis))
+
+    binMap = np.where(isIn, indAlt * len(aziAxis) + indAzi, -1)
+
+    return binMap, altAxis, aziAxis
+
+
+def binsToVisualSpace(pixelBins, visualSpaceShape, closeIter=None, isFill=False):
+    '''
+    generate binary visual space from the visual space bins of a set of cortical pixels
+
+    :param pixelBins: 1-d int array, flat indices in visual space (from getVisualSpaceBinMap), -1 will be ignored
+    :param visualSpaceShape: (altitude bin number, azimuth bin number)
+    :param closeIter: if not None and no less than 1, binary closing of visual space with this number of iterations
+    :param isFill: if True, fill the holes in visual space (after closing)
+    :return: visual space, 2-d array
+    '''
+
+    visualSpace = np.zeros(visualSpaceShape, dtype=np.uint8)
+    visualSpace.flat[pixelBins[pixelBins >= 0]] = 1
+
+    if closeIter is not None and closeIter >= 1:
+        visualSpace = ni.binary_closing(visualSpace, iterations=closeIter)
+
+    if isFill:
+        visualSpace = ni.binary_fill_holes(visualSpace)
+
+    return visualSpace
+
+
+def getVisualSpaces(patches, altMap, aziMap, altRange=(-40., 60.), aziRange=(-20., 120.), visualFieldOrigin=None,
+                    pixelSize=1., closeIter=None, isFill=False):
+    '''
+    get the visual response spaces of many patches at once, the visual locations of cortical pixels are binned only
+    once and shared by all patches
+
+    :param patches: dictionary of Patch objects
+    :return: dictionary of visual spaces with same keys as patches, altAxis, aziAxis
+    '''
+
+    binMap, altAxis, aziAxis = getVisualSpaceBinMap(altMap, aziMap, altRange=altRange, aziRange=aziRange,
+                                                    visualFieldOrigin=visualFieldOrigin, pixelSize=pixelSize)
+
+    visualSpaces = {}
+    for key, patch in patches.items():
+        visualSpaces.update({key: binsToVisualSpace(binMap[patch.getPixels()], (len(altAxis), len(aziAxis)),
+                                                    closeIter=closeIter, isFill=isFill)})
+
+    return visualSpaces, altAxis, aziAxis
+
+
 def localMin(eccMap, binSize):
 
     '''
@@ -687,18 +816,7 @@ def adjacentPairs(patches,borderWidth = 2):
     return all the patch pairs with same visual sign and sharing border
     '''
 
-    keyList = list(patches.keys())
-    pairKeyList = []
-
-    for pair in combinations(keyList, 2):
-        patch1 = patches[pair[0]]
-        patch2 = patches[pair[1]]
-
-        if (ia.is_adjacent(patch1.array, patch2.array, borderWidth = borderWidth)) and (patch1.sign == patch2.sign):
-
-            pairKeyList.append(pair)
-
-    return pairKeyList
+    return PatchAdjacencyGraph(patches, borderWidth = borderWidth).getPairs(isSameSign = True)
 
 
 def mergePatches(array1, array2, borderWidth = 2):
@@ -716,6 +834,209 @@ def mergePatches(array1, array2, borderWidth = 2):
         return spc
 
 
+class PatchAdjacencyGraph(object):
+    '''
+    adjacency graph of a set of patches. Two patches are adjacent if they are within the border width defined by
+    "borderWidth" (same criterion as corticalmapping.core.ImageAnalysis.is_adjacent, i.e. the city block distance
+    between their closest pixels is no more than 2 * (borderWidth - 1)). The graph is built in a single pass over
+    pixel neighborhoods of a labeled patch map and is updated locally when patches are merged, split or removed.
+    '''
+
+    def __init__(self, patches, borderWidth=2):
+        '''
+        :param patches: dictionary of Patch objects
+        :param borderWidth: int, border width, same definition as in adjacentPairs, should be no less than 2
+        '''
+
+        if borderWidth < 2:
+            raise ValueError('borderWidth should be no less than 2.')
+
+        self.borderWidth = borderWidth
+        self.keys = []  # keys in the order of adding, to keep the order of pairs consistent with the patch dictionary
+        self.signs = {}
+        self.labels = {}
+        self._labelKeys = {}
+        self.neighbors = {}
+        self.labelMap = None
+        self._nextLabel = 1
+        self._hiddenPixels = {}  # pixels of the patches sharing pixels with previously added patches
+
+        for key in patches.keys():
+            self._addNode(key, patches[key])
+            rows, cols = patches[key].getPixels()
+            if self.labelMap is None:
+                self.labelMap = np.zeros(patches[key].sparseArray.shape, dtype=np.int32)
+            self._paintPatch(key, rows, cols)
+
+        if self.labelMap is None:
+            return
+
+        # pixel neighborhoods
+        radius = self._getRadius()
+        labelNum = self._nextLabel
+        height, width = self.labelMap.shape
+        for dr in range(0, radius + 1):
+            for dc in range(-(radius - dr), radius - dr + 1):
+                if dr == 0 and dc <= 0:
+                    continue
+                if dr >= height or abs(dc) >= width:
+                    continue
+                labels1 = self.labelMap[0:height - dr, max(0, -dc):width - max(0, dc)]
+                labels2 = self.labelMap[dr:height, max(0, dc):width - max(0, -dc)]
+                isPair = (labels1 > 0) & (labels2 > 0) & (labels1 != labels2)
+                if not np.any(isPair):
+                    continue
+                pairCodes = np.unique(labels1[isPair].astype(np.int64) * labelNum + labels2[isPair])
+                for pairCode in pairCodes:
+                    self._addEdge(self._getKey(pairCode // labelNum), self._getKey(pairCode % labelNum))
+
+        # patches with shared pixels are not fully represented in the label map
+        for key, (rows, cols) in list(self._hiddenPixels.items()):
+            self._searchNeighbors(key, rows, cols)
+
+    def _getRadius(self):
+        return 2 * (int(self.borderWidth) - 1)
+
+    def _getKey(self, label):
+        return self._labelKeys[int(label)]
+
+    def _addNode(self, key, patch):
+        if key in self.labels:
+            raise LookupError('patch "' + str(key) + '" is already in the graph!')
+        self.keys.append(key)
+        self.signs.update({key: patch.sign})
+        self.labels.update({key: self._nextLabel})
+        self._labelKeys.update({self._nextLabel: key})
+        self.neighbors.update({key: set()})
+        self._nextLabel += 1
+
+    def _addEdge(self, key1, key2):
+        if key1 != key2:
+            self.neighbors[key1].add(key2)
+            self.neighbors[key2].add(key1)
+
+    def _paintPatch(self, key, rows, cols):
+        '''
+        label the free pixels of a patch in the label map, if some of its pixels are already labeled by other patches,
+        all its pixels will be saved in self._hiddenPixels
+        '''
+
+        isFree = self.labelMap[rows, cols] == 0
+        self.labelMap[rows[isFree], cols[isFree]] = self.labels[key]
+        if not np.all(isFree):
+            self._hiddenPixels.update({key: (rows, cols)})
+
+    def _searchNeighbors(self, key, rows, cols):
+        '''
+        add edges between a patch and all the patches within the border width, only the neighborhood of the patch will
+        be searched
+        '''
+
+        if len(rows) == 0:
+            return
+
+        radius = self._getRadius()
+        rowStart = max(np.amin(rows) - radius, 0)
+        rowEnd = min(np.amax(rows) + radius + 1, self.labelMap.shape[0])
+        colStart = max(np.amin(cols) - radius, 0)
+        colEnd = min(np.amax(cols) + radius + 1, self.labelMap.shape[1])
+
+        localMask = np.zeros((rowEnd - rowStart, colEnd - colStart), dtype=np.bool_)
+        localMask[rows - rowStart, cols - colStart] = True
+        localMask = ni.binary_dilation(localMask, iterations=radius)
+
+        localLabels = self.labelMap[rowStart:rowEnd, colStart:colEnd][localMask]
+        for neighborLabel in np.unique(localLabels[localLabels > 0]):
+            self._addEdge(self._getKey(neighborLabel), key)
+
+        for hiddenKey, (hiddenRows, hiddenCols) in self._hiddenPixels.items():
+            isInside = (hiddenRows >= rowStart) & (hiddenRows < rowEnd) & \
+                       (hiddenCols >= colStart) & (hiddenCols < colEnd)
+            if np.any(localMask[hiddenRows[isInside] - rowStart, hiddenCols[isInside] - colStart]):
+                self._addEdge(hiddenKey, key)
+
+    def addPatch(self, key, patch):
+        '''
+        add a patch into the graph, only the neighborhood of the patch will be searched
+        '''
+
+        self._addNode(key, patch)
+        rows, cols = patch.getPixels()
+
+        if self.labelMap is None:
+            self.labelMap = np.zeros(patch.sparseArray.shape, dtype=np.int32)
+
+        self._searchNeighbors(key, rows, cols)
+        self._paintPatch(key, rows, cols)
+
+    def removePatch(self, key):
+        '''
+        remove a patch from the graph
+        '''
+
+        label = self.labels.pop(key)
+        self._labelKeys.pop(label)
+        self.keys.remove(key)
+        self.signs.pop(key)
+        for neighbor in self.neighbors.pop(key):
+            self.neighbors[neighbor].discard(key)
+        self.labelMap[self.labelMap == label] = 0
+
+        # give the released pixels back to the patches sharing them
+        self._hiddenPixels.pop(key, None)
+        for hiddenKey, (rows, cols) in list(self._hiddenPixels.items()):
+            self._hiddenPixels.pop(hiddenKey)
+            self._paintPatch(hiddenKey, rows, cols)
+
+    def mergePatches(self, key1, key2, mergedKey, mergedPatch):
+        '''
+        replace two patches by their merged patch
+        '''
+
+        self.removePatch(key1)
+        self.removePatch(key2)
+        self.addPatch(mergedKey, mergedPatch)
+
+    def splitPatch(self, key, newPatches):
+        '''
+        replace a patch by a dictionary of patches split from it
+        '''
+
+        self.removePatch(key)
+        for newKey, newPatch in newPatches.items():
+            self.addPatch(newKey, newPatch)
+
+    def isAdjacent(self, key1, key2):
+        return key2 in self.neighbors[key1]
+
+    def getPairs(self, isSameSign=True):
+        '''
+        return list of adjacent patch pairs, in the same order as combinations of the patch keys
+
+        :param isSameSign: if True, only return pairs with same visual sign
+        '''
+
+        order = dict((key, ind) for ind, key in enumerate(self.keys))
+        pairKeyList = []
+        for key1 in self.keys:
+            for key2 in sorted(self.neighbors[key1], key=lambda k: order[k]):
+                if order[key2] > order[key1] and ((not isSameSign) or self.signs[key1] == self.signs[key2]):
+                    pairKeyList.append((key1, key2))
+        return pairKeyList
+
+    def copy(self):
+        newGraph = PatchAdjacencyGraph({}, borderWidth=self.borderWidth)
+        newGraph.keys = list(self.keys)
+        newGraph.signs = dict(self.signs)
+        newGraph.labels = dict(self.labels)
+        newGraph._labelKeys = dict(self._labelKeys)
+        newGraph.neighbors = dict((key, set(value)) for key, value in self.neighbors.items())
+        newGraph.labelMap = None if self.labelMap is None else np.array(self.labelMap)
+        newGraph._nextLabel = self._nextLabel
+        newGraph._hiddenPixels = dict(self._hiddenPixels)
+        return newGraph
+
+
 def eccentricityMap(altMap, aziMap, altCenter, aziCenter):
     '''
     calculate eccentricity map of with defined center
@@ -1232,6 +1553,62 @@ def getPatchDict(patch):
     return {'sparseArray':patch.sparseArray,'sign':patch.sign}
 
 
+# processing stages of RetinotopicMappingTrial.processTrial, in the order of execution. each stage is defined as:
+# (stage name, method name, parameter keys, upstream stages, output attribute names)
+# the first stage also depends on the input maps listed in STAGE_INPUT_MAPS
+STAGE_INPUT_MAPS = ('altPosMap', 'aziPosMap', 'altPowerMap', 'aziPowerMap')
+
+PROCESSING_STAGES = (('signMap', '_getSignMap',
+                      ('phaseMapFilterSigma', 'signMapFilterSigma'),
+                      (),
+                      ('altPosMapf', 'aziPosMapf', 'altPowerMapf', 'aziPowerMapf', 'signMap', 'signMapf')),
+                     ('rawPatchMap', '_getRawPatchMap',
+                      ('signMapThr', 'openIter', 'closeIter'),
+                      ('signMap',),
+                      ('rawPatchMap',)),
+                     ('rawPatches', '_getRawPatches',
+                      ('dilationIter', 'borderWidth', 'smallPatchThr'),
+                      ('signMap', 'rawPatchMap'),
+                      ('rawPatches',)),
+                     ('determinantMap', '_getDeterminantMap',
+                      (),
+                      ('signMap',),
+                      ('determinantMap',)),
+                     ('eccentricityMap', '_getEccentricityMap',
+                      ('eccMapFilterSigma',),
+                      ('signMap', 'rawPatches'),
+                      ('eccentricityMap', 'eccentricityMapf')),
+                     ('splitPatches', '_splitPatches',
+                      ('visualSpacePixelSize', 'visualSpaceCloseIter', 'splitLocalMinCutStep', 'splitOverlapThr',
+                       'borderWidth'),
+                      ('signMap', 'rawPatches', 'determinantMap', 'eccentricityMap'),
+                      ('patchesAfterSplit', 'patchGraphAfterSplit')),
+                     ('mergePatches', '_mergePatches',
+                      ('borderWidth', 'visualSpacePixelSize', 'visualSpaceCloseIter', 'mergeOverlapThr',
+                       'smallPatchThr'),
+                      ('signMap', 'splitPatches'),
+                      ('patchesAfterMerge', 'finalPatches')))
+
+
+def getStageCachePath(trialPath):
+    '''
+    return the path of the stage cache file saved next to a trial file
+    '''
+    return os.path.splitext(trialPath)[0] + '_stage_cache.pkl'
+
+
+def hashArray(arr):
+    '''
+    return md5 hex digest of an array, including its shape and dtype, None will be hashed as 'None'
+    '''
+    if arr is None:
+        return 'None'
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.md5(str((arr.shape, arr.dtype.str)).encode())
+    h.update(arr.view(np.uint8).data if arr.size else b'')
+    return h.hexdigest()
+
+
 class RetinotopicMappingTrial(object):
 
 
@@ -1576,6 +1953,9 @@ class RetinotopicMappingTrial(object):
         overlapPatches = []
         newPatchesDict = {}
 
+        # adjacency graph of the patches, updated with each split and reused by self._mergePatches
+        patchGraph = PatchAdjacencyGraph(patches, borderWidth = borderWidth+1)
+
         for key, value in patches.items():
             visualSpace, _, _ = value.getVisualSpace(altPosMapf,
                                                      aziPosMapf,
@@ -1652,6 +2032,8 @@ class RetinotopicMappingTrial(object):
 
                     newPatchesDict.update(newPatches)
 
+                    patchGraph.splitPatch(key, newPatches)
+
         for i in range(len(overlapPatches)):
             patches.pop(overlapPatches[i])
 
@@ -1675,6 +2057,7 @@ class RetinotopicMappingTrial(object):
 
 
         self.patchesAfterSplit = patches
+        self.patchGraphAfterSplit = patchGraph
 
         return patches
 
@@ -1694,6 +2077,14 @@ class RetinotopicMappingTrial(object):
         mergeOverlapThr = self.params['mergeOverlapThr']
         smallPatchThr = self.params['smallPatchThr']
 
+        # adjacency graph of the patches, built once and updated with each merge
+        if hasattr(self, 'patchGraphAfterSplit') and \
+                sorted(self.patchGraphAfterSplit.keys) == sorted(patches.keys()) and \
+                self.patchGraphAfterSplit.borderWidth == borderWidth+1:
+            patchGraph = self.patchGraphAfterSplit.copy()
+        else:
+            patchGraph = PatchAdjacencyGraph(patches, borderWidth = borderWidth+1)
+
         #merging non-overlaping patches
         mergeIter = 1
 
@@ -1713,7 +2104,7 @@ class RetinotopicMappingTrial(object):
             mergePairs = []
 
             #get adjacent pairs
-            adjPairs = adjacentPairs(patches, borderWidth = borderWidth+1)
+            adjPairs = patchGraph.getPairs(isSameSign = True)
 
             for ind, pair in enumerate(adjPairs): #for every adjacent pair
                 patch1 = patches[pair[0]]
@@ -1804,6 +2195,8 @@ class RetinotopicMappingTrial(object):
                         #add merged patches into the 'patches' dictionare
                         patches.update({patch1+'+'+patch2[5:]:value[2]})
 
+                        patchGraph.mergePatches(patch1, patch2, patch1+'+'+patch2[5:], value[2])
+
                         print('merging: '+patch1+' & '+patch2 + ', overlap ratio: ' + str(value[3]))
 
             mergeIter = mergeIter + 1
@@ -1983,6 +2376,9 @@ class RetinotopicMappingTrial(object):
         try:del self.patchesAfterSplit
         except AttributeError:pass
 
+        try:del self.patchGraphAfterSplit
+        except AttributeError:pass
+
         try:del self.patchesAfterMerge
         except AttributeError:pass
 
@@ -1999,22 +2395,77 @@ class RetinotopicMappingTrial(object):
         except AttributeError:pass
 
 
-    def processTrial(self, isPlot = False):
+    def getStageKeys(self):
+        '''
+        return a dictionary of hash keys of every processing stage (see PROCESSING_STAGES). The key of a stage depends
+        on its own parameters and the keys of its upstream stages, so changing a parameter only changes the keys of
+        the stages using it and the stages downstream of them.
+        '''
+
+        inputKey = str([hashArray(getattr(self, mapName)) for mapName in STAGE_INPUT_MAPS])
+
+        stageKeys = {}
+        for stageName, _, paramKeys, upstreamStages, _ in PROCESSING_STAGES:
+            stageParams = [(paramKey, self.params[paramKey]) for paramKey in paramKeys]
+            upstreamKeys = [stageKeys[upstreamStage] for upstreamStage in upstreamStages]
+            if not upstreamStages:
+                upstreamKeys.append(inputKey)
+            stageKeys.update({stageName: hashlib.md5(repr((stageName, stageParams, upstreamKeys)).encode()).hexdigest()})
+
+        return stageKeys
+
+    def cleanStageCache(self):
+
+        try:del self.stageCache
+        except AttributeError:pass
+
+    def processTrial(self, isPlot = False, isCache = True, cachePath = None):
+        '''
+        run all processing stages (see PROCESSING_STAGES)
+
+        :param isPlot: bool, plot the results of each stage. if True, all stages will be recomputed
+        :param isCache: bool, if True, the results of each stage are cached in self.stageCache with a key generated from
+                        the input maps and the parameters of this stage and all its upstream stages. a stage will be
+                        recomputed only if its key is different from the cached one, so after changing one parameter
+                        only the stages depending on it will run again. only the latest result of each stage is kept
+        :param cachePath: str, optional path of the pickle file to persist the stage cache (see getStageCachePath), if
+                          exists, it will be loaded before processing and it will be updated after processing. if None,
+                          the cache is only kept in memory
+        '''
+
         self.cleanMaps()
-        _ = self._getSignMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getRawPatchMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getRawPatches(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getDeterminantMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._getEccentricityMap(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._splitPatches(isPlot=isPlot)
-        if isPlot: plt.show()
-        _ = self._mergePatches(isPlot=isPlot)
-        if isPlot: plt.show()
+
+        if isCache and (not isPlot):
+            if not hasattr(self, 'stageCache'):
+                self.stageCache = {}
+
+            if cachePath is not None and os.path.isfile(cachePath):
+                self.stageCache.update(ft.loadFile(cachePath))
+
+            stageKeys = self.getStageKeys()
+            isUpdated = False
+
+            for stageName, methodName, _, _, outputNames in PROCESSING_STAGES:
+                stageKey = stageKeys[stageName]
+                if stageName in self.stageCache and self.stageCache[stageName]['key'] == stageKey:
+                    print('loading stage from cache: ' + stageName)
+                    for outputName, output in self.stageCache[stageName]['outputs'].items():
+                        setattr(self, outputName, output)
+                else:
+                    print('processing stage: ' + stageName)
+                    _ = getattr(self, methodName)(isPlot=False)
+                    self.stageCache.update({stageName: {'key': stageKey,
+                                                        'outputs': dict((outputName, getattr(self, outputName))
+                                                                        for outputName in outputNames)}})
+                    isUpdated = True
+
+            if cachePath is not None and isUpdated:
+                ft.saveFile(cachePath, self.stageCache)
+
+        else:
+            for _, methodName, _, _, _ in PROCESSING_STAGES:
+                _ = getattr(self, methodName)(isPlot=isPlot)
+                if isPlot: plt.show()
 
 
     def refresh(self,
@@ -3152,16 +3603,18 @@ class RetinotopicMappingTrial(object):
         pixelSize = self.params['visualSpacePixelSize']
         closeIter = self.params['visualSpaceCloseIter']
 
+        visualSpaces, altAxis, aziAxis = getVisualSpaces(finalPatches,
+                                                         self.altPosMapf,
+                                                         self.aziPosMapf,
+                                                         altRange=altRange,
+                                                         aziRange=aziRange,
+                                                         visualFieldOrigin=visualFieldOrigin,
+                                                         pixelSize = pixelSize,
+                                                         closeIter = closeIter)
+
         for key, patch in finalPatches.items():
             currAx = axList[i]
-            visualSpace, altAxis, aziAxis=patch.getVisualSpace(self.altPosMapf,
-                                                               self.aziPosMapf,
-                                                               altRange=altRange,
-                                                               aziRange=aziRange,
-                                                               visualFieldOrigin=visualFieldOrigin,
-                                                               pixelSize = pixelSize,
-                                                               closeIter = closeIter,
-                                                               isplot = False)
+            visualSpace = visualSpaces[key]
 
             if patch.sign == 1:
                 plotColor = '#ff0000'
@@ -3337,6 +3790,14 @@ class Patch(object):
     def getDict(self):
         return {'sparseArray':self.sparseArray,'sign':self.sign}
 
+    def getPixels(self):
+        '''
+        return the indices (rowIndices, columnIndices) of the pixels in the patch, without generating the full array
+        '''
+        coo = self.sparseArray.tocoo()
+        isIn = coo.data != 0
+        return coo.row[isIn], coo.col[isIn]
+
     def getTrace(self,mov):
         '''
         return trace of this patch in a certain movie
@@ -3360,45 +3821,20 @@ class Patch(object):
             return False
 
     def getVisualSpace(self, altMap, aziMap, altRange=(-40., 60.), aziRange=(-20., 120.), visualFieldOrigin=None,
-                       pixelSize=1., closeIter=None, isplot=False):
+                       pixelSize=1., closeIter=None, isFill=False, isplot=False):
         '''
         get the visual response space, visual response space center unique area and
         eccentricity map of a cortical patch
-        '''
-
-        #        altRange = np.array([np.amin(altMap)-10., np.amax(altMap)+10.])
-        #        aziRange = np.array([np.amin(aziMap)-10., np.amax(aziMap)+10.])
-
-        pixelSize = np.float(pixelSize)
-
-        if visualFieldOrigin:
-            altMap = altMap - visualFieldOrigin[0]
-            aziMap = aziMap - visualFieldOrigin[1]
 
-        # altAxis = np.arange(altRange[0], altRange[1], pixelSize)[::-1]
-        # aziAxis = np.arange(aziRange[0], aziRange[1], pixelSize)
-
-        # visualSpace = np.zeros((np.ceil((altRange[1] - altRange[0]) / pixelSize),
-        #                         np.ceil((aziRange[1] - aziRange[0]) / pixelSize)))
-
-        altAxis = np.arange(altRange[0], altRange[1], pixelSize)
-        aziAxis = np.arange(aziRange[0], aziRange[1], pixelSize)
-
-        visualSpace = np.zeros((len(altAxis), len(aziAxis)), dtype=np.uint8)
+        to get visual spaces of many patches on the same maps, use RetinotopicMapping.getVisualSpaces
+        '''
 
-        patchArray = self.array
-        for i in range(patchArray.shape[0]):
-            for j in range(patchArray.shape[1]):
-                if patchArray[i, j]:
-                    corAlt = altMap[i, j]
-                    corAzi = aziMap[i, j]
-                    if (corAlt >= altRange[0]) & (corAlt <= altRange[1]) & (corAzi >= aziRange[0]) & (corAzi <= aziRange[1]):
-                        indAlt = (corAlt - altRange[0]) // pixelSize
-                        indAzi = (corAzi - aziRange[0]) // pixelSize
-                        visualSpace[int(indAlt), int(indAzi)] = 1
+        pixels = self.getPixels()
+        pixelBins, altAxis, aziAxis = getVisualSpaceBinMap(altMap[pixels], aziMap[pixels], altRange=altRange,
+                                                           aziRange=aziRange, visualFieldOrigin=visualFieldOrigin,
+                                                           pixelSize=pixelSize)
 
-        if closeIter >= 1:
-            visualSpace = ni.binary_closing(visualSpace, iterations=closeIter)
+        visualSpace = binsToVisualSpace(pixelBins, (len(altAxis), len(aziAxis)), closeIter=closeIter, isFill=isFill)
 
         if isplot:
             f = plt.figure()
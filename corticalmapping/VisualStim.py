@@ -8,17 +8,21 @@ Created on Wed Jun 25 17:12:24 2014
 
 import os
 import datetime
+import collections
+import hashlib
 import random
 from psychopy import visual, event
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+import threading
+import queue
 from random import shuffle
 
 import socket
 #import tifffile as tf
-from . import core.FileTools as ft
-from . import core.ImageAnalysis as ia
+from .core import FileTools as ft
+from .core import ImageAnalysis as ia
 
 
 #from zro import RemoteObject, Proxy
@@ -148,11 +152,7 @@ def lookup_image(img, lookupI, lookupJ):
     if not lookupI.shape == lookupJ.shape:
         raise LookupError('The lookupI and lookupJ should have same size!!')
 
-    img2 = np.zeros(img.shape)
-
-    for i in range(img2.shape[0]):
-        for j in range(img2.shape[1]):
-            img2[i,j] = img[lookupI[i,j],lookupJ[i,j]]
+    img2 = np.array(img)[lookupI, lookupJ].astype(np.float64)
 
     return img2
 
@@ -197,15 +197,34 @@ def get_warped_square(degCorX,degCorY,center,width,height,ori,foregroundColor=1,
     return frame
 
 
-def circle_mask(map_x, map_y, center, radius):
+# cache of circle masks, keys: (id(map_x), id(map_y), center, radius), values: (map_x, map_y, mask). the maps are
+# kept in the cache so that their ids can not be reused by other arrays while the masks are cached
+_CIRCLE_MASK_CACHE = collections.OrderedDict()
+CIRCLE_MASK_CACHE_SIZE = 32
+
+
+def clear_circle_mask_cache():
+    """
+    remove all cached circle masks generated by circle_mask
+    """
+    _CIRCLE_MASK_CACHE.clear()
+
+
+def circle_mask(map_x, map_y, center, radius, is_cache=True):
     """
     generate a binary mask of a circle with given center and radius on a map with coordinates for each pixel defined by
     map_x and map_y
 
+    the distance of each pixel to the center is calculated in the same way as corticalmapping.core.ImageAnalysis.distance
+    (root mean square across dimensions). the most recent masks are cached by the identity of map_x and map_y, the center
+    and the radius, so map_x and map_y should not be modified in place after being passed to this function (or the cache
+    should be cleared by clear_circle_mask_cache)
+
     :param map_x: x coordinates for each pixel on a map
     :param map_y: y coordinates for each pixel on a map
     :param center: center coordinates of circle center {x, y}
     :param radius: radius of the circle
+    :param is_cache: bool, if True, the mask is looked up from and stored into the cache
     :return: binary mask for the circle, value range [0., 1.]
     """
 
@@ -213,11 +232,21 @@ def circle_mask(map_x, map_y, center, radius):
 
     if len(map_x.shape) != 2: raise ValueError('map_x and map_y should be 2-d!!')
 
-    circle_mask = np.zeros(map_x.shape, dtype = np.uint8)
-    for (i, j), value in  np.ndenumerate(circle_mask):
-        x=map_x[i,j]; y=map_y[i,j]
-        if ia.distance((x,y),center) <= radius:
-            circle_mask[i,j] = 1
+    key = (id(map_x), id(map_y), tuple(float(c) for c in center), float(radius))
+    if is_cache and key in _CIRCLE_MASK_CACHE:
+        cached_x, cached_y, cached_mask = _CIRCLE_MASK_CACHE[key]
+        if cached_x is map_x and cached_y is map_y:
+            _CIRCLE_MASK_CACHE.move_to_end(key)
+            return cached_mask.copy()
+
+    dis = np.sqrt((np.square(np.asarray(map_x, dtype=np.float64) - center[0]) +
+                   np.square(np.asarray(map_y, dtype=np.float64) - center[1])) / 2.)
+    circle_mask = (dis <= radius).astype(np.uint8)
+
+    if is_cache:
+        _CIRCLE_MASK_CACHE[key] = (map_x, map_y, circle_mask.copy())
+        _CIRCLE_MASK_CACHE.move_to_end(key)
+        while len(_CIRCLE_MASK_CACHE) > CIRCLE_MASK_CACHE_SIZE: _CIRCLE_MASK_CACHE.popitem(last=False)
 
     return circle_mask
 
@@ -251,10 +280,44 @@ def get_grating(map_x, map_y, ori=0., spatial_freq=0.1, center=(0.,60.), phase=0
     return grating.astype(map_x.dtype)
 
 
+def _nearest_indices(values, queries):
+    """
+    for each query, find the index of the element in 1-d array values with the smallest absolute difference, same as
+    np.argmin(np.abs(values - query)) for each query (the first index is returned for ties), but by binary search
+
+    :param values: 1-d array
+    :param queries: array of any shape
+    :return: array of int with the same shape as queries
+    """
+
+    values = np.asarray(values, dtype=np.float64).flatten()
+    queries = np.asarray(queries, dtype=np.float64)
+
+    order = np.argsort(values, kind='mergesort')
+    sortedValues = values[order]
+
+    rightPos = np.clip(np.searchsorted(sortedValues, queries), 1, len(values) - 1)
+    leftPos = rightPos - 1
+    if len(values) == 1: rightPos = leftPos = np.zeros(queries.shape, dtype=np.int64)
+
+    # move to the first of repeated values, which has the smallest index since the sort is stable
+    leftPos = np.searchsorted(sortedValues, sortedValues[leftPos])
+    rightPos = np.searchsorted(sortedValues, sortedValues[rightPos])
+
+    leftInd = order[leftPos]; rightInd = order[rightPos]
+    leftDiff = np.abs(values[leftInd] - queries); rightDiff = np.abs(values[rightInd] - queries)
+
+    isLeft = np.logical_or(leftDiff < rightDiff, np.logical_and(leftDiff == rightDiff, leftInd < rightInd))
+    return np.where(isLeft, leftInd, rightInd)
+
+
 class Monitor(object):
     """
     monitor object created by Jun, has the method "remap" to generate the
     spherical corrected coordinates in degrees
+
+    if cacheFolder is not None, the spherical corrected coordinates and the lookup table are cached in this folder,
+    keyed by the monitor geometry, and loaded from there when a monitor with the same geometry is created again
     """
 
     def __init__(self,
@@ -273,7 +336,8 @@ class Monitor(object):
                  gammaGrid=None,
                  luminance=None,
                  downSampleRate=10,
-                 refreshRate = 60.):
+                 refreshRate = 60.,
+                 cacheFolder=None):
 
         if resolution[0] % downSampleRate != 0 or resolution[1] % downSampleRate != 0:
            raise ArithmeticError('Resolution pixel numbers are not divisible by down sampling rate')
@@ -294,6 +358,7 @@ class Monitor(object):
         self.gammaGrid = gammaGrid
         self.luminance = luminance
         self.refreshRate = 60
+        self.cacheFolder = cacheFolder
 
         #distance form the projection point of the eye to the bottom of the monitor
         self.C2Bcm = self.monHcm - self.C2Tcm
@@ -301,8 +366,8 @@ class Monitor(object):
         self.C2Pcm = self.monWcm - self.C2Acm
 
         resolution=[0,0]
-        resolution[0]=self.resolution[0]/downSampleRate
-        resolution[1]=self.resolution[1]/downSampleRate
+        resolution[0]=self.resolution[0]//downSampleRate
+        resolution[1]=self.resolution[1]//downSampleRate
 
         mapcorX, mapcorY = np.meshgrid(list(range(resolution[1])), list(range(resolution[0])))
 
@@ -336,8 +401,8 @@ class Monitor(object):
         self.downSampleRate=downSampleRate
 
         resolution=[0,0]
-        resolution[0]=self.resolution[0]/downSampleRate
-        resolution[1]=self.resolution[1]/downSampleRate
+        resolution[0]=self.resolution[0]//downSampleRate
+        resolution[1]=self.resolution[1]//downSampleRate
 
         mapcorX, mapcorY = np.meshgrid(list(range(resolution[1])), list(range(resolution[0])))
 
@@ -356,33 +421,64 @@ class Monitor(object):
         self.remap()
 
 
-    def remap(self):
+    def _get_cache_path(self):
+        """
+        :return: path of the cache file of current monitor geometry, None if self.cacheFolder is None
+        """
+        if self.cacheFolder is None: return None
 
-        resolution=[0,0]
-        resolution[0]=self.resolution[0]/self.downSampleRate
-        resolution[1]=self.resolution[1]/self.downSampleRate
+        h = hashlib.md5(str((float(self.dis), float(self.monTilt), self.linCorX.shape)).encode())
+        h.update(np.ascontiguousarray(self.linCorX, dtype=np.float64).data)
+        h.update(np.ascontiguousarray(self.linCorY, dtype=np.float64).data)
+        return os.path.join(self.cacheFolder, 'monitor_' + h.hexdigest() + '.pkl')
 
-        mapcorX, mapcorY = np.meshgrid(list(range(resolution[1])), list(range(resolution[0])))
+    def _load_cache(self):
+        """
+        :return: dictionary of cached maps of current monitor geometry, empty if there is no cache
+        """
+        cachePath = self._get_cache_path()
+        if cachePath is None or not os.path.isfile(cachePath): return {}
+        return ft.loadFile(cachePath)
+
+    def _save_cache(self, **kwargs):
+        """
+        add maps into the cache file of current monitor geometry
+        """
+        cachePath = self._get_cache_path()
+        if cachePath is None: return
+
+        cache = self._load_cache()
+        cache.update(kwargs)
+        if not os.path.isdir(self.cacheFolder): os.makedirs(self.cacheFolder)
+        ft.saveFile(cachePath, cache)
+
+    def remap(self):
 
-        newmapX = np.zeros(resolution,dtype=np.float16)
-        newmapY = np.zeros(resolution,dtype=np.float16)
+        cache = self._load_cache()
+        if 'degCorX' in cache and 'degCorY' in cache:
+            self.degCorX = cache['degCorX']
+            self.degCorY = cache['degCorY']
+            return
 
+        linX = self.linCorX[0, :]
+        linY = self.linCorY[:, 0]
 
-        for j in range(resolution[1]):
-            newmapX[:, j] = (180.0 / np.pi) * np.arctan(self.linCorX[0, j] / self.dis)
-            dis2 = np.sqrt(np.square(self.dis) + np.square(self.linCorX[0, j])) #distance from
+        newmapX = ((180.0 / np.pi) * np.arctan(linX / self.dis)).astype(np.float16)
+        newmapX = np.tile(newmapX, (len(linY), 1))
 
-            for i in range(resolution[0]):
-                newmapY[i, j] = (180.0 / np.pi) * np.arctan(self.linCorY[i, 0] / dis2)
+        dis2 = np.sqrt(np.square(self.dis) + np.square(linX)) #distance from eye to each column at horizontal meridian
+        newmapY = ((180.0 / np.pi) * np.arctan(linY[:, None] / dis2[None, :])).astype(np.float16)
 
         self.degCorX = newmapX+90-self.monTilt
         self.degCorY = newmapY
 
+        self._save_cache(degCorX=self.degCorX, degCorY=self.degCorY)
+
     def plot_map(self):
 
         resolution=[0,0]
-        resolution[0]=self.resolution[0]/self.downSampleRate
-        resolution[1]=self.resolution[1]/self.downSampleRate
+        resolution[0]=self.resolution[0]//self.downSampleRate
+        resolution[1]=self.resolution[1]//self.downSampleRate
 
         mapcorX, mapcorY = np.meshgrid(list(range(resolution[1])), list(range(resolution[0])))
 
@@ -447,20 +543,18 @@ class Monitor(object):
         degCorX = self.degCorX+self.monTilt-90
         degCorY = self.degCorY
 
-        lookupI = np.zeros(degCorX.shape).astype(np.int32)
-        lookupJ = np.zeros(degCorX.shape).astype(np.int32)
+        cache = self._load_cache()
+        if 'lookupI' in cache and 'lookupJ' in cache: return cache['lookupI'], cache['lookupJ']
 
-        for j in range(lookupI.shape[1]):
-            currDegX = degCorX[0,j]
-            diffDegX = degNoWarpCorX[0,:] - currDegX
-            IndJ = np.argmin(np.abs(diffDegX))
-            lookupJ[:,j] = IndJ
+        lookupJ = _nearest_indices(degNoWarpCorX[0, :], degCorX[0, :]).astype(np.int32)
+        lookupJ = np.tile(lookupJ, (degCorX.shape[0], 1))
 
-            for i in range(lookupI.shape[0]):
-                currDegY = degCorY[i,j]
-                diffDegY = degNoWarpCorY[:,IndJ] - currDegY
-                indI = np.argmin(np.abs(diffDegY))
-                lookupI[i,j] = indI
+        lookupI = np.zeros(degCorX.shape).astype(np.int32)
+        for indJ in np.unique(lookupJ[0]):
+            currCols = lookupJ[0] == indJ
+            lookupI[:, currCols] = _nearest_indices(degNoWarpCorY[:, indJ], degCorY[:, currCols])
+
+        self._save_cache(lookupI=lookupI, lookupJ=lookupJ)
 
         return lookupI, lookupJ
 
@@ -578,17 +672,158 @@ class Stim(object):
         print('Nothing executed! This is place holder of function "generate_frames" for each specific stimulus.')
         print('This function should return a list of tuples, each tuple represents a single frame of the stimulus and contains all the information to recreate the frame.')
 
+    def prepare_frames(self):
+        """
+        place holder of function "prepare_frames" for each specific stimulus
+
+        this function should generate self.frames and the compact resources needed by self.render_frame (which are kept
+        in self._renderCache and are not saved into the log)
+        """
+        print('Nothing executed! This is place holder of function "prepare_frames" for each specific stimulus.')
+
+    def render_frame(self, i):
+        """
+        place holder of function "render_frame" for each specific stimulus
+
+        this function should return the i-th frame of the stimulus as a 2-d array (with format of float16) rendered
+        from self.frames[i], self.prepare_frames should be called before
+        """
+        print('Nothing executed! This is place holder of function "render_frame" for each specific stimulus.')
+
+    def get_frame_num(self):
+        """
+        :return: total number of frames of the stimulus
+        """
+        if self.frames is None: self.prepare_frames()
+        return len(self.frames)
+
+    def get_frame_key(self, i):
+        """
+        get a hashable key of the i-th frame, frames with the same key are rendered into identical images. by default
+        the key is the frame information in self.frames[i], stimuli whose frames also depend on the frame index should
+        override this function
+
+        :return: hashable key of the i-th frame
+        """
+        return tuple(tuple(x) if isinstance(x, np.ndarray) else x for x in self.frames[i])
+
+    def is_rebuildable(self):
+        """
+        :return: bool, True if every frame can be rebuilt from the log of the stimulus by self.prepare_frames and
+                 self.render_frame. stimuli with random content that is not saved into the log should return False
+        """
+        return True
+
+    def generate_log(self):
+        """
+        generate the log dictionary of the stimulus, should be called after self.prepare_frames
+
+        :return: dictionary with keys 'stimulation', 'monitor' and 'indicator'
+        """
+        mondict = dict(self.monitor.__dict__)
+        indicatordict = dict(self.indicator.__dict__)
+        indicatordict.pop('monitor', None)
+        stimdict = dict(self.__dict__)
+        stimdict.pop('monitor')
+        stimdict.pop('indicator')
+        stimdict.pop('_renderCache', None)
+        return {'stimulation': stimdict,
+                'monitor': mondict,
+                'indicator': indicatordict}
+
     def generate_movie(self):
         """
-        place holder of function "generate_movie" for each specific stimulus
+        generate the full movie of the stimulus by rendering every frame into memory
+
+        for long stimuli, DisplaySequence.set_stim(stim, isLazy=True) renders the frames on demand during display
+        instead
+
+        :return: 3-d array (with format of float16) of the stimulus to be displayed, and the log dictionary
+        """
+
+        self.prepare_frames()
+
+        frameNum = len(self.frames)
+        fullSequence = np.zeros((frameNum, self.monitor.degCorX.shape[0], self.monitor.degCorX.shape[1]),
+                                dtype=np.float16)
+
+        for i in range(frameNum):
+            fullSequence[i] = self.render_frame(i)
+
+            if i % max(1, frameNum // 10) == 0:
+                print(['Generating numpy sequence: ' + str(int(100 * (i + 1) / frameNum)) + '%'])
+
+        return fullSequence, self.generate_log()
+
+    def generate_movie_by_index(self):
+        """
+        generate the unique frames of the stimulus and the index into them for each frame of the stimulus. each unique
+        frame is rendered only once, so for stimuli with repeated frames (gaps, probes lasting several frames, periodic
+        gratings) this takes much less memory than self.generate_movie. the full movie equals frameBank[frameIndices]
+
+        :return: frameBank, 3-d array (with format of float16) of unique frames
+                 frameIndices, 1-d array (with format of uint32), index of the unique frame for each frame
+                 the log dictionary
+        """
+
+        self.prepare_frames()
+
+        frameNum = len(self.frames)
+        frameIndices = np.zeros(frameNum, dtype=np.uint32)
+        uniqueFrameIndices = {}
+        uniqueFrames = []
+
+        for i in range(frameNum):
+            frameKey = self.get_frame_key(i)
+            if frameKey not in uniqueFrameIndices:
+                uniqueFrameIndices[frameKey] = len(uniqueFrames)
+                uniqueFrames.append(self.render_frame(i))
+            frameIndices[i] = uniqueFrameIndices[frameKey]
+
+            if i % max(1, frameNum // 10) == 0:
+                print(['Generating numpy sequence: ' + str(int(100 * (i + 1) / frameNum)) + '%'])
+
+        frameBank = np.array(uniqueFrames, dtype=np.float16).reshape((len(uniqueFrames),
+                                                                      self.monitor.degCorX.shape[0],
+                                                                      self.monitor.degCorX.shape[1]))
+
+        print('Number of unique frames: ' + str(len(uniqueFrames)) + ' out of ' + str(frameNum) + ' frames.')
+
+        return frameBank, frameIndices, self.generate_log()
+
+    def _get_coordinate_maps(self):
+        """
+        :return: x and y coordinate maps of each pixel on the monitor in the coordinate system of the stimulus
+        """
+        if self.coordinate == 'degree':
+            return self.monitor.degCorX, self.monitor.degCorY
+        elif self.coordinate == 'linear':
+            return self.monitor.linCorX, self.monitor.linCorY
+        else:
+            raise LookupError('the "coordinate" attributate show be either "degree" or "linear"')
+
+    def _get_background_frame(self):
+        """
+        :return: a frame (with format of float16) filled with background color
+        """
+        return np.ones(self.monitor.degCorX.shape, dtype=np.float16) * self.background
+
+    def _paint_indicator(self, frame, color):
+        """
+        return a float16 copy of the frame with the indicator area painted with color
         """
-        print('Nothing executed! This is place holder of function "generate_movie" for each specific stimulus.')
-        print('This function should return two things:')
-        print('First: a 3-d array (with format of uint8) of the stimulus to be displayed.')
-        print('Second: a dictionary contain the information of this particular stimulus')
+        indicatorWmin = self.indicator.centerWpixel - (self.indicator.width_pixel // 2)
+        indicatorWmax = self.indicator.centerWpixel + (self.indicator.width_pixel // 2)
+        indicatorHmin = self.indicator.centerHpixel - (self.indicator.height_pixel // 2)
+        indicatorHmax = self.indicator.centerHpixel + (self.indicator.height_pixel // 2)
+
+        frame = np.array(frame, dtype=np.float16)
+        frame[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = color
+        return frame
 
     def clear(self):
         self.frames = None
+        self._renderCache = None
 
     def set_pre_gap_dur(self,preGapDur):
         self.preGapDur = preGapDur
@@ -631,56 +866,30 @@ class UniformContrast(Stim):
 
         return tuple(frames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        generate move for uniform contrast display for recording of spontaneous activity
+        generate frames for uniform contrast display for recording of spontaneous activity
         """
 
-        self.frames = self.generate_frames()
-
-        fullSequence = np.zeros((len(self.frames), self.monitor.degCorX.shape[0], self.monitor.degCorX.shape[1]),
-                                dtype=np.float16)
-
-        indicatorWmin = self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax = self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin = self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax = self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
-
-        background = self.background * np.ones((np.size(self.monitor.degCorX, 0), np.size(self.monitor.degCorX, 1)),
-                                               dtype=np.float16)
-
-        display = self.color * np.ones((np.size(self.monitor.degCorX, 0), np.size(self.monitor.degCorX, 1)),
-                                       dtype=np.float16)
-
         if not (self.coordinate == 'degree' or self.coordinate == 'linear'):
             raise LookupError('the "coordinate" attributate show be either "degree" or "linear"')
 
-        for i in range(len(self.frames)):
-            currFrame = self.frames[i]
-
-            if currFrame[0] == 0:
-                currFCsequence = background
-            else:
-                currFCsequence = display
-
-            currFCsequence[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[1]
+        self.frames = self.generate_frames()
+        self._renderCache = {}
 
-            fullSequence[i] = currFCsequence
+    def render_frame(self, i):
+        """
+        render the i-th frame for uniform contrast display
+        """
 
-            if i in range(0, len(self.frames), len(self.frames) / 10):
-                print(['Generating numpy sequence: ' + str(int(100 * (i + 1) / len(self.frames))) + '%'])
+        currFrame = self.frames[i]
 
-        mondict = dict(self.monitor.__dict__)
-        indicatordict = dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        NFdict = dict(self.__dict__)
-        NFdict.pop('monitor')
-        NFdict.pop('indicator')
-        fullDictionary = {'stimulation': NFdict,
-                          'monitor': mondict,
-                          'indicator': indicatordict}
+        if currFrame[0] == 0:
+            currFCsequence = self._get_background_frame()
+        else:
+            currFCsequence = self.color * np.ones(self.monitor.degCorX.shape, dtype=np.float16)
 
-        return fullSequence, fullDictionary
+        return self._paint_indicator(currFCsequence, currFrame[1])
 
 
 class KSstim(Stim):
@@ -783,23 +992,17 @@ class KSstim(Stim):
         plt.figure()
         plt.imshow(self.squares)
 
-    def generate_sweeps(self):
+    def _generate_sweep_table(self):
         """
-        generate full screen sweep sequence
+        generate the table of all sweeps without rendering them
+
+        :return: list of tuples, (orientation, sweepStartCoordinate, sweepEndCoordinate) for each sweep
         """
         sweepWidth = self.sweepWidth
         stepWidth =  self.stepWidth
         direction = self.direction
 
-        if self.coordinate == 'degree':
-            mapX = self.monitor.degCorX
-            mapY = self.monitor.degCorY
-
-        elif self.coordinate == 'linear':
-            mapX = self.monitor.linCorX
-            mapY = self.monitor.linCorY
-        else:
-            raise LookupError('the "coordinate" attributate show be either "degree" or "linear"')
+        mapX, mapY = self._get_coordinate_maps()
 
         minX = mapX.min()
         maxX = mapX.max()
@@ -820,25 +1023,37 @@ class KSstim(Stim):
         else:
             raise LookupError('attribute "direction" should be "B2U", "U2B", "L2R" or "R2L".')
 
-        sweepTable = []
+        if direction == "L2R" or direction == "R2L":
+            sweepTable = [('V', x, x + sweepWidth) for x in stepX]
+        else:
+            sweepTable = [('H', y, y + sweepWidth) for y in stepY]
+
+        return sweepTable
 
-        if 'stepX' in locals():
-            sweeps = np.zeros((len(stepX), np.size(mapX, 0), np.size(mapX, 1)), dtype = np.float16)
-            for i in range(len(stepX)):
-                temp=sweeps[i,:,:]
-                temp[np.where(np.logical_and(mapX >= stepX[i], mapX < (stepX[i] + sweepWidth)))] = 1.0
-                sweepTable.append(('V', stepX[i], stepX[i] + sweepWidth))
-                del temp
+    def _get_sweep(self, sweep):
+        """
+        render a single sweep
 
-        if 'stepY' in locals():
-            sweeps = np.zeros((len(stepY), np.size(mapY, 0), np.size(mapY, 1)), dtype = np.float16)
-            for j in range(len(stepY)):
-                temp=sweeps[j,:,:]
-                temp[np.where(np.logical_and(mapY >= stepY[j], mapY < (stepY[j] + sweepWidth)))] = 1.0
-                sweepTable.append(('H', stepY[j], stepY[j] + sweepWidth))
-                del temp
+        :param sweep: tuple, (orientation, sweepStartCoordinate, sweepEndCoordinate), one item of the sweep table
+        :return: 2-d bool array, True inside the sweep
+        """
+        mapX, mapY = self._get_coordinate_maps()
+
+        if sweep[0] == 'V':
+            currMap = mapX
+        else:
+            currMap = mapY
+
+        return np.logical_and(currMap >= sweep[1], currMap < sweep[2])
+
+    def generate_sweeps(self):
+        """
+        generate full screen sweep sequence
+        """
+        sweepTable = self._generate_sweep_table()
+        sweeps = np.array([self._get_sweep(sweep) for sweep in sweepTable], dtype=bool)
 
-        return sweeps.astype(np.bool), sweepTable
+        return sweeps, sweepTable
 
     def generate_frames(self):
         """
@@ -857,12 +1072,11 @@ class KSstim(Stim):
         for gap frames the second and third elements should be 'None'
         """
 
-        sweeps, _ = self.generate_sweeps()
         sweepFrame = self.sweepFrame
         flickerFrame = self.flickerFrame
         iteration = self.iteration
 
-        sweepNum = np.size(sweeps,0) # Number of sweeps, vertical or horizontal
+        sweepNum = len(self._generate_sweep_table()) # Number of sweeps, vertical or horizontal
         displayFrameNum = sweepFrame * sweepNum # total frame number for the visual stimulation of 1 iteration
 
         #frames for one iteration
@@ -918,61 +1132,47 @@ class KSstim(Stim):
 
         return tuple(fullFrames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        Function to Generate Kalatsky & Stryker visual stimulus frame by frame
+        generate the frames of Kalatsky & Stryker visual stimulus, the sweeps are rendered frame by frame from the
+        sweep table
         """
 
         self.squares = self.generate_squares()
 
-        sweeps, self.sweepTable = self.generate_sweeps()
+        self.sweepTable = self._generate_sweep_table()
 
         self.frames=self.generate_frames()
 
-        fullSequence = np.zeros((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16)
-
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
-
-        background = self.background * np.ones((np.size(self.monitor.degCorX, 0), np.size(self.monitor.degCorX,1)), dtype = np.float16)
+        self._renderCache = {'background': self._get_background_frame(), 'sweepIndex': None, 'sweep': None}
 
-        for i in range(len(self.frames)):
-            currFrame = self.frames[i]
-
-            if currFrame[0] == 0:
-                currNMsequence = background
-
-            else:
-                currSquare = self.squares * currFrame[1]
-                currSweep = sweeps[currFrame[2]]
-                currNMsequence = (currSweep * currSquare) + ((-1 * (currSweep - 1)) * background)
-
-            currNMsequence[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[3]
+    def render_frame(self, i):
+        """
+        render the i-th frame of Kalatsky & Stryker visual stimulus
+        """
 
-            fullSequence[i] = currNMsequence
+        currFrame = self.frames[i]
+        background = self._renderCache['background']
 
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
+        if currFrame[0] == 0:
+            currNMsequence = background
 
+        else:
+            if self._renderCache['sweepIndex'] != currFrame[2]:
+                self._renderCache['sweep'] = self._get_sweep(self.sweepTable[currFrame[2]])
+                self._renderCache['sweepIndex'] = currFrame[2]
 
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        KSdict=dict(self.__dict__)
-        KSdict.pop('monitor')
-        KSdict.pop('indicator')
-        fulldictionary={'stimulation':KSdict,
-                        'monitor':mondict,
-                        'indicator':indicatordict}
+            currSquare = self.squares * currFrame[1]
+            currSweep = self._renderCache['sweep']
+            currNMsequence = (currSweep * currSquare) + ((-1 * (currSweep - 1)) * background)
 
-        return fullSequence, fulldictionary
+        return self._paint_indicator(currNMsequence, currFrame[3])
 
     def clear(self):
         self.sweepTable = None
         self.frames = None
         self.square = None
+        self._renderCache = None
 
     def set_direction(self,direction):
 
@@ -1018,7 +1218,8 @@ class NoiseKSstim(Stim):
                  iteration=1,
                  preGapDur=2., # gap frame number before flash
                  postGapDur=3., # gap frame number after flash
-                 enhanceExp = None): # (0, inf], if smaller than 1, enhance contrast, if bigger than 1, reduce contrast
+                 enhanceExp = None, # (0, inf], if smaller than 1, enhance contrast, if bigger than 1, reduce contrast
+                 seed = None): # seed of noise movie, if None, a new seed is drawn every time the frames are prepared
 
         super(NoiseKSstim,self).__init__(monitor=monitor,indicator=indicator,background=background,coordinate=coordinate,preGapDur=preGapDur,postGapDur=postGapDur)
 
@@ -1037,10 +1238,12 @@ class NoiseKSstim(Stim):
         self.sweepFrame = sweepFrame
         self.iteration = iteration
         self.enhanceExp = enhanceExp
+        self.seed = seed
 
         self.sweepSpeed = self.monitor.refreshRate * self.stepWidth / self.sweepFrame #the speed of sweeps deg/sec
 
         self.sweepTable = None
+        self.noiseSeed = None
 
 
 
@@ -1054,7 +1257,7 @@ class NoiseKSstim(Stim):
         Fhigh_T = self.tempFreqCeil
         filter_T = generate_filter(frameNum, Fs_T, Flow_T, Fhigh_T, mode = self.filterMode)
 
-        hPixNum = self.monitor.resolution[0]/self.monitor.downSampleRate
+        hPixNum = self.monitor.resolution[0]//self.monitor.downSampleRate
         pixHeightCM = self.monitor.monHcm / hPixNum
         Fs_H = 1 / (np.arcsin(pixHeightCM / self.monitor.dis) * 180 /  np.pi)
         #print 'Fs_H:', Fs_H
@@ -1062,7 +1265,7 @@ class NoiseKSstim(Stim):
         Fhigh_H = self.spatialFreqCeil
         filter_H = generate_filter(hPixNum, Fs_H, Flow_H, Fhigh_H, mode = self.filterMode)
 
-        wPixNum = self.monitor.resolution[1]/self.monitor.downSampleRate
+        wPixNum = self.monitor.resolution[1]//self.monitor.downSampleRate
         pixWidthCM = self.monitor.monWcm / wPixNum
         Fs_W = 1 / (np.arcsin(pixWidthCM / self.monitor.dis) * 180 / np.pi)
         #print 'Fs_W:', Fs_W
@@ -1077,26 +1280,18 @@ class NoiseKSstim(Stim):
 
         return movie
 
-    def generate_sweeps(self):
+    def _generate_sweep_table(self):
         """
-        generate full screen sweep sequence
+        generate the table of all sweeps without rendering them
+
+        :return: list of tuples, (orientation, sweepStartCoordinate, sweepEndCoordinate) for each sweep
         """
-        sweepSigma = self.sweepSigma
         stepWidth =  self.stepWidth
         direction = self.direction
         sweepWidth = float(self.sweepWidth)
         edgeWidth = self.sweepEdgeWidth * self.sweepSigma
 
-        if self.coordinate == 'degree':
-            mapX = self.monitor.degCorX
-            mapY = self.monitor.degCorY
-
-        elif self.coordinate == 'linear':
-            mapX = self.monitor.linCorX
-            mapY = self.monitor.linCorY
-
-        else:
-            raise LookupError('the "coordinate" attributate show be either "degree" or "linear"')
+        mapX, mapY = self._get_coordinate_maps()
 
         minX = mapX.min()
         maxX = mapX.max()
@@ -1117,37 +1312,42 @@ class NoiseKSstim(Stim):
         else:
             raise LookupError('attribute "direction" should be "B2U", "U2B", "L2R" or "R2L".')
 
-        sweepTable = []
-
-        if 'stepX' in locals():
-            sweeps = np.ones((len(stepX), np.size(mapX, 0), np.size(mapX, 1)), dtype = np.float16)
-            for i in range(len(stepX)):
-                currSweep = sweeps[i,:,:]
-
-                sweep1 = gaussian(mapX, mu = stepX[i] - sweepWidth / 2, sig = sweepSigma)
-                sweep2 = gaussian(mapX, mu = stepX[i] + sweepWidth / 2, sig = sweepSigma)
+        if direction == "L2R" or direction == "R2L":
+            sweepTable = [('V', x - sweepWidth / 2, x + sweepWidth / 2) for x in stepX]
+        else:
+            sweepTable = [('H', y - sweepWidth / 2, y + sweepWidth / 2) for y in stepY]
 
-                currSweep[mapX < (stepX[i] - sweepWidth / 2)] = sweep1[mapX < (stepX[i] - sweepWidth / 2)]
-                currSweep[mapX > (stepX[i] + sweepWidth / 2)] = sweep2[mapX > (stepX[i] + sweepWidth / 2)]
+        return sweepTable
 
-                sweeps[i,:,:] = currSweep
+    def _get_sweep(self, sweep):
+        """
+        render a single sweep with gaussian edges
 
-                sweepTable.append(('V', stepX[i] - sweepWidth / 2, stepX[i] + sweepWidth / 2))
+        :param sweep: tuple, (orientation, sweepStartCoordinate, sweepEndCoordinate), one item of the sweep table
+        :return: 2-d array (with format of float16), contrast of the sweep at each pixel
+        """
+        mapX, mapY = self._get_coordinate_maps()
 
-        if 'stepY' in locals():
-            sweeps = np.ones((len(stepY), np.size(mapY, 0), np.size(mapY, 1)), dtype = np.float16)
-            for j in range(len(stepY)):
-                currSweep = sweeps[j,:,:]
+        if sweep[0] == 'V':
+            currMap = mapX
+        else:
+            currMap = mapY
 
-                sweep1 = gaussian(mapY, mu = stepY[j] - sweepWidth / 2, sig = sweepSigma)
-                sweep2 = gaussian(mapY, mu = stepY[j] + sweepWidth / 2, sig = sweepSigma)
+        currSweep = np.ones(currMap.shape, dtype = np.float16)
 
-                currSweep[mapY < (stepY[j] - sweepWidth / 2)] = sweep1[mapY < (stepY[j] - sweepWidth / 2)]
-                currSweep[mapY > (stepY[j] + sweepWidth / 2)] = sweep2[mapY > (stepY[j] + sweepWidth / 2)]
+        isBefore = currMap < sweep[1]
+        isAfter = currMap > sweep[2]
+        currSweep[isBefore] = gaussian(currMap[isBefore], mu = sweep[1], sig = self.sweepSigma)
+        currSweep[isAfter] = gaussian(currMap[isAfter], mu = sweep[2], sig = self.sweepSigma)
 
-                sweeps[j,:,:] = currSweep
+        return currSweep
 
-                sweepTable.append(('H', stepY[j] - sweepWidth / 2, stepY[j] + sweepWidth / 2))
+    def generate_sweeps(self):
+        """
+        generate full screen sweep sequence
+        """
+        sweepTable = self._generate_sweep_table()
+        sweeps = np.array([self._get_sweep(sweep) for sweep in sweepTable], dtype=np.float16)
 
         return sweeps, sweepTable
 
@@ -1167,7 +1367,7 @@ class NoiseKSstim(Stim):
         """
 
         if not(self.sweepTable):
-            _, self.sweepTable = self.generate_sweeps()
+            self.sweepTable = self._generate_sweep_table()
 
         sweepTable = self.sweepTable
         sweepFrame = self.sweepFrame
@@ -1225,62 +1425,65 @@ class NoiseKSstim(Stim):
 
         return tuple(fullFrames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        Function to Generate Kalatsky & Stryker visual stimulus frame by frame
+        generate the frames, the seed and the noise movie of Kalatsky & Stryker visual stimulus, the sweeps are
+        rendered frame by frame from the sweep table. the noise movie is generated from self.noiseSeed (logged), so the
+        frames can be rebuilt with seed=noiseSeed. it is filtered across the whole stimulus so it is kept in memory
         """
 
-        sweeps, self.sweepTable = self.generate_sweeps()
+        self.sweepTable = self._generate_sweep_table()
 
         self.frames = self.generate_frames()
+        self.noiseSeed = int(np.random.randint(0, 2**31 - 1)) if self.seed is None else int(self.seed)
 
-        noise_movie = self.generate_noise_movie(len(self.frames))
-
-        if self.isWarp:
-            lookupI, lookupJ = self.monitor.generate_Lookup_table()
-
-        fullSequence = np.zeros((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16)
-
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
-
-        background = np.ones(self.monitor.degCorX.shape, dtype = np.float16) * self.background
+        randomState = np.random.get_state()
+        np.random.seed(self.noiseSeed)
+        try:
+            noiseMovie = self.generate_noise_movie(len(self.frames))
+        finally:
+            np.random.set_state(randomState)
 
-        for i in range(len(self.frames)):
-            currFrame = self.frames[i]
+        self._renderCache = {'noiseMovie': noiseMovie,
+                             'background': self._get_background_frame(),
+                             'sweepIndex': None,
+                             'sweep': None}
 
-            if currFrame[0] == 0:
-                currNMsequence = background
-            else:
-                currImage = noise_movie[i,:,:]
-                if self.isWarp:
-                    currImage = lookup_image(currImage, lookupI, lookupJ)
-                currNMsequence = currImage * sweeps[currFrame[2]]
+        if self.isWarp:
+            self._renderCache['lookupI'], self._renderCache['lookupJ'] = self.monitor.generate_Lookup_table()
 
-            currNMsequence[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[3]
+    def get_frame_key(self, i):
+        """
+        the noise of each display frame is different, so display frames are keyed by their index
+        """
+        if self.frames[i][0] == 0: return self.frames[i]
+        else: return i
 
-            fullSequence[i] = currNMsequence
+    def render_frame(self, i):
+        """
+        render the i-th frame of Kalatsky & Stryker visual stimulus
+        """
 
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
+        currFrame = self.frames[i]
 
+        if currFrame[0] == 0:
+            currNMsequence = self._renderCache['background']
+        else:
+            if self._renderCache['sweepIndex'] != currFrame[2]:
+                self._renderCache['sweep'] = self._get_sweep(self.sweepTable[currFrame[2]])
+                self._renderCache['sweepIndex'] = currFrame[2]
 
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        KSdict=dict(self.__dict__)
-        KSdict.pop('monitor')
-        KSdict.pop('indicator')
-        fullDictionary={'stimulation':KSdict,
-                        'monitor':mondict,
-                        'indicator':indicatordict}
+            currImage = self._renderCache['noiseMovie'][i,:,:]
+            if self.isWarp:
+                currImage = lookup_image(currImage, self._renderCache['lookupI'], self._renderCache['lookupJ'])
+            currNMsequence = currImage * self._renderCache['sweep']
 
-        return fullSequence, fullDictionary
+        return self._paint_indicator(currNMsequence, currFrame[3])
 
     def clear(self):
         self.sweepTable = None
         self.frames = None
+        self._renderCache = None
 
     def set_direction(self,direction):
 
@@ -1401,24 +1604,12 @@ class ObliqueKSstim(Stim):
         plt.figure()
         plt.imshow(self.squares)
 
-    def generate_sweeps(self):
+    def _get_rotated_maps(self):
         """
-        generate full screen sweep sequence
+        :return: coordinate maps rotated by self.rotation_angle
         """
-        sweepWidth = self.sweepWidth
-        stepWidth =  self.stepWidth
-        direction = self.direction
 
-        if self.coordinate == 'degree':
-            mapX = self.monitor.degCorX
-            mapY = self.monitor.degCorY
-
-        elif self.coordinate == 'linear':
-            mapX = self.monitor.linCorX
-            mapY = self.monitor.linCorY
-
-        else:
-            raise LookupError('the "coordinate" attributate show be either "degree" or "linear"')
+        mapX, mapY = self._get_coordinate_maps()
 
         all_x = mapX.flatten(); all_y = mapY.flatten()
         rotation_matrix = np.array([[np.cos(self.rotation_angle), np.sin(self.rotation_angle)],
@@ -1427,6 +1618,21 @@ class ObliqueKSstim(Stim):
         map_rotated = np.dot(rotation_matrix,np.array([all_x,all_y]))
         map_x_r = map_rotated[0].reshape(mapX.shape); map_y_r = map_rotated[1].reshape(mapY.shape)
 
+        return map_x_r, map_y_r
+
+    def _generate_sweep_table(self, rotatedMaps=None):
+        """
+        generate the table of all sweeps without rendering them
+
+        :param rotatedMaps: output of self._get_rotated_maps(), calculated if None
+        :return: list of tuples, (orientation, sweepStartCoordinate, sweepEndCoordinate) for each sweep
+        """
+        sweepWidth = self.sweepWidth
+        stepWidth =  self.stepWidth
+        direction = self.direction
+
+        if rotatedMaps is None: rotatedMaps = self._get_rotated_maps()
+        map_x_r, map_y_r = rotatedMaps
 
         min_x_r = map_x_r.min(); max_x_r = map_x_r.max()
         min_y_r = map_y_r.min(); max_y_r = map_y_r.max()
@@ -1444,25 +1650,40 @@ class ObliqueKSstim(Stim):
         else:
             raise LookupError('attribute "direction" should be "B2U", "U2B", "L2R" or "R2L".')
 
-        sweepTable = []
+        if direction == "L2R" or direction == "R2L":
+            sweepTable = [('V', x, x + sweepWidth) for x in stepX]
+        else:
+            sweepTable = [('H', y, y + sweepWidth) for y in stepY]
+
+        return sweepTable
+
+    def _get_sweep(self, sweep, rotatedMaps=None):
+        """
+        render a single sweep
+
+        :param sweep: tuple, (orientation, sweepStartCoordinate, sweepEndCoordinate), one item of the sweep table
+        :param rotatedMaps: output of self._get_rotated_maps(), calculated if None
+        :return: 2-d bool array, True inside the sweep
+        """
+        if rotatedMaps is None: rotatedMaps = self._get_rotated_maps()
+        map_x_r, map_y_r = rotatedMaps
 
-        if 'stepX' in locals():
-            sweeps = np.zeros((len(stepX), np.size(map_x_r, 0), np.size(map_x_r, 1)), dtype = np.float16)
-            for i in range(len(stepX)):
-                temp=sweeps[i,:,:]
-                temp[np.where(np.logical_and(map_x_r >= stepX[i], map_x_r < (stepX[i] + sweepWidth)))] = 1.0
-                sweepTable.append(('V', stepX[i], stepX[i] + sweepWidth))
-                del temp
+        if sweep[0] == 'V':
+            currMap = map_x_r
+        else:
+            currMap = map_y_r
 
-        if 'stepY' in locals():
-            sweeps = np.zeros((len(stepY), np.size(map_y_r, 0), np.size(map_y_r, 1)), dtype = np.float16)
-            for j in range(len(stepY)):
-                temp=sweeps[j,:,:]
-                temp[np.where(np.logical_and(map_y_r >= stepY[j], map_y_r < (stepY[j] + sweepWidth)))] = 1.0
-                sweepTable.append(('H', stepY[j], stepY[j] + sweepWidth))
-                del temp
+        return np.logical_and(currMap >= sweep[1], currMap < sweep[2])
+
+    def generate_sweeps(self):
+        """
+        generate full screen sweep sequence
+        """
+        rotatedMaps = self._get_rotated_maps()
+        sweepTable = self._generate_sweep_table(rotatedMaps)
+        sweeps = np.array([self._get_sweep(sweep, rotatedMaps) for sweep in sweepTable], dtype=bool)
 
-        return sweeps.astype(np.bool), sweepTable
+        return sweeps, sweepTable
 
     def generate_frames(self):
         """
@@ -1481,12 +1702,11 @@ class ObliqueKSstim(Stim):
         for gap frames the second and third elements should be 'None'
         """
 
-        sweeps, _ = self.generate_sweeps()
         sweepFrame = self.sweepFrame
         flickerFrame = self.flickerFrame
         iteration = self.iteration
 
-        sweepNum = np.size(sweeps,0) # Number of sweeps, vertical or horizontal
+        sweepNum = len(self._generate_sweep_table()) # Number of sweeps, vertical or horizontal
         displayFrameNum = sweepFrame * sweepNum # total frame number for the visual stimulation of 1 iteration
 
         #frames for one iteration
@@ -1542,61 +1762,53 @@ class ObliqueKSstim(Stim):
 
         return tuple(fullFrames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        Function to Generate Kalatsky & Stryker visual stimulus frame by frame
+        generate the frames of Kalatsky & Stryker visual stimulus, the sweeps are rendered frame by frame from the
+        sweep table
         """
 
         self.squares = self.generate_squares()
 
-        sweeps, self.sweepTable = self.generate_sweeps()
-
-        self.frames=self.generate_frames()
-
-        fullSequence = np.zeros((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16)
+        rotatedMaps = self._get_rotated_maps()
 
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
+        self.sweepTable = self._generate_sweep_table(rotatedMaps)
 
-        background = self.background * np.ones((np.size(self.monitor.degCorX, 0), np.size(self.monitor.degCorX,1)), dtype = np.float16)
-
-        for i in range(len(self.frames)):
-            currFrame = self.frames[i]
-
-            if currFrame[0] == 0:
-                currNMsequence = background
+        self.frames=self.generate_frames()
 
-            else:
-                currSquare = self.squares * currFrame[1]
-                currSweep = sweeps[currFrame[2]]
-                currNMsequence = (currSweep * currSquare) + ((-1 * (currSweep - 1)) * background)
+        self._renderCache = {'background': self._get_background_frame(),
+                             'rotatedMaps': rotatedMaps,
+                             'sweepIndex': None,
+                             'sweep': None}
 
-            currNMsequence[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[3]
+    def render_frame(self, i):
+        """
+        render the i-th frame of Kalatsky & Stryker visual stimulus
+        """
 
-            fullSequence[i] = currNMsequence
+        currFrame = self.frames[i]
+        background = self._renderCache['background']
 
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
+        if currFrame[0] == 0:
+            currNMsequence = background
 
+        else:
+            if self._renderCache['sweepIndex'] != currFrame[2]:
+                self._renderCache['sweep'] = self._get_sweep(self.sweepTable[currFrame[2]],
+                                                             self._renderCache['rotatedMaps'])
+                self._renderCache['sweepIndex'] = currFrame[2]
 
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        KSdict=dict(self.__dict__)
-        KSdict.pop('monitor')
-        KSdict.pop('indicator')
-        fulldictionary={'stimulation':KSdict,
-                        'monitor':mondict,
-                        'indicator':indicatordict}
+            currSquare = self.squares * currFrame[1]
+            currSweep = self._renderCache['sweep']
+            currNMsequence = (currSweep * currSquare) + ((-1 * (currSweep - 1)) * background)
 
-        return fullSequence, fulldictionary
+        return self._paint_indicator(currNMsequence, currFrame[3])
 
     def clear(self):
         self.sweepTable = None
         self.frames = None
         self.square = None
+        self._renderCache = None
 
     def set_direction(self,direction):
 
@@ -1636,7 +1848,8 @@ class FlashingNoise(Stim):
                  flashFrameNum=1, # frame number for display noise of each flash
                  preGapDur=2., # gap frame number before flash
                  postGapDur=3., # gap frame number after flash
-                 isWarp = False): # warp noise or not
+                 isWarp = False, # warp noise or not
+                 seed = None): # seed of noise movie, if None, a new seed is drawn every time the frames are prepared
 
         super(FlashingNoise,self).__init__(monitor=monitor,indicator=indicator,background=background,coordinate=coordinate,preGapDur=preGapDur,postGapDur=postGapDur)
 
@@ -1646,6 +1859,8 @@ class FlashingNoise(Stim):
         self.iteration = iteration
         self.flashFrameNum = flashFrameNum
         self.isWarp = isWarp
+        self.seed = seed
+        self.noiseSeed = None
 
     def generate_noise_movie(self):
         """
@@ -1655,14 +1870,14 @@ class FlashingNoise(Stim):
         frameNum = self.flashFrameNum * self.iteration
         filter_T = np.ones((frameNum))
 
-        hPixNum = self.monitor.resolution[0]/self.monitor.downSampleRate
+        hPixNum = self.monitor.resolution[0]//self.monitor.downSampleRate
         pixHeightCM = self.monitor.monHcm / hPixNum
         Fs_H = 1 / (np.arcsin(pixHeightCM / self.monitor.dis) * 180 /  np.pi)
         Flow_H = 0
         Fhigh_H = self.spatialFreqCeil
         filter_H = generate_filter(hPixNum, Fs_H, Flow_H, Fhigh_H, mode = self.filterMode)
 
-        wPixNum = self.monitor.resolution[1]/self.monitor.downSampleRate
+        wPixNum = self.monitor.resolution[1]//self.monitor.downSampleRate
         pixWidthCM = self.monitor.monWcm / wPixNum
         Fs_W = 1 / (np.arcsin(pixWidthCM / self.monitor.dis) * 180 / np.pi)
         Flow_W = 0
@@ -1724,54 +1939,44 @@ class FlashingNoise(Stim):
 
         return tuple(frames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        generating movie
+        generate the frames and the noise movie from self.noiseSeed (logged), so the frames can be rebuilt with
+        seed=noiseSeed
         """
 
         self.frames = self.generate_frames()
-        noise_movie = self.generate_noise_movie()
-
-        if self.isWarp:
-            lookupI, lookupJ = self.monitor.generate_Lookup_table()
-
-        fullSequence = np.zeros((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16)
-
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
+        self.noiseSeed = int(np.random.randint(0, 2**31 - 1)) if self.seed is None else int(self.seed)
 
-        background = self.background * np.ones((np.size(self.monitor.degCorX, 0), np.size(self.monitor.degCorX,1)), dtype = np.float16)
-
-        for i in range(len(self.frames)):
-            currFrame = self.frames[i]
+        randomState = np.random.get_state()
+        np.random.seed(self.noiseSeed)
+        try:
+            noiseMovie = self.generate_noise_movie()
+        finally:
+            np.random.set_state(randomState)
 
-            if currFrame[0] == 0:
-                currFNsequence = background
-            else:
-                currFNsequence = noise_movie[currFrame[2],:,:]
-                if self.isWarp:
-                    currFNsequence = lookup_image(currFNsequence, lookupI, lookupJ)
+        self._renderCache = {'noiseMovie': noiseMovie,
+                             'background': self._get_background_frame()}
 
-            currFNsequence[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[3]
+        if self.isWarp:
+            self._renderCache['lookupI'], self._renderCache['lookupJ'] = self.monitor.generate_Lookup_table()
 
-            fullSequence[i] = currFNsequence
+    def render_frame(self, i):
+        """
+        render the i-th frame
+        """
 
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
+        currFrame = self.frames[i]
 
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        NFdict=dict(self.__dict__)
-        NFdict.pop('monitor')
-        NFdict.pop('indicator')
-        fullDictionary={'stimulation':NFdict,
-                        'monitor':mondict,
-                        'indicator':indicatordict}
+        if currFrame[0] == 0:
+            currFNsequence = self._renderCache['background']
+        else:
+            currFNsequence = self._renderCache['noiseMovie'][currFrame[2],:,:]
+            if self.isWarp:
+                currFNsequence = lookup_image(currFNsequence, self._renderCache['lookupI'],
+                                              self._renderCache['lookupJ'])
 
-        return fullSequence, fullDictionary
+        return self._paint_indicator(currFNsequence, currFrame[3])
 
     def set_flash_frame_num(self, flashFrameNum):
         self.flashFrameNum = flashFrameNum
@@ -1833,7 +2038,7 @@ class GaussianNoise(Stim):
         Fhigh_T = self.tempFreqCeil
         filter_T = generate_filter(frameNum, Fs_T, Flow_T, Fhigh_T, mode = self.filterMode)
 
-        hPixNum = self.monitor.resolution[0]/self.monitor.downSampleRate
+        hPixNum = self.monitor.resolution[0]//self.monitor.downSampleRate
         pixHeightCM = self.monitor.monHcm / hPixNum
         Fs_H = 1 / (np.arcsin(pixHeightCM / self.monitor.dis) * 180 /  np.pi)
         #print 'Fs_H:', Fs_H
@@ -1841,7 +2046,7 @@ class GaussianNoise(Stim):
         Fhigh_H = self.spatialFreqCeil
         filter_H = generate_filter(hPixNum, Fs_H, Flow_H, Fhigh_H, mode = self.filterMode)
 
-        wPixNum = self.monitor.resolution[1]/self.monitor.downSampleRate
+        wPixNum = self.monitor.resolution[1]//self.monitor.downSampleRate
         pixWidthCM = self.monitor.monWcm / wPixNum
         Fs_W = 1 / (np.arcsin(pixWidthCM / self.monitor.dis) * 180 / np.pi)
         #print 'Fs_W:', Fs_W
@@ -1931,61 +2136,69 @@ class GaussianNoise(Stim):
 
         return tuple(frames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        generating movie
+        generate the frames and a random seed of noise movie for each iteration. the noise movie of an iteration is
+        generated from its seed when its first frame is rendered, so only one iteration of noise movie is kept in memory
         """
 
         self.frames = self.generate_frames()
-        iterationFrameNum = len(self.frames) / self.iteration
+        self.noiseSeeds = [int(seed) for seed in np.random.randint(0, 2**31 - 1, size=self.iteration)]
 
+        self._renderCache = {'background': self._get_background_frame(),
+                             'noiseIteration': None,
+                             'noiseMovie': None}
 
         if self.isWarp:
-            lookupI, lookupJ = self.monitor.generate_Lookup_table()
-
-        fullSequence = np.zeros((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16)
+            self._renderCache['lookupI'], self._renderCache['lookupJ'] = self.monitor.generate_Lookup_table()
 
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
-
-        background = self.background * np.ones((self.monitor.degCorX.shape), dtype = np.float16)
+    def _get_iteration_noise_movie(self, iteration):
+        """
+        :return: noise movie of one iteration generated from its random seed, the state of numpy random number
+                 generator is not changed
+        """
 
-        for i in range(len(self.frames)):
+        if self._renderCache['noiseIteration'] != iteration:
+            iterationFrameNum = len(self.frames) // self.iteration
+            displayFrameNum = iterationFrameNum - self.preGapFrameNum - self.postGapFrameNum
 
-            currFrame = self.frames[i]
+            randomState = np.random.get_state()
+            np.random.seed(self.noiseSeeds[iteration])
+            try:
+                self._renderCache['noiseMovie'] = self.generate_noise_movie(displayFrameNum)
+            finally:
+                np.random.set_state(randomState)
+            self._renderCache['noiseIteration'] = iteration
 
-            if currFrame[1] == 1:
-                displayFrameNum = iterationFrameNum - self.preGapFrameNum - self.postGapFrameNum
-                noise_movie = self.generate_noise_movie(displayFrameNum)
+        return self._renderCache['noiseMovie']
 
-            if currFrame[0] == 0:
-                currGNsequence = background
-            else:
-                currDisplayInd = (i % iterationFrameNum) - self.preGapFrameNum
-                currGNsequence = noise_movie[currDisplayInd,:,:] * currFrame[4]
-                if self.isWarp:
-                    currGNsequence = lookup_image(currGNsequence, lookupI, lookupJ)
-
-            currGNsequence[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[3]
+    def get_frame_key(self, i):
+        """
+        the noise of each display frame is different, so display frames are keyed by their index, gap frames are keyed
+        by their indicator color (the contrast of gap frames is nan, which can not be compared)
+        """
+        if self.frames[i][0] == 0: return 0, float(self.frames[i][3])
+        else: return i
 
-            fullSequence[i] = currGNsequence
+    def render_frame(self, i):
+        """
+        render the i-th frame
+        """
 
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
+        currFrame = self.frames[i]
 
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        KSdict=dict(self.__dict__)
-        KSdict.pop('monitor')
-        KSdict.pop('indicator')
-        fullDictionary={'stimulation':KSdict,
-                        'monitor':mondict,
-                        'indicator':indicatordict}
+        if currFrame[0] == 0:
+            currGNsequence = self._renderCache['background']
+        else:
+            iterationFrameNum = len(self.frames) // self.iteration
+            noise_movie = self._get_iteration_noise_movie(int(currFrame[2]))
+            currDisplayInd = (i % iterationFrameNum) - self.preGapFrameNum
+            currGNsequence = noise_movie[currDisplayInd,:,:] * currFrame[4]
+            if self.isWarp:
+                currGNsequence = lookup_image(currGNsequence, self._renderCache['lookupI'],
+                                              self._renderCache['lookupJ'])
 
-        return fullSequence, fullDictionary
+        return self._paint_indicator(currGNsequence, currFrame[3])
 
     def set_flash_frame_num(self, flashFrameNum):
         self.flashFrame = flashFrameNum
@@ -2102,60 +2315,33 @@ class FlashingCircle(Stim):
 
         return tuple(frames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        generating movie
+        generate the frames and the circle mask
         """
 
         self.frames = self.generate_frames()
 
-        fullSequence = np.zeros((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16)
+        mapX, mapY = self._get_coordinate_maps()
 
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
+        self._renderCache = {'background': self._get_background_frame(),
+                             'circleMask': circle_mask(mapX,mapY,self.center,self.radius).astype(np.float16)}
 
-        background = self.background * np.ones((np.size(self.monitor.degCorX, 0), np.size(self.monitor.degCorX,1)), dtype = np.float16)
+    def render_frame(self, i):
+        """
+        render the i-th frame
+        """
 
-        if self.coordinate == 'degree':
-            mapX = self.monitor.degCorX
-            mapY = self.monitor.degCorY
+        currFrame = self.frames[i]
+        background = self._renderCache['background']
+        circleMask = self._renderCache['circleMask']
 
-        elif self.coordinate == 'linear':
-            mapX = self.monitor.linCorX
-            mapY = self.monitor.linCorY
+        if currFrame[0] == 0:
+            currFCsequence = background
         else:
-            raise LookupError('the "coordinate" attributate show be either "degree" or "linear"')
-
-        circleMask = circle_mask(mapX,mapY,self.center,self.radius).astype(np.float16)
-
-        for i in range(len(self.frames)):
-            currFrame = self.frames[i]
-
-            if currFrame[0] == 0:
-                currFCsequence = background
-            else:
-                currFCsequence = (circleMask * self.color) + ((-1 * (circleMask - 1)) * background)
+            currFCsequence = (circleMask * self.color) + ((-1 * (circleMask - 1)) * background)
 
-            currFCsequence[indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[3]
-
-            fullSequence[i] = currFCsequence
-
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
-
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        NFdict=dict(self.__dict__)
-        NFdict.pop('monitor')
-        NFdict.pop('indicator')
-        fullDictionary={'stimulation':NFdict,
-                        'monitor':mondict,
-                        'indicator':indicatordict}
-
-        return fullSequence, fullDictionary
+        return self._paint_indicator(currFCsequence, currFrame[3])
 
 
 class SparseNoise(Stim):
@@ -2349,61 +2535,41 @@ class SparseNoise(Stim):
 
         return tuple(frames)
 
-    def generate_movie(self):
+    def prepare_frames(self):
         """
-        generate movie for display
+        generate the pseudorandomized frames for display
         """
 
         self.frames = self.generate_frames()
 
-        if self.coordinate=='degree':corX=self.monitor.degCorX;corY=self.monitor.degCorY
-        elif self.coordinate=='linear':corX=self.monitor.linCorX;corY=self.monitor.linCorY
+        self._renderCache = {'maps': self._get_coordinate_maps(),
+                             'square': None,
+                             'squareKey': None}
 
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
-
-        fullSequence = np.ones((len(self.frames),self.monitor.degCorX.shape[0],self.monitor.degCorX.shape[1]),dtype=np.float16) * self.background
-
-        for i, currFrame in enumerate(self.frames):
-            if currFrame[0] == 1: # not a gap
-                if i == 0: # first frame and (not a gap)
-                    currDisplayMatrix = get_warped_square(corX, corY, center = currFrame[1], width=self.probeSize[0],
-                                                          height=self.probeSize[1], ori=self.probeOrientation,
-                                                          foregroundColor=currFrame[2], backgroundColor=self.background)
-                else: # (not first frame) and (not a gap)
-                    if self.frames[i-1][1] is None: # (not first frame) and (not a gap) and (new square from gap)
-                        currDisplayMatrix = get_warped_square(corX, corY, center = currFrame[1], width=self.probeSize[0],
-                                                              height=self.probeSize[1], ori=self.probeOrientation,
-                                                              foregroundColor=currFrame[2], backgroundColor=self.background)
-                    elif (currFrame[1]!=self.frames[i-1][1]).any() or (currFrame[2]!=self.frames[i-1][2]):
-                        # (not first frame) and (not a gap) and (new square from old square)
-                        currDisplayMatrix = get_warped_square(corX, corY, center = currFrame[1], width=self.probeSize[0],
-                                                              height=self.probeSize[1], ori=self.probeOrientation,
-                                                              foregroundColor=currFrame[2], backgroundColor=self.background)
-
-                #assign current display matrix to full sequence
-                fullSequence[i] = currDisplayMatrix
-
-            #add sync square for photodiode
-            fullSequence[i, indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax]=currFrame[3]
-
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
-
-        #generate log dictionary
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        SNdict=dict(self.__dict__)
-        SNdict.pop('monitor')
-        SNdict.pop('indicator')
-        fulldictionary={'stimulation':SNdict,
-                        'monitor':mondict,
-                        'indicator':indicatordict}
-
-        return fullSequence, fulldictionary
+    def render_frame(self, i):
+        """
+        render the i-th frame, the square of the previous display frame is reused if it is not changed
+        """
+
+        currFrame = self.frames[i]
+
+        currSequence = self._get_background_frame()
+
+        if currFrame[0] == 1: # not a gap
+            squareKey = (tuple(currFrame[1]), currFrame[2])
+            if squareKey != self._renderCache['squareKey']:
+                corX, corY = self._renderCache['maps']
+                self._renderCache['square'] = get_warped_square(corX, corY, center = currFrame[1],
+                                                                width=self.probeSize[0], height=self.probeSize[1],
+                                                                ori=self.probeOrientation,
+                                                                foregroundColor=currFrame[2],
+                                                                backgroundColor=self.background)
+                self._renderCache['squareKey'] = squareKey
+
+            currSequence[:] = self._renderCache['square']
+
+        #add sync square for photodiode
+        return self._paint_indicator(currSequence, currFrame[3])
 
 
 class DriftingGratingCircle(Stim):
@@ -2581,68 +2747,53 @@ class DriftingGratingCircle(Stim):
 
         return masks
 
-    def generate_movie(self):
-
-
-        self.frames = self.generate_frames()
-        mask_dict = self._generate_circle_mask_dict()
+    def prepare_frames(self):
+        """
+        generate the pseudorandomized frames and the circle masks for display
+        """
 
-        if self.coordinate=='degree':corX=self.monitor.degCorX;corY=self.monitor.degCorY
-        elif self.coordinate=='linear':corX=self.monitor.linCorX;corY=self.monitor.linCorY
-        else:
+        if not (self.coordinate == 'degree' or self.coordinate == 'linear'):
             raise LookupError("self.coordinate should be either 'linear' or 'degree'.")
 
-        indicatorWmin=self.indicator.centerWpixel - (self.indicator.width_pixel / 2)
-        indicatorWmax=self.indicator.centerWpixel + (self.indicator.width_pixel / 2)
-        indicatorHmin=self.indicator.centerHpixel - (self.indicator.height_pixel / 2)
-        indicatorHmax=self.indicator.centerHpixel + (self.indicator.height_pixel / 2)
-
-        mov = np.ones((len(self.frames),corX.shape[0],corX.shape[1]),dtype=np.float16) * self.background
-        background_frame = np.ones(corX.shape,dtype=np.float16) * self.background
-
-        for i, currFrame in enumerate(self.frames):
-
-            if currFrame[0] == 1: # not a gap
-
-                curr_ori = self._get_ori(currFrame[4])
+        self.frames = self.generate_frames()
 
-                curr_grating = get_grating(corX,
-                                           corY,
-                                           ori = curr_ori,
-                                           spatial_freq = currFrame[2],
-                                           center = self.center,
-                                           phase = currFrame[7],
-                                           contrast = currFrame[5])
-                curr_grating = curr_grating * 2. - 1.
+        self._renderCache = {'maskDict': self._generate_circle_mask_dict(),
+                             'background': self._get_background_frame()}
 
-                curr_circle_mask = mask_dict[currFrame[6]]
+    def render_frame(self, i):
+        """
+        render the i-th frame
+        """
 
-                mov[i] = (curr_grating * curr_circle_mask) + (background_frame * (curr_circle_mask * -1. + 1.))
+        currFrame = self.frames[i]
+        background_frame = self._renderCache['background']
 
-            #add sync square for photodiode
-            mov[i, indicatorHmin:indicatorHmax, indicatorWmin:indicatorWmax] = currFrame[-1]
+        if currFrame[0] == 1: # not a gap
 
+            corX, corY = self._get_coordinate_maps()
 
-            if i in range(0, len(self.frames),len(self.frames)/10):
-                print(['Generating numpy sequence: '+str(int(100 * (i+1) / len(self.frames)))+'%'])
+            curr_ori = self._get_ori(currFrame[4])
 
+            curr_grating = get_grating(corX,
+                                       corY,
+                                       ori = curr_ori,
+                                       spatial_freq = currFrame[2],
+                                       center = self.center,
+                                       phase = currFrame[7],
+                                       contrast = currFrame[5])
+            curr_grating = curr_grating * 2. - 1.
 
+            curr_circle_mask = self._renderCache['maskDict'][currFrame[6]]
 
-        #generate log dictionary
-        mondict=dict(self.monitor.__dict__)
-        indicatordict=dict(self.indicator.__dict__)
-        indicatordict.pop('monitor')
-        self_dict=dict(self.__dict__)
-        self_dict.pop('monitor')
-        self_dict.pop('indicator')
-        log={'stimulation':self_dict,
-             'monitor':mondict,
-             'indicator':indicatordict}
+            curr_frame = (curr_grating * curr_circle_mask) + (background_frame * (curr_circle_mask * -1. + 1.))
+        else:
+            curr_frame = background_frame
 
-        return mov, log
+        #add sync square for photodiode
+        return self._paint_indicator(curr_frame, currFrame[-1])
 
 
-class KSstimAllDir(object):
+class KSstimAllDir(Stim):
     """
     generate Kalatsky & Stryker stimulation in all four direction contiuously
     """
@@ -2661,10 +2812,9 @@ class KSstimAllDir(object):
                  preGapDur=2.,
                  postGapDur=3.):
 
-        self.monitor = monitor
-        self.indicator = indicator
-        self.background = background
-        self.coordinate = coordinate
+        super(KSstimAllDir,self).__init__(monitor=monitor,indicator=indicator,background=background,coordinate=coordinate,preGapDur=preGapDur,postGapDur=postGapDur)
+
+        self.stimName = 'KSstimAllDir'
         self.squareSize = squareSize
         self.squareCenter = squareCenter
         self.flickerFrame = flickerFrame
@@ -2672,78 +2822,108 @@ class KSstimAllDir(object):
         self.stepWidth = stepWidth
         self.sweepFrame = sweepFrame
         self.iteration = iteration
-        self.preGapDur = preGapDur
-        self.postGapDur = postGapDur
 
 
-    def generate_movie(self):
+    def _generate_stims(self):
+        """
+        generate one KSstim object for each of the four directions
+        """
 
-        KS_stim=KSstim(self.monitor,
-                       self.indicator,
-                       background=self.background,
-                       coordinate=self.coordinate,
-                       direction='B2U',
-                       squareSize=self.squareSize,
-                       squareCenter=self.squareCenter,
-                       flickerFrame=self.flickerFrame,
-                       sweepWidth=self.sweepWidth,
-                       stepWidth=self.stepWidth,
-                       sweepFrame=self.sweepFrame,
-                       iteration=self.iteration,
-                       preGapDur=self.preGapDur,
-                       postGapDur=self.postGapDur)
-
-        movB2U, dictB2U = KS_stim.generate_movie()
-        KS_stim.set_direction('U2B')
-        movU2B, dictU2B = KS_stim.generate_movie()
-        KS_stim.set_direction('L2R')
-        movL2R, dictL2R = KS_stim.generate_movie()
-        KS_stim.set_direction('R2L')
-        movR2L, dictR2L = KS_stim.generate_movie()
-
-        mov = np.vstack((movB2U,movU2B,movL2R,movR2L))
-        log = {'monitor':dictB2U['monitor'],
-               'indicator':dictB2U['indicator']}
-        stimulation = dict(dictB2U['stimulation'])
-        stimulation['stimName'] = 'KSstimAllDir'
-        stimulation['direction'] = ['B2U','U2B','L2R','R2L']
+        stims = []
+        for direction in ['B2U','U2B','L2R','R2L']:
+            stim = KSstim(self.monitor,
+                          self.indicator,
+                          background=self.background,
+                          coordinate=self.coordinate,
+                          direction=direction,
+                          squareSize=self.squareSize,
+                          squareCenter=self.squareCenter,
+                          flickerFrame=self.flickerFrame,
+                          sweepWidth=self.sweepWidth,
+                          stepWidth=self.stepWidth,
+                          sweepFrame=self.sweepFrame,
+                          iteration=self.iteration,
+                          preGapDur=self.preGapDur,
+                          postGapDur=self.postGapDur)
+            stims.append(stim)
+
+        return stims
+
+    def prepare_frames(self):
+        """
+        generate the frames of all four directions, each frame is rendered by the KSstim object of its direction
+
+        for each frame, the direction is appended to the frame of KSstim and the sweep index points to the combined
+        sweep table of all directions
+        """
+
+        stims = self._generate_stims()
 
-        sweepTable = []
         frames = []
+        sweepTable = []
+        frameStarts = []
+
+        for stim in stims:
+            stim.prepare_frames()
+
+            sweepStart = len(sweepTable)
+            frameStarts.append(len(frames))
 
-        sweepTableB2U = dictB2U['stimulation']['sweepTable']; framesB2U = dictB2U['stimulation']['frames']; sweepLenB2U = len(sweepTableB2U)
-        sweepTableB2U = [ ['B2U', x[1], x[2]] for x in sweepTableB2U]; framesB2U = [[x[0],x[1],x[2],x[3],'B2U'] for x in framesB2U]
-        sweepTable += sweepTableB2U; frames += framesB2U
+            for x in stim.frames:
+                sweepIndex = x[2]
+                if sweepIndex is not None: sweepIndex += sweepStart
+                frames.append((x[0], x[1], sweepIndex, x[3], stim.direction))
 
-        sweepTableU2B = dictU2B['stimulation']['sweepTable']; framesU2B = dictU2B['stimulation']['frames']; sweepLenU2B = len(sweepTableU2B)
-        sweepTableU2B = [ ['U2B', x[1], x[2]] for x in sweepTableU2B]; framesU2B = [[x[0],x[1],x[2],x[3],'U2B'] for x in framesU2B]
-        for frame in framesU2B:
-            if frame[2] is not None: frame[2] += sweepLenB2U
-        sweepTable += sweepTableU2B; frames += framesU2B
+            sweepTable += [(stim.direction, x[1], x[2]) for x in stim.sweepTable]
 
-        sweepTableL2R = dictL2R['stimulation']['sweepTable']; framesL2R = dictL2R['stimulation']['frames']; sweepLenL2R = len(sweepTableL2R)
-        sweepTableL2R = [ ['L2R', x[1], x[2]] for x in sweepTableL2R]; framesL2R = [[x[0],x[1],x[2],x[3],'L2R'] for x in framesL2R]
-        for frame in framesL2R:
-            if frame[2] is not None: frame[2] += sweepLenB2U+sweepLenU2B
-        sweepTable += sweepTableL2R; frames += framesL2R
+        self.frames = frames
+        self.sweepTable = sweepTable
 
-        sweepTableR2L = dictR2L['stimulation']['sweepTable']; framesR2L = dictR2L['stimulation']['frames']
-        sweepTableR2L = [ ['R2L', x[1], x[2]] for x in sweepTableR2L]; framesR2L = [[x[0],x[1],x[2],x[3],'R2L'] for x in framesR2L]
-        for frame in framesR2L:
-            if frame[2] is not None: frame[2] += sweepLenB2U+sweepLenU2B+sweepLenL2R
-        sweepTable += sweepTableR2L; frames += framesR2L
+        self._renderCache = {'stims': stims, 'frameStarts': frameStarts}
 
-        stimulation['frames'] = [tuple(x) for x in frames]
-        stimulation['sweepTable'] = [tuple(x) for x in sweepTable]
+    def render_frame(self, i):
+        """
+        render the i-th frame by the KSstim object of its direction
+        """
+
+        stimInd = np.searchsorted(self._renderCache['frameStarts'], i, side='right') - 1
+        frameStart = self._renderCache['frameStarts'][stimInd]
+
+        return self._renderCache['stims'][stimInd].render_frame(i - frameStart)
+
+    def get_frame_key(self, i):
+        """
+        key of the i-th frame given by the KSstim object of its direction
+        """
 
+        stimInd = np.searchsorted(self._renderCache['frameStarts'], i, side='right') - 1
+        frameStart = self._renderCache['frameStarts'][stimInd]
+
+        return stimInd, self._renderCache['stims'][stimInd].get_frame_key(i - frameStart)
+
+    def generate_log(self):
+        """
+        generate the log dictionary of the stimulus from the log of the first direction, should be called after
+        self.prepare_frames
+        """
+
+        firstLog = self._renderCache['stims'][0].generate_log()
+
+        log = {'monitor':firstLog['monitor'],
+               'indicator':firstLog['indicator']}
+        stimulation = dict(firstLog['stimulation'])
+        stimulation['stimName'] = 'KSstimAllDir'
+        stimulation['direction'] = ['B2U','U2B','L2R','R2L']
+        stimulation['frames'] = list(self.frames)
+        stimulation['sweepTable'] = list(self.sweepTable)
+        stimulation['frameConfig'] = ('isDisplay', 'squarePolarity', 'sweepIndex', 'indicatorColor')
+        stimulation['sweepConfig'] = ('orientation', 'sweepStartCoordinate', 'sweepEndCoordinate')
         log['stimulation'] = stimulation
-        log['stimulation']['frameConfig'] = ('isDisplay', 'squarePolarity', 'sweepIndex', 'indicatorColor')
-        log['stimulation']['sweepConfig'] = ('orientation', 'sweepStartCoordinate', 'sweepEndCoordinate')
 
-        return mov, log
+        return log
 
 
-class ObliqueKSstimAllDir(object):
+class ObliqueKSstimAllDir(Stim):
     """
     generate Kalatsky & Stryker stimulation in all four direction contiuously
     """
@@ -2763,10 +2943,9 @@ class ObliqueKSstimAllDir(object):
                  postGapDur=3.,
                  rotation_angle=np.pi/4):
 
-        self.monitor = monitor
-        self.indicator = indicator
-        self.background = background
-        self.coordinate = coordinate
+        super(ObliqueKSstimAllDir,self).__init__(monitor=monitor,indicator=indicator,background=background,coordinate=coordinate,preGapDur=preGapDur,postGapDur=postGapDur)
+
+        self.stimName = 'ObliqueKSstimAllDir'
         self.squareSize = squareSize
         self.squareCenter = squareCenter
         self.flickerFrame = flickerFrame
@@ -2774,80 +2953,184 @@ class ObliqueKSstimAllDir(object):
         self.stepWidth = stepWidth
         self.sweepFrame = sweepFrame
         self.iteration = iteration
-        self.preGapDur = preGapDur
-        self.postGapDur = postGapDur
         self.rotation_angle = rotation_angle
 
 
-    def generate_movie(self):
+    def _generate_stims(self):
+        """
+        generate one ObliqueKSstim object for each of the four directions
+        """
 
-        KS_stim=ObliqueKSstim(self.monitor,
-                              self.indicator,
-                              background=self.background,
-                              coordinate=self.coordinate,
-                              direction='B2U',
-                              squareSize=self.squareSize,
-                              squareCenter=self.squareCenter,
-                              flickerFrame=self.flickerFrame,
-                              sweepWidth=self.sweepWidth,
-                              stepWidth=self.stepWidth,
-                              sweepFrame=self.sweepFrame,
-                              iteration=self.iteration,
-                              preGapDur=self.preGapDur,
-                              postGapDur=self.postGapDur,
-                              rotation_angle=self.rotation_angle)
-
-        movB2U, dictB2U = KS_stim.generate_movie()
-        KS_stim.set_direction('U2B')
-        movU2B, dictU2B = KS_stim.generate_movie()
-        KS_stim.set_direction('L2R')
-        movL2R, dictL2R = KS_stim.generate_movie()
-        KS_stim.set_direction('R2L')
-        movR2L, dictR2L = KS_stim.generate_movie()
-
-        mov = np.vstack((movB2U,movU2B,movL2R,movR2L))
-        log = {'monitor':dictB2U['monitor'],
-               'indicator':dictB2U['indicator']}
-        stimulation = dict(dictB2U['stimulation'])
-        stimulation['stimName'] = 'ObliqueKSstimAllDir'
-        stimulation['direction'] = ['B2U','U2B','L2R','R2L']
+        stims = []
+        for direction in ['B2U','U2B','L2R','R2L']:
+            stim = ObliqueKSstim(self.monitor,
+                                 self.indicator,
+                                 background=self.background,
+                                 coordinate=self.coordinate,
+                                 direction=direction,
+                                 squareSize=self.squareSize,
+                                 squareCenter=self.squareCenter,
+                                 flickerFrame=self.flickerFrame,
+                                 sweepWidth=self.sweepWidth,
+                                 stepWidth=self.stepWidth,
+                                 sweepFrame=self.sweepFrame,
+                                 iteration=self.iteration,
+                                 preGapDur=self.preGapDur,
+                                 postGapDur=self.postGapDur,
+                                 rotation_angle=self.rotation_angle)
+            stims.append(stim)
+
+        return stims
+
+    def prepare_frames(self):
+        """
+        generate the frames of all four directions, each frame is rendered by the ObliqueKSstim object of its direction
+
+        for each frame, the direction is appended to the frame of ObliqueKSstim and the sweep index points to the combined
+        sweep table of all directions
+        """
+
+        stims = self._generate_stims()
 
-        sweepTable = []
         frames = []
+        sweepTable = []
+        frameStarts = []
+
+        for stim in stims:
+            stim.prepare_frames()
+
+            sweepStart = len(sweepTable)
+            frameStarts.append(len(frames))
+
+            for x in stim.frames:
+                sweepIndex = x[2]
+                if sweepIndex is not None: sweepIndex += sweepStart
+                frames.append((x[0], x[1], sweepIndex, x[3], stim.direction))
 
-        sweepTableB2U = dictB2U['stimulation']['sweepTable']; framesB2U = dictB2U['stimulation']['frames']; sweepLenB2U = len(sweepTableB2U)
-        sweepTableB2U = [ ['B2U', x[1], x[2]] for x in sweepTableB2U]; framesB2U = [[x[0],x[1],x[2],x[3],'B2U'] for x in framesB2U]
-        sweepTable += sweepTableB2U; frames += framesB2U
+            sweepTable += [(stim.direction, x[1], x[2]) for x in stim.sweepTable]
 
-        sweepTableU2B = dictU2B['stimulation']['sweepTable']; framesU2B = dictU2B['stimulation']['frames']; sweepLenU2B = len(sweepTableU2B)
-        sweepTableU2B = [ ['U2B', x[1], x[2]] for x in sweepTableU2B]; framesU2B = [[x[0],x[1],x[2],x[3],'U2B'] for x in framesU2B]
-        for frame in framesU2B:
-            if frame[2] is not None: frame[2] += sweepLenB2U
-        sweepTable += sweepTableU2B; frames += framesU2B
+        self.frames = frames
+        self.sweepTable = sweepTable
 
-        sweepTableL2R = dictL2R['stimulation']['sweepTable']; framesL2R = dictL2R['stimulation']['frames']; sweepLenL2R = len(sweepTableL2R)
-        sweepTableL2R = [ ['L2R', x[1], x[2]] for x in sweepTableL2R]; framesL2R = [[x[0],x[1],x[2],x[3],'L2R'] for x in framesL2R]
-        for frame in framesL2R:
-            if frame[2] is not None: frame[2] += sweepLenB2U+sweepLenU2B
-        sweepTable += sweepTableL2R; frames += framesL2R
+        self._renderCache = {'stims': stims, 'frameStarts': frameStarts}
+
+    def render_frame(self, i):
+        """
+        render the i-th frame by the ObliqueKSstim object of its direction
+        """
 
-        sweepTableR2L = dictR2L['stimulation']['sweepTable']; framesR2L = dictR2L['stimulation']['frames']
-        sweepTableR2L = [ ['R2L', x[1], x[2]] for x in sweepTableR2L]; framesR2L = [[x[0],x[1],x[2],x[3],'R2L'] for x in framesR2L]
-        for frame in framesR2L:
-            if frame[2] is not None: frame[2] += sweepLenB2U+sweepLenU2B+sweepLenL2R
-        sweepTable += sweepTableR2L; frames += framesR2L
+        stimInd = np.searchsorted(self._renderCache['frameStarts'], i, side='right') - 1
+        frameStart = self._renderCache['frameStarts'][stimInd]
 
-        stimulation['frames'] = [tuple(x) for x in frames]
-        stimulation['sweepTable'] = [tuple(x) for x in sweepTable]
+        return self._renderCache['stims'][stimInd].render_frame(i - frameStart)
 
+    def get_frame_key(self, i):
+        """
+        key of the i-th frame given by the ObliqueKSstim object of its direction
+        """
+
+        stimInd = np.searchsorted(self._renderCache['frameStarts'], i, side='right') - 1
+        frameStart = self._renderCache['frameStarts'][stimInd]
+
+        return stimInd, self._renderCache['stims'][stimInd].get_frame_key(i - frameStart)
+
+    def generate_log(self):
+        """
+        generate the log dictionary of the stimulus from the log of the first direction, should be called after
+        self.prepare_frames
+        """
+
+        firstLog = self._renderCache['stims'][0].generate_log()
+
+        log = {'monitor':firstLog['monitor'],
+               'indicator':firstLog['indicator']}
+        stimulation = dict(firstLog['stimulation'])
+        stimulation['stimName'] = 'ObliqueKSstimAllDir'
+        stimulation['direction'] = ['B2U','U2B','L2R','R2L']
+        stimulation['frames'] = list(self.frames)
+        stimulation['sweepTable'] = list(self.sweepTable)
         log['stimulation'] = stimulation
 
-        return mov, log
+        return log
+
+
+class FrameBuffer(object):
+    """
+    render frames of a stimulus in a background thread ahead of display, at most bufferSize rendered frames are kept in
+    memory at any time
+    """
+
+    def __init__(self, stim, frameIndices, bufferSize=60):
+        """
+        :param stim: stimulus object with methods render_frame(i) and get_frame_key(i), frames should be prepared
+                     already
+        :param frameIndices: iterable of the indices of frames to be rendered, in the order of display
+        :param bufferSize: maximum number of rendered frames waiting for display
+        """
+
+        if bufferSize < 1: raise ValueError('bufferSize should be a positive integer!')
+
+        self._queue = queue.Queue(maxsize=int(bufferSize))
+        self._stopEvent = threading.Event()
+        self._thread = threading.Thread(target=self._render, args=(stim, frameIndices))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        """
+        put item into the buffer, wait while the buffer is full, return False if stopped
+        """
+        while not self._stopEvent.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _render(self, stim, frameIndices):
+        """
+        render frames in order, consecutive frames with the same key (see Stim.get_frame_key) are rendered only once
+        """
+        try:
+            frame = None
+            lastFrameKey = None
+            for frameInd in frameIndices:
+                frameKey = stim.get_frame_key(frameInd)
+                if frame is None or frameKey != lastFrameKey:
+                    frame = stim.render_frame(frameInd)
+                    lastFrameKey = frameKey
+                if not self._put(frame): return
+        except Exception as e:
+            self._put(e)
+
+    def wait_until_filled(self):
+        """
+        block until the buffer is full or all frames are rendered
+        """
+        while self._thread.is_alive() and not self._queue.full():
+            time.sleep(0.01)
+
+    def get(self):
+        """
+        :return: next rendered frame, blocks if it is not rendered yet
+        """
+        frame = self._queue.get()
+        if isinstance(frame, Exception): raise frame
+        return frame
+
+    def close(self):
+        """
+        stop rendering and release rendered frames
+        """
+        self._stopEvent.set()
+        self._thread.join()
+        while not self._queue.empty(): self._queue.get()
 
 
 class DisplaySequence(object):
     """
-    Display the numpy sequence from memory
+    Display the numpy sequence from memory, or render the frames of a stimulus on demand during display
     """
 
     def __init__(self,
@@ -2882,9 +3165,14 @@ class DisplaySequence(object):
                  displayControlPort=10002,
                  fileNumNIDev='Dev1',
                  fileNumNIPort='0',
-                 fileNumNILines='0:7'):
+                 fileNumNILines='0:7',
+                 isSaveFrameBank=False):  # if True, always save the unique frames of the stimulus into the log
 
         self.sequence = None
+        self.sequenceIndices = None
+        self.stim = None
+        self.bufferSize = None
+        self.isStimRebuildable = None
         self.sequenceLog = {}
         self.psychopyMonitor = psychopyMonitor
         self.remoteSyncSaveWaitTime = remoteSyncSaveWaitTime
@@ -2913,6 +3201,7 @@ class DisplaySequence(object):
         self.fileNumNIDev = fileNumNIDev
         self.fileNumNIPort = fileNumNIPort
         self.fileNumNILines = fileNumNILines
+        self.isSaveFrameBank = isSaveFrameBank
 
         try:
             self._remote_obj = RemoteObject(rep_port=self.displayControlPort)
@@ -2961,6 +3250,10 @@ class DisplaySequence(object):
         Vrange = (Vmax-Vmin)
         anyArrayNor = ((anyArray-Vmin)/Vrange).astype(np.float16)
         self.sequence = 2*(anyArrayNor-0.5)
+        self.sequenceIndices = None
+        self.stim = None
+        self.bufferSize = None
+        self.isStimRebuildable = None
 
         if logDict != None:
             if type(logDict) is dict:
@@ -2972,14 +3265,52 @@ class DisplaySequence(object):
         self.clear()
 
 
-    def set_stim(self, stim):
+    def set_stim(self, stim, isLazy=False, bufferSize=60):
         """
         to display defined stim object
-        """
-        self.sequence, self.sequenceLog = stim.generate_movie()
+
+        :param stim: stimulus object
+        :param isLazy: bool, if False, the unique frames of the stimulus are generated in memory before display
+                       (self.sequence) together with the index of the unique frame for each frame
+                       (self.sequenceIndices), see stim.generate_movie_by_index. if True, only the frame information is
+                       generated and each frame is rendered on demand during display by stim.render_frame, so that the
+                       memory usage does not depend on the stimulus duration, only for stimuli that can be rebuilt
+                       from the log (see stim.is_rebuildable)
+        :param bufferSize: only for lazy display, maximum number of frames rendered ahead of display
+        """
+        if isLazy and not stim.is_rebuildable():
+            raise ValueError('The frames of ' + str(stim.__class__.__name__) + ' can not be rebuilt from the log, so '
+                             'they can not be displayed lazily. Set isLazy=False to save them into the log.')
+        self.isStimRebuildable = stim.is_rebuildable()
+
+        if isLazy:
+            stim.prepare_frames()
+            self.sequence = None
+            self.sequenceIndices = None
+            self.stim = stim
+            self.bufferSize = bufferSize
+            self.sequenceLog = stim.generate_log()
+        else:
+            self.sequence, self.sequenceIndices, self.sequenceLog = stim.generate_movie_by_index()
+            self.stim = None
+            self.bufferSize = None
         self.clear()
 
 
+    def _get_sequence_frame_num(self):
+        """
+        :return: number of frames in a single run of the sequence, None if no sequence is set
+        """
+        if self.sequenceIndices is not None:
+            return len(self.sequenceIndices)
+        elif self.sequence is not None:
+            return self.sequence.shape[0]
+        elif self.stim is not None:
+            return self.stim.get_frame_num()
+        else:
+            return None
+
+
     def trigger_display(self):
 
 
@@ -2995,7 +3326,7 @@ class DisplaySequence(object):
             refreshRate = 60.
 
         #prepare display frames log
-        if self.sequence is None:
+        if self.sequence is None and self.stim is None:
             raise LookupError("Please set the sequence to be displayed!!\n")
         try:
             sequenceFrames = self.sequenceLog['stimulation']['frames']
@@ -3010,7 +3341,7 @@ class DisplaySequence(object):
             self.displayFrames = None
 
         # calculate expected display time
-        displayTime = float(self.sequence.shape[0]) * self.displayIteration / refreshRate
+        displayTime = float(self._get_sequence_frame_num()) * self.displayIteration / refreshRate
         print('\n Expected display time: ', displayTime, ' seconds\n')
 
         # generate file name
@@ -3255,10 +3586,19 @@ class DisplaySequence(object):
     def _display(self, window, stim):
 
 
+        singleRunFrames = self._get_sequence_frame_num()
+
+        # render frames of the stimulus ahead of display
+        if self.sequence is None:
+            frameBuffer = FrameBuffer(self.stim, self._get_display_frame_indices(singleRunFrames),
+                                      bufferSize=self.bufferSize)
+            frameBuffer.wait_until_filled()
+        else:
+            frameBuffer = None
+
         # display frames
         timeStamp=[]
         startTime = time.clock()
-        singleRunFrames = self.sequence.shape[0]
 
         if self.isSyncPulse:
             syncPulseTask = iodaq.DigitalOutput(self.syncPulseNIDev, self.syncPulseNIPort, self.syncPulseNILine)
@@ -3269,12 +3609,18 @@ class DisplaySequence(object):
 
         while self.keepDisplay and i < (singleRunFrames * self.displayIteration):
 
-            if self.displayOrder == 1:frameNum = i % singleRunFrames
+            if frameBuffer is None:
+                if self.displayOrder == 1:frameNum = i % singleRunFrames
 
-            if self.displayOrder == -1:frameNum = singleRunFrames - (i % singleRunFrames) -1
+                if self.displayOrder == -1:frameNum = singleRunFrames - (i % singleRunFrames) -1
+
+                if self.sequenceIndices is None: currFrame = self.sequence[frameNum]
+                else: currFrame = self.sequence[self.sequenceIndices[frameNum]]
+            else:
+                currFrame = frameBuffer.get()
 
             # currFrame=Image.fromarray(self.sequence[frameNum]) # removed PIL dependency
-            stim.setImage(self.sequence[frameNum][::-1,:])
+            stim.setImage(currFrame[::-1,:])
             stim.draw()
             timeStamp.append(time.clock()-startTime)
 
@@ -3294,6 +3640,8 @@ class DisplaySequence(object):
         stopTime = time.clock()
         window.close()
 
+        if frameBuffer is not None: frameBuffer.close()
+
         if self.isSyncPulse:syncPulseTask.StopTask()
 
         self.timeStamp = np.array(timeStamp)
@@ -3305,6 +3653,15 @@ class DisplaySequence(object):
         if self.keepDisplay == True: print('\nDisplay successfully completed.')
 
 
+    def _get_display_frame_indices(self, singleRunFrames):
+        """
+        generator of the indices of frames in the order of display, for all display iterations
+        """
+        for i in range(singleRunFrames * self.displayIteration):
+            if self.displayOrder == -1: yield singleRunFrames - (i % singleRunFrames) - 1
+            else: yield i % singleRunFrames
+
+
     def flag_to_close(self):
         self.keepDisplay = False
 
@@ -3367,7 +3724,13 @@ class DisplaySequence(object):
             displayLog.pop("_remote_obj")
         displayLog.pop('sequenceLog')
         displayLog.pop('displayControlSock')
-        displayLog.pop('sequence')
+        # the unique frames (self.sequence) are saved only if self.isSaveFrameBank is True or if they can not be
+        # rebuilt from the stimulus log (see stim.is_rebuildable), otherwise only the index of the unique frame for
+        # each frame is saved, the frames can be rebuilt from stimulation['frames'] by stim.prepare_frames and
+        # stim.render_frame, random noise stimuli log the seeds of their noise movies
+        isSaveFrameBank = self.isSaveFrameBank or (self.isStimRebuildable is False)
+        if not (isSaveFrameBank and self.sequenceIndices is not None): displayLog.pop('sequence')
+        displayLog.pop('stim')
         if hasattr(self, 'remoteSync'):
             displayLog.pop("remoteSync")
         logFile.update({'presentation':displayLog})
@@ -5,6 +5,8 @@ import pickle
 import os
 import shutil
 import struct
+import threading
+import queue
 from . import ImageAnalysis as ia
 from . import tifffile as tf
 import h5py
@@ -671,6 +673,108 @@ def write_dictionary_to_h5group_recursively(target, source, is_overwrite=True):
         raise TypeError('target: "' + target.name + '" should be either h5py.Dataset or h5py.Group classes.')
 
 
+def get_available_memory():
+    """
+    :return: int, available physical memory in bytes, None if it can not be determined
+    """
+    try:
+        import psutil
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        pass
+
+    try:
+        return int(os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class ChunkReader(object):
+    """
+    iterate through chunks of a 3-d array_like object (hdf5 dataset, BinarySlicer object, np.array, etc) along the
+    first axis. a background thread keeps reading the following chunks into a bounded queue while the current chunk is
+    being processed, so that disk reading overlaps with computation.
+
+    usage:
+        for chunk_start, chunk_end, chunk in ChunkReader(array_like, chunk_length=1000):
+            ...
+    """
+
+    def __init__(self, array_like, chunk_length=1000, dtype=None, prefetch_num=2, spatial_slice=None):
+        """
+        :param array_like: 3-d, array_like object (hdf5 dataset, BinarySlicer object, np.array, etc), dimension (zyx)
+        :param chunk_length: int, the number of frames of each chunk
+        :param dtype: if not None, each chunk will be converted to this data type in the reading thread
+        :param prefetch_num: int, maximum number of chunks read ahead and waiting in the queue
+        :param spatial_slice: tuple of slice objects for the remaining axes (for example, a bounding box), if None,
+                              whole frames will be read
+        """
+
+        if chunk_length < 1: raise ValueError('chunk_length should be a positive integer!')
+        if prefetch_num < 1: raise ValueError('prefetch_num should be a positive integer!')
+
+        self.array_like = array_like
+        self.chunk_length = int(chunk_length)
+        self.dtype = dtype
+        self.prefetch_num = int(prefetch_num)
+        if spatial_slice is None: self.spatial_slice = ()
+        else: self.spatial_slice = tuple(spatial_slice)
+
+        self.frame_num = array_like.shape[0]
+
+    def __len__(self):
+        return len(self.get_chunk_ranges())
+
+    def get_chunk_ranges(self):
+        """
+        :return: list of (chunk_start, chunk_end)
+        """
+        return [(chunk_start, min(chunk_start + self.chunk_length, self.frame_num))
+                for chunk_start in range(0, self.frame_num, self.chunk_length)]
+
+    def read_chunk(self, chunk_start, chunk_end):
+        chunk = np.asarray(self.array_like[(slice(chunk_start, chunk_end),) + self.spatial_slice])
+        if self.dtype is not None: chunk = chunk.astype(self.dtype)
+        return chunk
+
+    @staticmethod
+    def _put(chunk_queue, stop_event, item):
+        while not stop_event.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_all(self, chunk_queue, stop_event):
+        try:
+            for chunk_start, chunk_end in self.get_chunk_ranges():
+                if not self._put(chunk_queue, stop_event, (chunk_start, chunk_end,
+                                                           self.read_chunk(chunk_start, chunk_end))):
+                    return
+        except Exception as e:
+            self._put(chunk_queue, stop_event, e)
+            return
+        self._put(chunk_queue, stop_event, None)
+
+    def __iter__(self):
+        chunk_queue = queue.Queue(maxsize=self.prefetch_num)
+        stop_event = threading.Event()
+        reader = threading.Thread(target=self._read_all, args=(chunk_queue, stop_event))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            while True:
+                item = chunk_queue.get()
+                if item is None: break
+                if isinstance(item, Exception): raise item
+                yield item
+        finally:
+            stop_event.set()
+            reader.join()
+
 
 if __name__=='__main__':
 
@@ -7,14 +7,20 @@ import numpy as np
 from scipy import interpolate
 import scipy.ndimage as ni
 import scipy.stats as stats
+import scipy.sparse as sparse
 import skimage.morphology as sm
 from . import FileTools as ft
 from . import PlottingTools as pt
+import os
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 try: import cv2
-except ImportError as e: print(e)
+except ImportError as e: print(e); cv2 = None
 try: from toolbox.misc import BinarySlicer
 except ImportError as e: print(e)
+try: import scipy.fft as fftpack # keeps single precision
+except ImportError: fftpack = np.fft
 
 
 def resample(t1,y1,interval,kind='linear', isPlot = False):
@@ -387,6 +393,116 @@ def rigid_transform(img, zoom=None, rotation=None, offset=None, outputShape=None
     return newImg.astype(img.dtype)
 
 
+def _get_rigid_transform_plan(frameShape, zoom=None, rotation=None, offset=None, outputShape=None):
+    '''
+    precompute the geometry of the rigid transformation (see rigid_transform_cv2_2d) of frames with shape frameShape
+
+    :return: dictionary of the shape after zooming (height, width), the expanding and rotation matrices and the size
+             of expanded image, if the image is moved, and the final shape (height, width)
+    '''
+
+    height, width = int(frameShape[0]), int(frameShape[1])
+    plan = {'zoomShape': None, 'expandMatrix': None, 'rotationMatrix': None, 'expandSize': None, 'isMove': False}
+
+    if zoom is not None:
+        try: zoomH = float(zoom[0]); zoomW = float(zoom[1])
+        except TypeError: zoomH = float(zoom); zoomW = float(zoom)
+        height = int(height * zoomH); width = int(width * zoomW)
+        plan['zoomShape'] = (height, width)
+
+    if rotation:
+        diagonal = int(np.sqrt(height ** 2 + width ** 2))
+        plan['expandMatrix'] = np.float32([[1, 0, (diagonal - width) / 2], [0, 1, (diagonal - height) / 2]])
+        plan['expandSize'] = diagonal
+        height = width = diagonal
+
+        # same as cv2.getRotationMatrix2D((width / 2, height / 2), rotation, 1)
+        alpha = np.cos(rotation * np.pi / 180.); beta = np.sin(rotation * np.pi / 180.)
+        centerX = width / 2; centerY = height / 2
+        plan['rotationMatrix'] = np.array([[alpha, beta, (1 - alpha) * centerX - beta * centerY],
+                                           [-beta, alpha, beta * centerX + (1 - alpha) * centerY]])
+
+    if (outputShape is not None) or (offset is not None):
+        plan['isMove'] = True
+        if outputShape is not None: height, width = int(outputShape[0]), int(outputShape[1])
+
+    plan['outputShape'] = (height, width)
+
+    return plan
+
+
+def _warp_affine(img, M, dsize, borderValue=0.):
+    '''
+    cv2.warpAffine with linear interpolation, falls back to scipy.ndimage.affine_transform if opencv is not available
+
+    :param M: 2 x 3 affine matrix mapping source (x, y) to destination (x, y)
+    :param dsize: (width, height) of output image
+    '''
+
+    if cv2 is not None: return cv2.warpAffine(img, M, dsize, borderValue=borderValue)
+
+    M = np.array(M, dtype=np.float64)
+    invM = np.linalg.inv(M[:, 0:2])
+    # convert from (x, y) to (row, col)
+    matrix = invM[::-1, ::-1]
+    shift = -invM.dot(M[:, 2])[::-1]
+    return ni.affine_transform(img, matrix, offset=shift, output_shape=(dsize[1], dsize[0]), order=1,
+                               mode='constant', cval=borderValue)
+
+
+def _resize_cubic(img, shape):
+    '''
+    cv2.resize with cubic interpolation, falls back to scipy.ndimage.affine_transform if opencv is not available
+
+    :param shape: (height, width) of output image
+    '''
+
+    if cv2 is not None: return cv2.resize(img, dsize=(shape[1], shape[0]), interpolation=cv2.INTER_CUBIC)
+
+    scale = np.array([float(img.shape[0]) / shape[0], float(img.shape[1]) / shape[1]])
+    return ni.affine_transform(img, scale, offset=0.5 * scale - 0.5, output_shape=shape, order=3, mode='nearest')
+
+
+def _rigid_transform_frame(img, plan, offset=None):
+    '''
+    rigid transformation of a 2d-image with a plan generated by _get_rigid_transform_plan, returns float64 image
+    '''
+
+    newImg = np.array(img).astype(np.float64)
+    minValue = np.amin(newImg)
+
+    if plan['zoomShape'] is not None:
+        newImg = _resize_cubic(newImg, plan['zoomShape'])
+
+    if plan['rotationMatrix'] is not None:
+        expandSize = plan['expandSize']
+        newImg = _warp_affine(newImg.astype(np.float32), plan['expandMatrix'], (expandSize, expandSize))
+        newImg = _warp_affine(newImg.astype(np.float64), plan['rotationMatrix'], (expandSize, expandSize),
+                              borderValue=minValue)
+
+    if plan['isMove']:
+        if offset is None: offset = (0, 0)
+        M = np.float32([[1, 0, offset[0]], [0, 1, offset[1]]])
+        newImg = _warp_affine(newImg, M, (plan['outputShape'][1], plan['outputShape'][0]), borderValue=minValue)
+
+    return newImg
+
+
+def _rigid_transform_chunk(chunk, plan, dtype, offset=None, offsets=None):
+    '''
+    rigid transformation of every frame of a 3d chunk with a plan generated by _get_rigid_transform_plan
+
+    :param offset: None or (xoffset, yoffset), offset of all frames
+    :param offsets: None or 2d array, frameNum x 2, offset of each frame in the chunk, overrides offset
+    '''
+
+    newChunk = np.empty((chunk.shape[0], plan['outputShape'][0], plan['outputShape'][1]), dtype=dtype)
+    for i in range(chunk.shape[0]):
+        if offsets is not None: offset = offsets[i]
+        newChunk[i] = _rigid_transform_frame(chunk[i], plan, offset=offset)
+    return newChunk
+
+
 def rigid_transform_cv2_2d(img, zoom=None, rotation=None, offset=None, outputShape=None):
 
     '''
@@ -402,56 +518,79 @@ def rigid_transform_cv2_2d(img, zoom=None, rotation=None, offset=None, outputSha
     if len(img.shape) != 2:
         raise LookupError('Input image is not a 2d or 3d array!')
 
-    newImg = np.array(img).astype(np.float)
-    minValue = np.amin(newImg)
+    plan = _get_rigid_transform_plan(img.shape, zoom=zoom, rotation=rotation, offset=offset, outputShape=outputShape)
+    newImg = _rigid_transform_frame(img, plan, offset=offset)
 
-    if zoom is not None:
-        newImg = zoom_image(img, zoom=zoom)
+    if plan['isMove']: return newImg.astype(img.dtype)
+    else: return newImg
 
-    if rotation:
-        newImg = expand_image_cv2(newImg)
-        newImg = rotate_image(newImg, rotation, borderValue=minValue)
 
-    if (outputShape is None) and (offset is None):
-        return newImg
-    else:
-        if outputShape is None:
-            outputShape = newImg.shape
-        if offset is None:
-            offset = (0,0)
-        newImg = moveImage(newImg, offset[0], offset[1], outputShape[1],outputShape[0],borderValue=minValue)
+def rigid_transform_cv2_3d(img, zoom=None, rotation=None, offset=None, outputShape=None, output=None,
+                           chunkLength=100, threadNum=None):
+    '''
+    rigid transformation of every frame of a 3d-matrix by using opencv. the geometry of the transformation is computed
+    once and chunks of frames are transformed in parallel by a pool of threads (opencv releases the GIL while warping).
+    if opencv is not available, frames are transformed by scipy.ndimage instead
+    :param img: input matrix, 3d array_like, frame x row x col
+    :param zoom:
+    :param rotation: in degree, counterclock wise
+    :param offset: tuple (xoffset, yoffset) pixel value of starting point of output image, or 2d array, frameNum x 2,
+                   (xoffset, yoffset) of each frame
+    :param outputShape: the shape of output image, (height, width)
+    :param output: preallocated output, 3d array_like (np.ndarray, np.memmap, hdf5 dataset, etc.), if None a new
+                   array with the dtype of img will be created
+    :param chunkLength: positive int, number of frames transformed by one thread at a time
+    :param threadNum: positive int, number of threads, if None, the number of cpus
+    :return: new matrix after transformation
+    '''
 
-        return newImg.astype(img.dtype)
+    if len(img.shape) != 3:
+        raise LookupError('Input image is not a 3d array!')
 
+    if chunkLength < 1: raise ValueError('chunkLength should be a positive integer!')
+    chunkLength = int(chunkLength)
 
-def rigid_transform_cv2_3d(img, zoom=None, rotation=None, offset=None, outputShape=None):
+    if threadNum is None: threadNum = os.cpu_count() or 1
+    if threadNum < 1: raise ValueError('threadNum should be a positive integer!')
 
-    if len(img.shape) != 3:
-        raise LookupError('Input image is not a 3d array!')
+    frameNum = img.shape[0]
 
-    if not outputShape:
-        if zoom is not None:
-            try:
-                newHeight = int(img.shape[1]*zoom[0])
-                newWidth = int(img.shape[2]*zoom[1])
-            except TypeError:
-                newHeight = int(img.shape[1] * zoom)
-                newWidth = int(img.shape[2] * zoom)
-        else:
-            newHeight = img.shape[1]
-            newWidth = img.shape[2]
-    else:
-        newHeight = outputShape[0]
-        newWidth = outputShape[1]
-    newImg = np.empty((img.shape[0],newHeight,newWidth),dtype=img.dtype)
+    offsets = None
+    if offset is not None and len(np.array(offset).shape) == 2:
+        offsets = np.array(offset)
+        if offsets.shape != (frameNum, 2): raise ValueError('offset of each frame should have shape (frameNum, 2)!')
 
-    for i in range(img.shape[0]):
-        newImg[i,:,:] = rigid_transform_cv2_2d(img[i, :, :], zoom=zoom, rotation=rotation, offset=offset, outputShape=outputShape)
+    plan = _get_rigid_transform_plan(img.shape[1:], zoom=zoom, rotation=rotation, offset=offset,
+                                     outputShape=outputShape)
+    newShape = (frameNum, plan['outputShape'][0], plan['outputShape'][1])
 
-    return newImg
+    if output is None:
+        output = np.empty(newShape, dtype=img.dtype)
+    elif tuple(output.shape) != newShape:
+        raise ValueError('the shape of output should be ' + str(newShape) + '!')
+
+    if offsets is not None: offset = None
+
+    with ThreadPoolExecutor(max_workers=threadNum) as pool:
+        # chunks are read and written in current thread, at most 2 x threadNum chunks are in memory at the same time
+        pending = deque()
+        for chunkStart in range(0, frameNum, chunkLength):
+            chunkEnd = min(chunkStart + chunkLength, frameNum)
+            chunkOffsets = None if offsets is None else offsets[chunkStart:chunkEnd]
+            future = pool.submit(_rigid_transform_chunk, np.array(img[chunkStart:chunkEnd]), plan, output.dtype,
+                                 offset=offset, offsets=chunkOffsets)
+            pending.append((chunkStart, chunkEnd, future))
+            if len(pending) >= 2 * threadNum:
+                currStart, currEnd, future = pending.popleft()
+                output[currStart:currEnd] = future.result()
+        while pending:
+            currStart, currEnd, future = pending.popleft()
+            output[currStart:currEnd] = future.result()
 
+    return output
 
-def rigid_transform_cv2(img, zoom=None, rotation=None, offset=None, outputShape=None):
+
+def rigid_transform_cv2(img, zoom=None, rotation=None, offset=None, outputShape=None, threadNum=None):
 
     '''
     rigid transformation of a 2d-image or 3d-matrix by using opencv
@@ -460,57 +599,141 @@ def rigid_transform_cv2(img, zoom=None, rotation=None, offset=None, outputShape=
     :param rotation: in degree, counterclock wise
     :param offset: tuple (xoffset, yoffset) pixel value of starting point of output image
     :param outputShape: the shape of output image, (height, width)
+    :param threadNum: positive int, number of threads to transform a 3d-matrix, if None, the number of cpus
     :return: new image or matrix after transformation
     '''
 
     if len(img.shape) == 2:
         return rigid_transform_cv2_2d(img, zoom=zoom, rotation=rotation, offset=offset, outputShape=outputShape)
     elif len(img.shape) == 3:
-        return rigid_transform_cv2_3d(img, zoom=zoom, rotation=rotation, offset=offset, outputShape=outputShape)
+        return rigid_transform_cv2_3d(img, zoom=zoom, rotation=rotation, offset=offset, outputShape=outputShape,
+                                      threadNum=threadNum)
     else:
         raise ValueError('Input image is not a 2d or 3d array!')
 
 
+def get_rigid_transform_matrix(frameShape, zoom=None, rotation=None, offset=None, outputShape=None):
+    '''
+    affine matrix of the rigid transformation of rigid_transform_cv2_2d, the zooming, expanding, rotation and moving
+    steps are combined into one matrix
+
+    :param frameShape: (height, width) of input image
+    :param zoom:
+    :param rotation: in degree, counterclock wise
+    :param offset: tuple (xoffset, yoffset) pixel value of starting point of output image
+    :param outputShape: the shape of output image, (height, width)
+    :return: matrix, 3 x 3 homogeneous matrix mapping source (x, y) to destination (x, y); shape of output image
+             (height, width)
+    '''
+
+    plan = _get_rigid_transform_plan(frameShape, zoom=zoom, rotation=rotation, offset=offset, outputShape=outputShape)
+    matrix = np.eye(3)
+
+    if plan['zoomShape'] is not None:
+        # pixel centers are aligned in the same way as cv2.resize
+        zoomH = float(plan['zoomShape'][0]) / frameShape[0]; zoomW = float(plan['zoomShape'][1]) / frameShape[1]
+        matrix = np.array([[zoomW, 0., 0.5 * (zoomW - 1)], [0., zoomH, 0.5 * (zoomH - 1)], [0., 0., 1.]]).dot(matrix)
+
+    if plan['rotationMatrix'] is not None:
+        matrix = np.vstack((plan['expandMatrix'].astype(np.float64), [0., 0., 1.])).dot(matrix)
+        matrix = np.vstack((plan['rotationMatrix'], [0., 0., 1.])).dot(matrix)
+
+    if plan['isMove'] and offset is not None:
+        matrix = np.array([[1., 0., offset[0]], [0., 1., offset[1]], [0., 0., 1.]]).dot(matrix)
+
+    return matrix, plan['outputShape']
+
+
+def get_warp_maps(matrix, outputShape, isFixedPoint=True):
+    '''
+    precompute the lookup maps of an affine transformation, so that every frame of a movie can be transformed by one
+    remapping (see remap_image)
+
+    :param matrix: 3 x 3 (or 2 x 3) affine matrix mapping source (x, y) to destination (x, y)
+    :param outputShape: shape of output image, (height, width)
+    :param isFixedPoint: bool, if True and opencv is available, the maps are converted into the faster fixed point
+                         representation of opencv
+    :return: warp maps, (mapX, mapY) of source coordinates for each output pixel
+    '''
+
+    matrix = np.array(matrix, dtype=np.float64)[0:2, :]
+    invMatrix = np.linalg.inv(np.vstack((matrix, [0., 0., 1.])))
+
+    ys, xs = np.mgrid[0:outputShape[0], 0:outputShape[1]].astype(np.float64)
+    mapX = (invMatrix[0, 0] * xs + invMatrix[0, 1] * ys + invMatrix[0, 2]).astype(np.float32)
+    mapY = (invMatrix[1, 0] * xs + invMatrix[1, 1] * ys + invMatrix[1, 2]).astype(np.float32)
+
+    if isFixedPoint and cv2 is not None: return cv2.convertMaps(mapX, mapY, cv2.CV_16SC2)
+    else: return mapX, mapY
+
+
+def remap_image(img, warpMaps, borderValue=None):
+    '''
+    transform a 2d-image with precomputed warp maps (output of get_warp_maps) by linear interpolation, by using
+    opencv if available, otherwise by scipy.ndimage.map_coordinates
+
+    :param borderValue: value of pixels outside of input image, if None, the minimum of input image
+    :return: transformed image, np.float32
+    '''
+
+    img = np.asarray(img, dtype=np.float32)
+    if borderValue is None: borderValue = float(np.amin(img))
+
+    if cv2 is not None:
+        return cv2.remap(img, warpMaps[0], warpMaps[1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                         borderValue=borderValue)
+    else:
+        return ni.map_coordinates(img, [warpMaps[1], warpMaps[0]], order=1, mode='constant', cval=borderValue)
+
+
 def boxcartime_dff(data,
                    window,# boxcar size in seconds
-                   fs # sample rate in ms
+                   fs, # sample rate in ms
+                   output = None, # preallocated output array (np.ndarray, np.memmap, hdf5 dataset, etc.)
+                   pixelBlockSize = 10000 # maximum number of pixels processed together
                    ):
     """
     Created on Mon Nov 24 14:37:02 2014
 
     [dff] = boxcartime_dff(data[t,y,x], rollingwindow[in s], samplerate[in ms])
-    boxcar average uses scipy.signal package, imported locally
+
+    the baseline of each frame is the boxcar average of the following "win" frames (win = ceil(window / exposure)),
+    dff is calculated for the frames in the middle of the movie and the output has data.shape[0] - win frames.
+    the boxcar average is calculated with cumulative sums along time axis for blocks of pixels, so the memory usage
+    is bounded by the block size.
 
     @author: mattv
     """
-    import scipy.signal as sig
 
     if data.ndim != 3:
         raise LookupError('input images must be a 3-dim array format [t,y,x]')
 
-    exposure = np.float(fs/1000) #convert exposure from ms to s
-    win = np.float(window)
-    win = win/exposure
-    win = np.ceil(win)
-
-    # rolling average
-    kernal = np.ones(win, dtype=('float'))
-    padsize = data.shape[0] + win*2
-    mov_ave = np.zeros([padsize+win-1], dtype=('float'))
-    mov_pad = np.zeros([padsize], dtype=('float'))
-    mov_dff = np.zeros([data.shape[0]-win, data.shape[1], data.shape[2]])
-    for y in range(data.shape[1]):
-        for x in range(data.shape[2]):
-            # put data within padded array
-            mov_pad[win:(padsize-win)] = data[:,y,x]
-            # moving average by convolution
-            mov_ave = sig.fftconvolve(mov_pad, kernal)/win
-            # cut off pad
-            mov_ave = mov_ave[win*2:1+mov_ave.shape[0]-win*2]
-            # use moving average as f0 for df/f
-            mov_dff[:,y,x] = (data[(win/2):data.shape[0]-(win/2),y,x] - mov_ave)/mov_ave
-
-    return mov_dff
+    exposure = float(fs)/1000. #convert exposure from ms to s
+    win = int(np.ceil(float(window)/exposure))
+
+    frameNum = data.shape[0]
+    if win < 1 or win >= frameNum:
+        raise ValueError('boxcar window should be at least one frame and shorter than the movie!')
+
+    dffShape = (frameNum - win, data.shape[1], data.shape[2])
+    if output is None:
+        output = np.zeros(dffShape)
+    elif tuple(output.shape) != dffShape:
+        raise LookupError('the shape of "output" should be ' + str(dffShape) + '!')
+
+    blockRowNum = max(pixelBlockSize // data.shape[2], 1)
+
+    for rowStart in range(0, data.shape[1], blockRowNum):
+        rowEnd = min(rowStart + blockRowNum, data.shape[1])
+        block = np.asarray(data[:, rowStart:rowEnd, :], dtype=np.float64)
+
+        # moving average of frame [i+1, i+win] as f0 of frame i+win//2
+        cumSum = np.cumsum(block, axis=0)
+        movAve = (cumSum[win:] - cumSum[:frameNum-win]) / win
+
+        output[:, rowStart:rowEnd, :] = (block[(win//2):(win//2)+frameNum-win] - movAve) / movAve
+
+    return output
 
 
 def normalize_movie(movie,
@@ -519,6 +742,8 @@ def normalize_movie(movie,
                     ):
     '''
     return average image, movie minus avearage, and dF over F for each pixel
+
+    to compute only one of the normalized movies with less memory, use normalize_movie_chunked
     '''
     movie = np.array(movie, dtype = np.float32)
 
@@ -544,24 +769,82 @@ def normalize_movie(movie,
     return averageImage, normalizedMovie, dFoverFMovie
 
 
-def temporal_filter_movie(mov,  # array of movie
-                        Fs,  # sampling rate
-                        Flow,  # low cutoff frequency
-                        Fhigh,  # high cutoff frequency
-                        mode = 'box'): # filter mode, '1/f' or 'box'):
+def normalize_movie_chunked(movie, baselinePic=None, baselineType='mean', outputType='dFoverF', output=None,
+                            chunkLength=1000):
+    '''
+    compute only one normalized movie ('dF': movie minus baseline, or 'dFoverF': dF over baseline), streaming over
+    chunks of frames. The baseline (if not given) is computed in chunks of frames (mean) or blocks of rows (median).
 
-    if len(mov.shape) != 3:
-        raise LookupError('The "mov" array should have 3 dimensions!')
+    :param movie: 3d array_like (np.array, np.memmap, BinarySlicer object, hdf5 dataset, etc)
+    :param baselinePic: 2d array, picture for baseline, if None, calculated from movie with baselineType
+    :param baselineType: 'mean' or 'median'
+    :param outputType: 'dF' or 'dFoverF'
+    :param output: preallocated float array_like with same shape as movie, can be the movie itself (in-place
+                   normalization). if None, a new np.float32 array will be created
+    :param chunkLength: int, number of frames processed together
+    :return: averageImage (baseline picture), normalized movie
+    '''
+
+    if len(movie.shape) != 3: raise LookupError('The "movie" should be 3-d!')
+    if outputType not in ('dF', 'dFoverF'): raise LookupError('The "outputType" should be "dF" or "dFoverF"!')
+    if chunkLength < 1: raise ValueError('chunkLength should be a positive integer!')
+
+    frameNum = movie.shape[0]
+
+    if baselinePic is not None:
+        if tuple(movie.shape[1:]) != baselinePic.shape:
+            raise LookupError('The shape of "baselinePic" should match the shape of the frame shape of "movie"!')
+        averageImage = baselinePic
+
+    elif baselineType == 'mean':
+        sumImage = np.zeros(movie.shape[1:], dtype=np.float64)
+        for chunkStart in range(0, frameNum, chunkLength):
+            sumImage += np.sum(np.asarray(movie[chunkStart:chunkStart + chunkLength], dtype=np.float32), axis=0)
+        averageImage = (sumImage / frameNum).astype(np.float32)
+
+    elif baselineType == 'median':
+        averageImage = np.empty(movie.shape[1:], dtype=np.float32)
+        blockRowNum = max(chunkLength * movie.shape[1] // frameNum, 1)
+        for rowStart in range(0, movie.shape[1], blockRowNum):
+            averageImage[rowStart:rowStart + blockRowNum] = \
+                np.median(np.asarray(movie[:, rowStart:rowStart + blockRowNum], dtype=np.float32), axis=0)
+
+    else:
+        raise LookupError('The "baselineType" should be "mean" or "median"!!')
+
+    if output is None:
+        output = np.empty(movie.shape, dtype=np.float32)
+    elif tuple(output.shape) != tuple(movie.shape):
+        raise LookupError('The shape of "output" should match the shape of "movie"!')
+
+    for chunkStart in range(0, frameNum, chunkLength):
+        chunkEnd = min(chunkStart + chunkLength, frameNum)
+        chunk = np.array(movie[chunkStart:chunkEnd], dtype=np.float32)
+        chunk -= averageImage
+        if outputType == 'dFoverF':
+            chunk /= averageImage
+        output[chunkStart:chunkEnd] = chunk
+
+    return averageImage, output
 
-    frameNum = mov.shape[0]
-    freqs = np.fft.fftfreq(frameNum, d = (1./float(Fs)))
 
-    filterArray = np.ones(frameNum)
+def get_temporal_filter_array(frameNum, Fs, Flow, Fhigh, mode = 'box'):
+    '''
+    generate the frequency domain filter used by temporal_filter_movie, for the non-negative frequencies of a real fft
+    (np.fft.rfftfreq) of a signal with frameNum samples
+
+    :param frameNum: int, number of time points
+    :param Fs: sampling rate
+    :param Flow: low cutoff frequency
+    :param Fhigh: high cutoff frequency
+    :param mode: filter mode, '1/f' or 'box'
+    :return: 1d array, length: frameNum // 2 + 1
+    '''
 
-    for i in range(frameNum):
-        if ((freqs[i] > 0) and (freqs[i] < Flow) or (freqs[i] > Fhigh)) or \
-           ((freqs[i] < 0) and (freqs[i] > -Flow) or (freqs[i] < -Fhigh)):
-            filterArray[i] = 0
+    freqs = np.fft.rfftfreq(frameNum, d = (1./float(Fs)))
+
+    filterArray = np.ones(len(freqs))
+    filterArray[((freqs > 0) & (freqs < Flow)) | (freqs > Fhigh)] = 0
 
     if mode == '1/f':
         filterArray[1:] = filterArray[1:] / abs(freqs[1:])
@@ -574,15 +857,48 @@ def temporal_filter_movie(mov,  # array of movie
     if Flow == 0:
         filterArray[0] = 1
 
-    movFFT = np.fft.fft(mov, axis = 0)
+    return filterArray
 
-    for i in range(mov.shape[1]):
-        for j in range(mov.shape[2]):
-            movFFT[:,i,j] = movFFT[:,i,j] * filterArray
 
-    movF = np.real(np.fft.ifft(movFFT, axis = 0))
+def temporal_filter_movie(mov,  # array of movie
+                        Fs,  # sampling rate
+                        Flow,  # low cutoff frequency
+                        Fhigh,  # high cutoff frequency
+                        mode = 'box', # filter mode, '1/f' or 'box'
+                        dtype = np.float32, # data type of filtering and output
+                        pixelBlockSize = 10000, # maximum number of pixels filtered together
+                        output = None): # preallocated output
+    '''
+    temporally filter each pixel of a movie in frequency domain. The movie is processed in blocks of rows with real ffts
+    along time axis, so the memory usage is bounded by the block size. mov can be any 3d array_like supporting
+    slicing (np.ndarray, np.memmap, hdf5 dataset, etc.), and output can be a preallocated array_like with same shape
+    (for example a np.memmap or hdf5 dataset) for movies larger than memory.
 
-    return movF
+    :return: filtered movie (output, if it is given)
+    '''
+
+    if len(mov.shape) != 3:
+        raise LookupError('The "mov" array should have 3 dimensions!')
+
+    frameNum = mov.shape[0]
+
+    if output is None:
+        output = np.empty(mov.shape, dtype = dtype)
+    elif tuple(output.shape) != tuple(mov.shape):
+        raise LookupError('The "output" array should have the same shape as the "mov" array!')
+
+    filterArray = get_temporal_filter_array(frameNum, Fs, Flow, Fhigh, mode = mode).astype(dtype)
+    filterArray = filterArray[:, None, None]
+
+    blockRowNum = max(pixelBlockSize // mov.shape[2], 1)
+
+    for rowStart in range(0, mov.shape[1], blockRowNum):
+        rowEnd = min(rowStart + blockRowNum, mov.shape[1])
+        blockFFT = fftpack.rfft(np.asarray(mov[:, rowStart:rowEnd, :], dtype = dtype), axis = 0)
+        blockFFT *= filterArray
+        output[:, rowStart:rowEnd, :] = fftpack.irfft(blockFFT, n = frameNum, axis = 0).astype(dtype)
+
+    return output
 
 
 def generate_rectangle_mask(shape, center, width, height, isplot = False):
@@ -625,14 +941,16 @@ def generate_oval_mask(shape, center, width, height, isplot = False):
     return mask
 
 
-def get_trace(movie, mask, maskMode ='binary'):
+def get_final_mask(mask, maskMode='binary'):
     '''
-    get a trace across a movie with averaged value in a mask
+    convert a mask into a weight mask (zeros outside roi) and the number of pixels in roi, used by get_trace
 
     maskMode: 'binary': ones in roi, zeros outside
               'binaryNan': ones in roi, nans outside
               'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
               'weightedNan': weighted values in roi, nans outside
+
+    :return: finalMask, pixelNum
     '''
 
     if maskMode == 'binary':
@@ -660,17 +978,33 @@ def get_trace(movie, mask, maskMode ='binary'):
     else:
         raise LookupError('maskMode not understood. Should be one of "binary", "binaryNan", "weighted", "weightedNan".')
 
+    return finalMask, pixelNum
+
+
+def get_trace(movie, mask, maskMode ='binary'):
+    '''
+    get a trace across a movie with averaged value in a mask
+
+    maskMode: 'binary': ones in roi, zeros outside
+              'binaryNan': ones in roi, nans outside
+              'weighted': weighted values in roi, zeros outside (note: all pixels equal to zero will be considered outside roi
+              'weightedNan': weighted values in roi, nans outside
+    '''
+
+    finalMask, pixelNum = get_final_mask(mask, maskMode=maskMode)
+
     trace = np.sum(np.multiply(movie,finalMask),(1,2))/pixelNum
 
     return trace
 
 
-def get_trace_binaryslicer(bl_obj, mask, mask_mode = 'binary'):
+def get_trace_binaryslicer(bl_obj, mask, mask_mode = 'binary', loading_frame_num = 1000):
     '''
 
     :param bl_obj: the binary slicer object of a large matrix
     :param mask: the mask
     :param mask_mode: same as 'mask_mode' in function get_trace
+    :param loading_frame_num: frame number of each chunk, chunks are prefetched by a background thread
 
     maskMode: 'binary': ones in roi, zeros outside
               'binaryNan': ones in roi, nans outside
@@ -719,9 +1053,12 @@ def get_trace_binaryslicer(bl_obj, mask, mask_mode = 'binary'):
         min_col = min(mask_ind[1]); max_col = max(mask_ind[1]) + 1
         finalMask = finalMask[min_row:max_row, min_col:max_col]
 
-    mov = bl_obj[:,min_row:max_row, min_col:max_col]
-    # print mov
-    return get_trace(mov, finalMask, maskMode='weighted')
+    traces = []
+    for _, _, currMov in ft.ChunkReader(bl_obj, chunk_length=loading_frame_num,
+                                        spatial_slice=(slice(min_row, max_row), slice(min_col, max_col))):
+        traces.append(get_trace(currMov, finalMask, maskMode='weighted'))
+
+    return np.concatenate(traces)
 
 
 def get_trace_binaryslicer2(bl_obj, mask, mask_mode = 'binary', loading_frame_num = 1000):
@@ -760,12 +1097,8 @@ def get_trace_binaryslicer2(bl_obj, mask, mask_mode = 'binary', loading_frame_nu
         print('Translating in chunks: '+str(chunkNum-1)+' x '+str(loading_frame_num)+' frame(s)'+' + '+str(frameNum % loading_frame_num)+' frame(s)')
 
     traces = []
-    for i in range(chunkNum):
-        indStart = i*loading_frame_num
-        indEnd = (i+1)*loading_frame_num
-        if indEnd > frameNum: indEnd = frameNum
+    for i, (indStart, indEnd, currMov) in enumerate(ft.ChunkReader(bl_obj, chunk_length=loading_frame_num)):
         print('Extracting signal from frame '+str(indStart)+' to frame '+str(indEnd)+'.\t'+str(i*100./chunkNum)+'%')
-        currMov = bl_obj[indStart:indEnd,:,:]
         traces.append(get_trace(currMov, mask, maskMode=mask_mode))
 
     return np.concatenate(traces)
@@ -804,25 +1137,114 @@ def get_trace_binaryslicer3(bl_obj, masks, mask_mode = 'binary', loading_frame_n
         chunkNum += 1
         print('Translating in chunks: '+str(chunkNum-1)+' x '+str(loading_frame_num)+' frame(s)'+' + '+str(frameNum % loading_frame_num)+' frame(s)')
 
-    traces = {}
-    for key in masks.keys(): traces.update({'trace_'+key:[]})
+    keys, mask_matrix = get_mask_matrix(masks, frame_shape=bl_obj.shape[1:], mask_mode=mask_mode)
+
+    traces = [[] for key in keys]
 
-    for i in range(chunkNum):
-        indStart = i*loading_frame_num
-        indEnd = (i+1)*loading_frame_num
-        if indEnd > frameNum: indEnd = frameNum
+    for i, (indStart, indEnd, currMov) in enumerate(ft.ChunkReader(bl_obj, chunk_length=loading_frame_num)):
         print('Extracting signal from frame '+str(indStart)+' to frame '+str(indEnd)+'.\t'+str(i*100./chunkNum)+'%')
-        currMov = bl_obj[indStart:indEnd,:,:]
-        for key, mask in masks.items():
-            if len(mask.shape) != 2: raise ValueError('Mask "' + key + '" should be 2d!')
-            if bl_obj.shape[1] != mask.shape[0] or bl_obj.shape[2] != mask.shape[1]:
-                raise ValueError('the size of each frame of the BinarySlicer object should be the same as the size of mask "' + key + '"!')
-            traces['trace_'+key].append(get_trace(currMov, mask, maskMode=mask_mode))
+        currTraces = get_traces_from_mask_matrix(currMov, mask_matrix)
+        for j in range(len(keys)):
+            traces[j].append(currTraces[j])
+
+    return dict(('trace_'+key, np.concatenate(trace)) for key, trace in zip(keys, traces))
+
+
+def get_mask_matrix(masks, frame_shape=None, mask_mode='binary'):
+    '''
+    pack a dictionary of masks into one sparse (pixel x roi) matrix. each column is the weight mask of one roi divided
+    by its pixel number, so that the traces of all rois (including neuropil surround masks, if they are in the
+    dictionary) in a movie can be extracted by a single sparse-dense matrix product (see get_traces_from_mask_matrix)
+
+    :param masks: a dictionary of 2d masks
+    :param frame_shape: tuple of two positive integers, shape of each frame, if None, the shape of the first mask
+    :param mask_mode: same as 'maskMode' in function get_trace, or a dictionary with the same keys as masks, giving
+                      the mode of each mask
+    :return: keys: list of mask keys, the order of columns in mask_matrix
+             mask_matrix: scipy.sparse.csc_matrix, shape (frame_shape[0] * frame_shape[1], number of masks)
+    '''
+
+    keys = list(masks.keys())
+
+    if frame_shape is None:
+        if not keys: raise ValueError('Can not get frame shape from empty masks!')
+        frame_shape = masks[keys[0]].shape
+    frame_shape = tuple(frame_shape)
+
+    data = []
+    rows = []
+    cols = []
+    for col, key in enumerate(keys):
+        mask = masks[key]
+        if len(mask.shape) != 2: raise ValueError('Mask "' + key + '" should be 2d!')
+        if mask.shape != frame_shape:
+            raise ValueError('the size of each frame of the movie should be the same as the size of mask "' + key + '"!')
+
+        if isinstance(mask_mode, dict): curr_mode = mask_mode[key]
+        else: curr_mode = mask_mode
+
+        final_mask, pixel_num = get_final_mask(mask, maskMode=curr_mode)
+        pixel_ind = np.flatnonzero(final_mask)
+        data.append(final_mask.flat[pixel_ind] / float(pixel_num))
+        rows.append(pixel_ind)
+        cols.append(np.zeros(len(pixel_ind), dtype=np.int64) + col)
+
+    if keys:
+        data = np.concatenate(data); rows = np.concatenate(rows); cols = np.concatenate(cols)
+
+    mask_matrix = sparse.csc_matrix((data, (rows, cols)), shape=(frame_shape[0] * frame_shape[1], len(keys)),
+                                    dtype=np.float64)
+
+    return keys, mask_matrix
+
+
+def get_traces_from_mask_matrix(mov, mask_matrix):
+    '''
+    extract traces of all rois in a movie with one sparse-dense matrix product
+
+    :param mov: 3d array, movie (frame x row x column)
+    :param mask_matrix: sparse (pixel x roi) matrix from get_mask_matrix
+    :return: 2d array, roi x frame, traces of all rois
+    '''
+
+    mov = np.asarray(mov)
+    if len(mov.shape) != 3: raise ValueError('movie should be 3d!')
+    mov_2d = mov.reshape((mov.shape[0], mov.shape[1] * mov.shape[2]))
+    if mov_2d.shape[1] != mask_matrix.shape[0]:
+        raise ValueError('the pixel number of each frame of the movie should be the same as the row number of '
+                         'mask_matrix!')
+
+    return np.asarray(mask_matrix.T.dot(mov_2d.T))
+
+
+def get_traces_batch(mov, masks, mask_mode='binary', loading_frame_num=1000):
+    '''
+    get traces of many masks from a movie, by loading chunk each time. all masks are packed into a sparse matrix
+    (see get_mask_matrix), so every chunk only needs one sparse-dense matrix product instead of one full frame
+    multiplication per mask
+
+    :param mov: 3d movie, can be numpy.ndarray, BinarySlicer object or h5py dataset (anything supports slicing along
+                the first axis and has a 'shape' attribute)
+    :param masks: a dictionary of masks (both roi masks and their neuropil surround masks)
+    :param mask_mode: same as 'maskMode' in function get_trace, or a dictionary with the same keys as masks, giving
+                      the mode of each mask
+    :param loading_frame_num: frame number of each chunk, chunks are prefetched by a background thread
+
+    :return: dictionary of traces, same structure as the output of get_trace_binaryslicer3, {'trace_'+key: trace}
+    '''
 
-    for key in traces.keys():
-        traces[key] = np.concatenate(traces[key])
+    if loading_frame_num < 1: raise ValueError('loading_frame_num should be a positive integer!')
+    if len(mov.shape) != 3: raise ValueError('movie should be 3d!')
 
-    return traces
+    keys, mask_matrix = get_mask_matrix(masks, frame_shape=mov.shape[1:], mask_mode=mask_mode)
+
+    frameNum = mov.shape[0]
+    traces = np.zeros((len(keys), frameNum), dtype=np.float64)
+
+    for indStart, indEnd, currMov in ft.ChunkReader(mov, chunk_length=loading_frame_num):
+        traces[:, indStart:indEnd] = get_traces_from_mask_matrix(currMov, mask_matrix)
+
+    return dict(('trace_'+key, traces[i]) for i, key in enumerate(keys))
 
 
 def hit_or_miss(coor, mask):
@@ -1047,10 +1469,11 @@ def z_downsample(img, downSampleRate):
     return newImg
 
 
-def get_masks(labeled, minArea=None, maxArea=None, isSort=True, keyPrefix = None, labelLength=None):
+def get_masks(labeled, minArea=None, maxArea=None, isSort=True, keyPrefix = None, labelLength=None, isCompact=False):
     '''
     get mask dictionary from labeled map (labeled by scipy.ndimage.label function), masks with area smaller than
-    minArea and maxArea will be discarded.
+    minArea and maxArea will be discarded. The labeled map is scanned only once: the areas of all labels are counted
+    together and each mask is extracted from its bounding box (scipy.ndimage.find_objects).
 
     :param labeled: 2d array with non-negative int, labelled map (ideally the output of scipy.ndimage.label function)
     :param minArea: positive int, minimum area criterion of retained masks
@@ -1058,21 +1481,31 @@ def get_masks(labeled, minArea=None, maxArea=None, isSort=True, keyPrefix = None
     :param isSort: bool, sort the masks by area or not
     :param keyPrefix: str, the key prefix for returned dictionary
     :param labelLength: positive int, the length of key index
+    :param isCompact: bool, if True, masks are returned as CompactMask objects (bounding box and local mask) instead
+                      of full size 2d arrays
 
-    :return masks: dictionary of 2d binary masks
+    :return masks: dictionary of 2d binary masks (or CompactMask objects)
     '''
 
-    maskNum = np.max(labeled.flatten())
+    labeled = np.asarray(labeled)
+    areas = np.bincount(labeled.flatten().astype(np.int64))
     masks = {}
-    for i in range(1, maskNum + 1):
-        currMask = np.zeros(labeled.shape, dtype=np.uint8)
-        currMask[labeled == i] = 1
+    for i, boundingBox in enumerate(ni.find_objects(labeled), start=1):
+        # labels without any pixel give empty masks, as when each label was compared with the whole labeled map
+        if boundingBox is None: boundingBox = (slice(0, 0), slice(0, 0))
 
-        if minArea is not None and np.sum(currMask.flatten()) < minArea:
+        if minArea is not None and areas[i] < minArea:
             continue
-        elif maxArea is not None and np.sum(currMask.flatten()) > maxArea:
+        elif maxArea is not None and areas[i] > maxArea:
             continue
         else:
+            localMask = labeled[boundingBox] == i
+            if isCompact:
+                currMask = CompactMask(localMask, boundingBox, labeled.shape)
+            else:
+                currMask = np.zeros(labeled.shape, dtype=np.uint8)
+                currMask[boundingBox][localMask] = 1
+
             if labelLength is not None:
                 mask_index = ft.int2str(i, labelLength)
             else:
@@ -1104,13 +1537,14 @@ def get_marked_masks(labeled, markCoor):
 
 def sort_masks(masks, keyPrefix=None, labelLength=3):
     '''
-    sort a dictionary of binary masks, big to small
+    sort a dictionary of binary masks (2d arrays or CompactMask objects), big to small
     '''
 
     maskNum = len(list(masks.keys()))
     order = []
     for key, mask in masks.items():
-        order.append([key,np.sum(mask.flatten())])
+        if isinstance(mask, CompactMask): order.append([key, mask.get_area()])
+        else: order.append([key,np.sum(mask.flatten())])
 
     order = sorted(order, key=lambda a:a[1], reverse=True)
 
@@ -1142,6 +1576,28 @@ def sort_masks(masks, keyPrefix=None, labelLength=3):
 #     return newA
 
 
+def get_onset_frame_indices(frameTS, onsetTimes):
+    '''
+    find the index of the frame nearest to each onset time (same as np.argmin(np.abs(frameTS - onset)) for each
+    onset, ties go to the earlier frame), resolved for all onsets at once by sorted search
+
+    :param frameTS: the timestamps for each frame of the raw movie, monotonically increasing
+    :param onsetTimes: time stamps of onsets
+    :return: 1d array of int, frame index of each onset
+    '''
+
+    frameTS = np.asarray(frameTS)
+    onsetTimes = np.asarray(onsetTimes, dtype=np.float64)
+
+    rightInd = np.clip(np.searchsorted(frameTS, onsetTimes, side='left'), 1, len(frameTS) - 1)
+    leftInd = rightInd - 1
+    isLeft = np.abs(onsetTimes - frameTS[leftInd]) <= np.abs(frameTS[rightInd] - onsetTimes)
+    onsetInd = np.where(isLeft, leftInd, rightInd)
+    if len(frameTS) == 1: onsetInd[:] = 0
+
+    return onsetInd.astype(np.int64)
+
+
 def get_average_movie(mov, frameTS, onsetTimes, chunkDur, isReturnN=False):
     '''
     :param mov: image movie
@@ -1151,45 +1607,122 @@ def get_average_movie(mov, frameTS, onsetTimes, chunkDur, isReturnN=False):
     :return: averageed movie of all chunks
     '''
 
-    meanFrameDur = np.mean(np.diff(frameTS))
-
-    chunkFrameDur = int(np.ceil(chunkDur / meanFrameDur))
+    aveMovs, ns = get_average_movies(mov, frameTS, {'onsets': onsetTimes}, chunkDur)
 
-    # print 'chunkDur:', chunkDur
-    # print 'meanFrameDur:', meanFrameDur
-    # print 'chunkFrameDur:', chunkFrameDur
+    if isReturnN:
+        return aveMovs['onsets'], ns['onsets']
+    else:
+        return aveMovs['onsets']
 
-    sumMov = None
-    n = 0.
 
-    curr_onset = -1
-    onset_num = len(onsetTimes)
-    t0 = time.time()
+def get_average_movies(mov, frameTS, onsetTimes, chunkDur, isReturnSEM=False, loadingFrameNum=1000, verbose=True):
+    '''
+    average stimulus locked chunks of a movie for multiple conditions in a single pass through the movie. The frame
+    indices of all onsets are resolved at once (get_onset_frame_indices) and the movie is then read sequentially in
+    chunks (each frame only once), adding every frame to all (condition, trial) windows covering it.
 
-    for i, onset in enumerate(onsetTimes):
-        if onset >= frameTS[0] and onset + chunkDur <= frameTS[-1]:
+    onsets before the first frame, with the chunk ending after the last frame timestamp, or with the chunk exceeding
+    the movie are excluded (same criteria as the original get_average_movie)
 
-            if i // (onset_num // 10) > curr_onset:
-                # print t0 - time.time(), ' second :', (i // (onset_num // 10)) * 10, '%'
-                print(('{:09.2f} second: {:2d} %'.format(time.time() - t0, (i // (onset_num // 10)) * 10)))
-                curr_onset = i // (onset_num // 10)
+    :param mov: image movie, 3d array_like (np.array, BinarySlicer object, hdf5 dataset, etc)
+    :param frameTS: the timestamps for each frame of the raw movie
+    :param onsetTimes: dictionary, {condition: time stamps of onset of each trigger}
+    :param chunkDur: duration of each chunk, float or dictionary {condition: duration}
+    :param isReturnSEM: if True, also return the standard error of mean of each condition (Welford's algorithm)
+    :param loadingFrameNum: frame number of each chunk of reading
+    :return: aveMovs: dictionary, {condition: averaged movie, float32}
+             ns: dictionary, {condition: number of chunks averaged}
+             sems: dictionary, {condition: standard error of mean, float32}, only if isReturnSEM is True
+    '''
 
-            onsetFrameInd = int(np.argmin(np.abs(frameTS-onset)))
-            # print 'Chunk:',int(n),'; Starting frame index:',onsetFrameInd,'; Ending frame index', onsetFrameInd+chunkFrameDur
+    frameTS = np.asarray(frameTS)
+    meanFrameDur = np.mean(np.diff(frameTS))
 
-            if onsetFrameInd+chunkFrameDur <= mov.shape[0]:
-                if sumMov is None: sumMov = np.zeros((chunkFrameDur,mov.shape[1],mov.shape[2]), dtype=np.float64)
-                sumMov += mov[onsetFrameInd:onsetFrameInd+chunkFrameDur,:,:].astype(np.float64)
-                n += 1.
-            else:
-                print('Ending frame index ('+str(int(onsetFrameInd+chunkFrameDur))+') is larger than frames in movie ('+\
-                      str(int(mov.shape[0]))+'.\nExclude this trigger.')
-                continue
+    conditions = list(onsetTimes.keys())
+    frameShape = tuple(mov.shape[1:])
+
+    # windows of all valid trials: condition index, start frame, end frame
+    trialCond = []
+    trialStart = []
+    chunkFrameDurs = {}
+    for condInd, cond in enumerate(conditions):
+        if isinstance(chunkDur, dict): currChunkDur = chunkDur[cond]
+        else: currChunkDur = chunkDur
+        chunkFrameDur = int(np.ceil(currChunkDur / meanFrameDur))
+        chunkFrameDurs.update({cond: chunkFrameDur})
+
+        onsets = np.asarray(onsetTimes[cond], dtype=np.float64)
+        onsets = onsets[(onsets >= frameTS[0]) & (onsets + currChunkDur <= frameTS[-1])]
+        onsetInd = get_onset_frame_indices(frameTS, onsets)
+
+        isExceed = onsetInd + chunkFrameDur > mov.shape[0]
+        for ind in onsetInd[isExceed]:
+            print('Ending frame index ('+str(int(ind+chunkFrameDur))+') is larger than frames in movie ('+\
+                  str(int(mov.shape[0]))+'.\nExclude this trigger.')
+        onsetInd = onsetInd[~isExceed]
+
+        trialCond.append(np.zeros(len(onsetInd), dtype=np.int64) + condInd)
+        trialStart.append(onsetInd)
+
+    trialCond = np.concatenate(trialCond) if conditions else np.zeros(0, dtype=np.int64)
+    trialStart = np.concatenate(trialStart) if conditions else np.zeros(0, dtype=np.int64)
+    trialEnd = trialStart + np.array([chunkFrameDurs[conditions[c]] for c in trialCond], dtype=np.int64)
+
+    means = dict((cond, np.zeros((chunkFrameDurs[cond],) + frameShape, dtype=np.float64)) for cond in conditions)
+    counts = dict((cond, np.zeros(chunkFrameDurs[cond], dtype=np.int64)) for cond in conditions)
+    if isReturnSEM:
+        m2s = dict((cond, np.zeros((chunkFrameDurs[cond],) + frameShape, dtype=np.float64)) for cond in conditions)
+
+    if len(trialStart) > 0:
+        readStart = int(np.amin(trialStart))
+        readEnd = int(np.amax(trialEnd))
 
-    if isReturnN:
-        return sumMov.astype(np.float32) / n, int(n)
+        if verbose:
+            print('Averaging ' + str(len(conditions)) + ' condition(s), ' + str(len(trialStart)) + ' chunk(s), from ' +
+                  'frame ' + str(readStart) + ' to frame ' + str(readEnd) + '.')
+
+        for i in range(readStart, readEnd, loadingFrameNum):
+            chunkStart = i
+            chunkEnd = min(i + loadingFrameNum, readEnd)
+            currMov = np.asarray(mov[chunkStart:chunkEnd], dtype=np.float64)
+
+            if verbose:
+                print('\t' + str(int((chunkStart - readStart) * 100. / (readEnd - readStart))) + ' %')
+
+            for trialInd in np.where((trialStart < chunkEnd) & (trialEnd > chunkStart))[0]:
+                cond = conditions[trialCond[trialInd]]
+                frameStart = max(trialStart[trialInd], chunkStart)
+                frameEnd = min(trialEnd[trialInd], chunkEnd)
+                aveStart = frameStart - trialStart[trialInd]
+                aveEnd = frameEnd - trialStart[trialInd]
+
+                # Welford's update, for the mean only this is the same as averaging the sum
+                currFrames = currMov[frameStart - chunkStart:frameEnd - chunkStart]
+                currMean = means[cond][aveStart:aveEnd]
+                counts[cond][aveStart:aveEnd] += 1
+                currCount = counts[cond][aveStart:aveEnd].reshape((-1,) + (1,) * len(frameShape))
+                delta = currFrames - currMean
+                currMean += delta / currCount
+                if isReturnSEM:
+                    m2s[cond][aveStart:aveEnd] += delta * (currFrames - currMean)
+
+    aveMovs = {}
+    ns = {}
+    sems = {}
+    for cond in conditions:
+        n = int(np.amax(counts[cond])) if len(counts[cond]) > 0 else 0
+        if n == 0:
+            print('\nNo valid chunk found for condition: ' + str(cond) + '!')
+        aveMovs.update({cond: means[cond].astype(np.float32)})
+        ns.update({cond: n})
+        if isReturnSEM:
+            if n > 1: sems.update({cond: (np.sqrt(m2s[cond] / (n - 1)) / np.sqrt(n)).astype(np.float32)})
+            else: sems.update({cond: np.zeros(m2s[cond].shape, dtype=np.float32)})
+
+    if isReturnSEM:
+        return aveMovs, ns, sems
     else:
-        return sumMov.astype(np.float32) / n
+        return aveMovs, ns
 
 
 def get_average_movie2(mov, frameTS, onsetTimes, chunkDur, verbose=True):
@@ -1212,6 +1745,8 @@ def get_average_movie2(mov, frameTS, onsetTimes, chunkDur, verbose=True):
     sumMov = None
     real_count = 0
 
+    onsetFrameInds = get_onset_frame_indices(frameTS, onsetTimes)
+
     curr_onset = -1
     onset_num = len(onsetTimes)
     t0 = time.time()
@@ -1227,7 +1762,7 @@ def get_average_movie2(mov, frameTS, onsetTimes, chunkDur, verbose=True):
             # print 'onset number:', count, 'is before imaging start time. Exclude this onset.'
 
         else:
-            onsetFrameInd = np.argmin(np.abs(frameTS-onset))
+            onsetFrameInd = onsetFrameInds[i]
             # if verbose:
             #     print 'Chunk:',int(count),'; Starting frame index:',onsetFrameInd,'; Ending frame index', onsetFrameInd+chunkFrameDur
 
@@ -1300,8 +1835,13 @@ def regression_detrend_1d(sig, trend):
 class ROI(object):
     '''
     class of binary ROI
+
+    the ROI only stores the sorted flat (row-major) indices of its pixels in the full frame, the full frame mask is
+    only generated on demand
     '''
 
+    __slots__ = ('dimension', 'pixelIndices', 'pixelSizeX', 'pixelSizeY', 'pixelSizeUnit')
+
     def __init__(self, mask, pixelSize = None, pixelSizeUnit = None):
         '''
         :param mask: 2-d array, if not binary, non-zero and non-nan pixel will be included in mask,
@@ -1312,20 +1852,80 @@ class ROI(object):
 
         if len(mask.shape)!=2: raise ValueError('Input mask should be 2d.')
 
-        self.dimension = mask.shape
-        self.pixels = np.where(np.logical_and(mask!=0, ~np.isnan(mask)))
+        self.dimension = tuple(int(d) for d in mask.shape)
+        self.pixelIndices = np.flatnonzero(np.logical_and(mask!=0, ~np.isnan(mask)))
 
-        if pixelSize is None: self.pixelSizeX = self.pixelSizeY = pixelSize
-        elif (not hasattr(pixelSize, '__len__')): self.pixelSizeX = self.pixelSizeY = pixelSize
-        elif len(pixelSize)==2: self.pixelSizeY = pixelSize[0]; self.pixelSizeX = pixelSize[1]
-        else: raise LookupError('pixel size should be either None or scalar or list(array) of two sclars!!')
+        self.set_pixel_size(pixelSize)
 
         if self.pixelSizeY is None: self.pixelSizeUnit=None
         else: self.pixelSizeUnit = pixelSizeUnit
 
+    @staticmethod
+    def from_pixel_indices(pixelIndices, dimension, pixelSize=None, pixelSizeUnit=None):
+        '''
+        generate ROI directly from flat pixel indices without building the full frame mask
+
+        :param pixelIndices: 1d array of int, flat (row-major) indices of the pixels in the full frame
+        :param dimension: tuple of two positive ints, shape of the full frame
+        :param pixelSize: float, can be None, one value (square pixel) or (width, height) for non-square pixel
+        :param pixelSizeUnit: str, the unit of pixel size
+        '''
+        roi = ROI.__new__(ROI)
+        roi._set_pixel_indices(pixelIndices, dimension)
+        roi.set_pixel_size(pixelSize)
+        if roi.pixelSizeY is None: roi.pixelSizeUnit = None
+        else: roi.pixelSizeUnit = pixelSizeUnit
+        return roi
+
+    def _set_pixel_indices(self, pixelIndices, dimension):
+        '''
+        set dimension and sorted flat pixel indices, return the sorting order of the input indices
+        '''
+        dimension = tuple(int(d) for d in dimension)
+        if len(dimension) != 2: raise ValueError('dimension should have two elements.')
+
+        pixelIndices = np.asarray(pixelIndices, dtype=np.int64).flatten()
+        order = np.argsort(pixelIndices, kind='mergesort')
+        pixelIndices = pixelIndices[order]
+        if len(pixelIndices) > 0:
+            if pixelIndices[0] < 0 or pixelIndices[-1] >= dimension[0] * dimension[1]:
+                raise ValueError('pixel indices out of the range of dimension!')
+            if np.any(np.diff(pixelIndices) == 0):
+                raise ValueError('pixel indices should be unique!')
+
+        self.dimension = dimension
+        self.pixelIndices = pixelIndices
+        return order
+
+    def __setstate__(self, state):
+        '''
+        restore ROI from pickle, also accepts the __dict__ state of ROIs pickled before the flat pixel index storage,
+        in which the pixels are saved as 'pixels' (row indices, column indices) instead of 'pixelIndices'
+        '''
+        if isinstance(state, tuple):
+            dictState, slotState = state
+            state = dict(dictState or {})
+            state.update(slotState or {})
+        else: state = dict(state)
+
+        if 'pixels' in state:
+            dimension = tuple(int(d) for d in state.pop('dimension'))
+            pixels = tuple(np.asarray(p, dtype=np.int64).flatten() for p in state.pop('pixels'))
+            order = self._set_pixel_indices(np.ravel_multi_index(pixels, dimension), dimension)
+            if 'weights' in state: state['weights'] = np.asarray(state['weights']).flatten()[order]
+
+        for key, value in state.items(): setattr(self, key, value)
+
     def __str__(self):
         return 'corticalmapping.core.ImageAnalysis.ROI object'
 
+    @property
+    def pixels(self):
+        '''
+        index list of the pixels in the ROI, (row indices, column indices), same as the output of np.where
+        '''
+        return np.unravel_index(self.pixelIndices, self.dimension)
+
     def set_pixel_size(self, pixelSize):
         if pixelSize is None: self.pixelSizeX = self.pixelSizeY = pixelSize
         elif (not hasattr(pixelSize, '__len__')): self.pixelSizeX = self.pixelSizeY = pixelSize
@@ -1388,16 +1988,16 @@ class ROI(object):
 
         if (self.pixelSizeX is not None) and (self.pixelSizeX is not None):
             print('returning area with unit:' + self.pixelSizeUnit + '^2')
-            return float(len(self.pixels[0]))*self.pixelSizeX*self.pixelSizeY
+            return float(len(self.pixelIndices))*self.pixelSizeX*self.pixelSizeY
         else:
             print('returning area as pixel counts without unit.')
-            return len(self.pixels[0])
+            return len(self.pixelIndices)
 
     def get_binary_area(self):
         '''
         :return: number of pixels in the roi
         '''
-        return len(self.pixels[0])
+        return len(self.pixelIndices)
 
     def get_center(self):
         '''
@@ -1405,13 +2005,22 @@ class ROI(object):
         '''
         return np.mean(np.array(self.pixels,dtype=np.float).transpose(),axis=0)
 
+    def get_pixel_traces(self, mov):
+        '''
+        :param mov: 3d array, frame x row x col
+        :return: 2d array, frame x pixel, traces of all pixels in the roi, pixels are in the order of self.pixelIndices
+        '''
+        mov = np.asarray(mov)
+        if mov.shape[1:] != self.dimension:
+            raise ValueError('the frame shape of input movie is different from roi dimension!')
+        return mov.reshape((mov.shape[0], -1))[:, self.pixelIndices]
+
     def get_binary_trace(self, mov):
         '''
         return trace of this ROI (binary format, 0s and 1s) in a given movie
         '''
-        binaryMask = self.get_binary_mask().astype(np.float32)
-        trace = np.multiply(mov, np.array([binaryMask])).sum(axis=1).sum(axis=1)
-        # print trace
+        pixelTraces = self.get_pixel_traces(mov)
+        trace = np.sum(pixelTraces, axis=1, dtype=np.result_type(pixelTraces.dtype, np.float32))
         return trace / self.get_binary_area()
 
     def get_binary_trace_pixelwise(self, mov):
@@ -1441,7 +2050,7 @@ class ROI(object):
 
     def to_h5_group(self, h5Group):
         '''
-        add attributes and dataset to a h5 data group
+        add attributes and dataset to a h5 data group, only flat pixel indices (and weights) are saved
         '''
         h5Group.attrs['dimension'] = self.dimension
         h5Group.attrs['description'] = str(self)
@@ -1450,12 +2059,22 @@ class ROI(object):
         if self.pixelSizeUnit is None: h5Group.attrs['pixelSizeUnit'] = 'None'
         else: h5Group.attrs['pixelSizeUnit'] = self.pixelSizeUnit
 
-        dataDict = dict(self.__dict__)
-        _ = dataDict.pop('dimension');_ = dataDict.pop('pixelSizeX');_ = dataDict.pop('pixelSizeY');_ = dataDict.pop('pixelSizeUnit')
+        if self.dimension[0] * self.dimension[1] <= np.iinfo(np.uint32).max: indexDtype = np.uint32
+        else: indexDtype = np.uint64
+        h5Group.create_dataset('pixelIndices', data=self.pixelIndices.astype(indexDtype))
+
+        dataDict = self._get_extra_data()
         for key, value in dataDict.items():
             if value is None: h5Group.create_dataset(key,data='None')
             else: h5Group.create_dataset(key,data=value)
 
+    def _get_extra_data(self):
+        '''
+        :return: dictionary of data to be saved by to_h5_group other than dimension, pixel indices and pixel size,
+                 including attributes defined by subclasses
+        '''
+        return dict(getattr(self, '__dict__', {}))
+
     def binary_overlap(self, roi):
         """
         :param roi: another ROI object, should have same dimension as self
@@ -1464,10 +2083,27 @@ class ROI(object):
         if roi.dimension != self.dimension:
             raise ValueError('the dimensions of input roi are different from self dimensions!')
 
-        pixel_list = list(self.get_pixel_list()) + list(roi.get_pixel_list())
-        pixel_tuple = tuple([tuple(p) for p in pixel_list])
-        pixel_set = set(pixel_tuple)
-        return len(pixel_tuple) - len(pixel_set)
+        return len(np.intersect1d(self.pixelIndices, roi.pixelIndices, assume_unique=True))
+
+    @staticmethod
+    def _read_h5_group(h5Group):
+        '''
+        read dimension, pixel size, pixel size unit and flat pixel indices from a hdf5 data group, supports both the
+        flat index format and the older (row indices, column indices) format
+        '''
+        dimension = tuple(h5Group.attrs['dimension'])
+        pixelSize = h5Group.attrs['pixelSize']
+        if isinstance(pixelSize, (str, bytes)) and pixelSize in ('None', b'None'): pixelSize = None
+        pixelSizeUnit = h5Group.attrs['pixelSizeUnit']
+        if isinstance(pixelSizeUnit, (str, bytes)) and pixelSizeUnit in ('None', b'None'): pixelSizeUnit = None
+
+        if 'pixelIndices' in list(h5Group.keys()):
+            pixelIndices = h5Group['pixelIndices'][()].astype(np.int64)
+        else:
+            pixels = h5Group['pixels'][()]
+            pixelIndices = np.ravel_multi_index(tuple(np.asarray(pixels, dtype=np.int64)), dimension)
+
+        return dimension, pixelSize, pixelSizeUnit, pixelIndices
 
     @staticmethod
     def from_h5_group(h5Group):
@@ -1475,29 +2111,46 @@ class ROI(object):
         load ROI (either ROI or WeightedROI) object from a hdf5 data group
         '''
 
-        dimension = h5Group.attrs['dimension']
-        pixelSize = h5Group.attrs['pixelSize']
-        if pixelSize == 'None': pixelSize = None
-        pixelSizeUnit = h5Group.attrs['pixelSizeUnit']
-        if pixelSizeUnit is 'None': pixelSizeUnit = None
-        pixels = h5Group['pixels'].value
+        dimension, pixelSize, pixelSizeUnit, pixelIndices = ROI._read_h5_group(h5Group)
 
         if 'weights' in list(h5Group.keys()):
-            weights = h5Group['weights'].value
-            mask = np.zeros(dimension, dtype=np.float32);
-            mask[tuple(pixels)] = weights
-            return WeightedROI(mask, pixelSize=pixelSize, pixelSizeUnit=pixelSizeUnit)
+            weights = h5Group['weights'][()]
+            return WeightedROI.from_pixel_indices(pixelIndices, weights, dimension, pixelSize=pixelSize,
+                                                  pixelSizeUnit=pixelSizeUnit)
         else:
-            mask = np.zeros(dimension, dtype=np.uint8);
-            mask[tuple(pixels)] = 1
-            return ROI(mask, pixelSize=pixelSize, pixelSizeUnit=pixelSizeUnit)
+            return ROI.from_pixel_indices(pixelIndices, dimension, pixelSize=pixelSize, pixelSizeUnit=pixelSizeUnit)
 
 
 class WeightedROI(ROI):
 
+    __slots__ = ('weights',)
+
     def __init__(self, mask, pixelSize = None, pixelSizeUnit = None):
         super(WeightedROI,self).__init__(mask, pixelSize = pixelSize, pixelSizeUnit = pixelSizeUnit)
-        self.weights = mask[self.pixels]
+        self.weights = mask.flat[self.pixelIndices]
+
+    @staticmethod
+    def from_pixel_indices(pixelIndices, weights, dimension, pixelSize=None, pixelSizeUnit=None):
+        '''
+        generate WeightedROI directly from flat pixel indices and weights without building the full frame mask
+
+        :param pixelIndices: 1d array of int, flat (row-major) indices of the pixels in the full frame
+        :param weights: 1d array, weights of each pixel in pixelIndices, same length as pixelIndices
+        :param dimension: tuple of two positive ints, shape of the full frame
+        :param pixelSize: float, can be None, one value (square pixel) or (width, height) for non-square pixel
+        :param pixelSizeUnit: str, the unit of pixel size
+        '''
+        weights = np.asarray(weights).flatten()
+        if len(weights) != np.asarray(pixelIndices).size:
+            raise ValueError('the length of weights should be the same as the length of pixel indices!')
+
+        roi = ROI.__new__(WeightedROI)
+        order = roi._set_pixel_indices(pixelIndices, dimension)
+        roi.weights = weights[order]
+        roi.set_pixel_size(pixelSize)
+        if roi.pixelSizeY is None: roi.pixelSizeUnit = None
+        else: roi.pixelSizeUnit = pixelSizeUnit
+        return roi
 
     def __str__(self):
         return 'corticalmapping.core.ImageAnalysis.WeightedROI object, subclass of ' \
@@ -1561,8 +2214,9 @@ class WeightedROI(ROI):
         :param is_area_weighted: bool, if False, total area of the mask is calculated in a binary fashion
                                        if True, total area of mask is calculated in a weighted fashion
         '''
-        weightedMask = self.get_weighted_mask()
-        trace = np.multiply(mov, np.array([weightedMask])).sum(axis=-1).sum(axis=-1)
+        pixelTraces = self.get_pixel_traces(mov)
+        dtype = np.result_type(pixelTraces.dtype, np.float32)
+        trace = np.dot(pixelTraces.astype(dtype), self.weights.astype(dtype))
         # print trace
         if is_area_weighted:
             return trace / self.get_binary_area()
@@ -1591,22 +2245,93 @@ class WeightedROI(ROI):
         else:
             raise ValueError('is_area_weighted should be a boolean variable.')
 
+    def _get_extra_data(self):
+        dataDict = super(WeightedROI, self)._get_extra_data()
+        dataDict['weights'] = self.weights
+        return dataDict
+
     @staticmethod
     def from_h5_group(h5Group):
         '''
         load WeightedROI (either ROI or WeightedROI) object from a hdf5 data group
         '''
 
-        dimension = h5Group.attrs['dimension']
-        pixelSize = h5Group.attrs['pixelSize']
-        if pixelSize == 'None': pixelSize = None
-        pixelSizeUnit = h5Group.attrs['pixelSizeUnit']
-        if pixelSizeUnit == 'None': pixelSizeUnit = None
-        pixels = h5Group['pixels'].value
-        weights = h5Group['weights'].value
-        mask = np.zeros(dimension, dtype=np.float32)
-        mask[tuple(pixels)] = weights
-        return WeightedROI(mask, pixelSize=pixelSize, pixelSizeUnit=pixelSizeUnit)
+        dimension, pixelSize, pixelSizeUnit, pixelIndices = ROI._read_h5_group(h5Group)
+        weights = h5Group['weights'][()]
+        return WeightedROI.from_pixel_indices(pixelIndices, weights, dimension, pixelSize=pixelSize,
+                                              pixelSizeUnit=pixelSizeUnit)
+
+
+class CompactMask(object):
+    '''
+    compact representation of a binary mask: the bounding box of the mask in the full frame and the binary mask
+    within the bounding box. The full frame mask is only generated on demand (get_binary_mask, or np.array(mask)).
+    '''
+
+    def __init__(self, localMask, boundingBox, dimension):
+        '''
+        :param localMask: 2d array, binary mask within the bounding box
+        :param boundingBox: tuple of two slices, bounding box in the full frame (output of scipy.ndimage.find_objects)
+        :param dimension: tuple of two positive ints, shape of the full frame
+        '''
+
+        localMask = np.asarray(localMask).astype(np.bool_)
+        if len(localMask.shape) != 2: raise ValueError('Input local mask should be 2d.')
+
+        boundingBox = tuple(slice(*currSlice.indices(currLength)[0:2]) for currSlice, currLength
+                            in zip(boundingBox, dimension))
+        if localMask.shape != tuple(currSlice.stop - currSlice.start for currSlice in boundingBox):
+            raise ValueError('the shape of local mask should match the size of bounding box.')
+
+        self.localMask = localMask
+        self.boundingBox = boundingBox
+        self.dimension = tuple(dimension)
+
+    def __str__(self):
+        return 'corticalmapping.core.ImageAnalysis.CompactMask object'
+
+    @property
+    def shape(self):
+        return self.dimension
+
+    def __array__(self, dtype=None):
+        if dtype is None: return self.get_binary_mask()
+        else: return self.get_binary_mask().astype(dtype)
+
+    def get_area(self):
+        return int(np.sum(self.localMask))
+
+    def get_indices(self):
+        '''
+        :return: index list of the pixels in the full frame, (row indices, column indices)
+        '''
+        rows, cols = np.where(self.localMask)
+        return rows + self.boundingBox[0].start, cols + self.boundingBox[1].start
+
+    def get_binary_mask(self):
+        '''
+        generate full frame binary mask, return 2d array, with 0s and 1s, dtype np.uint8
+        '''
+        mask = np.zeros(self.dimension, dtype=np.uint8)
+        mask[self.boundingBox][self.localMask] = 1
+        return mask
+
+    def get_local_mask(self, padding=0):
+        '''
+        get the binary mask within the bounding box extended by padding pixels on each side (cut at the frame edges)
+
+        :param padding: non-negative int
+        :return: localMask, 2d array, dtype np.bool_
+                 boundingBox, tuple of two slices, the extended bounding box in the full frame
+        '''
+        if padding < 0: raise ValueError('padding should not be negative.')
+        boundingBox = tuple(slice(max(currSlice.start - padding, 0), min(currSlice.stop + padding, currLength))
+                            for currSlice, currLength in zip(self.boundingBox, self.dimension))
+        localMask = np.zeros([currSlice.stop - currSlice.start for currSlice in boundingBox], dtype=np.bool_)
+        localMask[self.boundingBox[0].start - boundingBox[0].start:self.boundingBox[0].stop - boundingBox[0].start,
+                  self.boundingBox[1].start - boundingBox[1].start:self.boundingBox[1].stop - boundingBox[1].start] = \
+            self.localMask
+        return localMask, boundingBox
 
 
 if __name__ == '__main__':
@@ -202,16 +202,13 @@ def show_movie(path,  # tif file path or numpy arrary of the movie
 
     if mode == 'raw':
         mov = rawMov
+    elif mode == 'dF' or mode == 'dFoverF':
+        _, mov = ia.normalize_movie_chunked(rawMov,
+                                            baselinePic=baselinePic,
+                                            baselineType=baselineType,
+                                            outputType=mode)
     else:
-        _, dFMov, dFoverFMov = ia.normalize_movie(rawMov,
-                                                  baselinePic=baselinePic,
-                                                  baselineType=baselineType)
-        if mode == 'dF':
-            mov = dFMov
-        elif mode == 'dFoverF':
-            mov = dFoverFMov
-        else:
-            raise LookupError('The "mode" should be "raw", "dF" or "dFoverF"!')
+        raise LookupError('The "mode" should be "raw", "dF" or "dFoverF"!')
 
     if isinstance(path, str):
         tf.imshow(mov,
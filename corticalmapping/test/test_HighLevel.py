@@ -0,0 +1,121 @@
+__author__ = 'junz'
+
+import os
+import io
+import json
+import shutil
+import tempfile
+import contextlib
+import h5py
+from unittest import mock
+import numpy as np
+import scipy.ndimage as ni
+import scipy.stats as stats
+import corticalmapping.core.ImageAnalysis as ia
+import corticalmapping.core.FileTools as ft
+import corticalmapping.HighLevel as hl
+import unittest
+
+
+def regression_detrend_loop(mov, roi):
+    '''
+    per-pixel linregress against the global trend, reference of hl.regression_detrend
+    '''
+    trend = ia.WeightedROI(roi).get_weighted_trace(mov)
+    mov_new = np.empty(mov.shape, dtype=np.float32)
+    slopes = np.empty((mov.shape[1], mov.shape[2]), dtype=np.float32)
+    rvalues = np.empty((mov.shape[1], mov.shape[2]), dtype=np.float32)
+    for i in range(mov.shape[1]):
+        for j in range(mov.shape[2]):
+            slope, _, r_value, _, _ = stats.linregress(trend, mov[:, i, j])
+            slopes[i, j] = slope
+            rvalues[i, j] = r_value
+            mov_new[:, i, j] = mov[:, i, j] - trend * slope
+    return mov_new, trend, slopes, rvalues
+
+
+class TestHighLevel(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpFolder = tempfile.mkdtemp()
+
+        # smooth movie with values in [0, 100]
+        mov = ni.gaussian_filter(np.random.RandomState(0).rand(7, 64, 64), (0, 3, 3))
+        self.mov = ((mov - np.amin(mov)) / (np.amax(mov) - np.amin(mov)) * 100.).astype(np.float32)
+        self.inputPath = os.path.join(self.tmpFolder, 'input.npy')
+        np.save(self.inputPath, self.mov)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpFolder)
+
+    def saveParams(self, zoom, rotation):
+        parameterPath = os.path.join(self.tmpFolder, 'params.json')
+        with open(parameterPath, 'w') as f:
+            json.dump({'Xoffset': 6, 'Yoffset': -4, 'ReferenceMapHeight': 120, 'ReferenceMapWidth': 120,
+                       'Zoom': zoom, 'Rotation': rotation}, f)
+        return parameterPath
+
+    def test_translateHugeMovieByVasculature(self):
+        outputPath = os.path.join(self.tmpFolder, 'output.npy')
+
+        for zoom, rotation, referenceDecimation in [(1., 0., 2), (1.2, 10., 2), (0.9, -20., 1)]:
+            parameterPath = self.saveParams(zoom, rotation)
+            movT = hl.translateMovieByVasculature(self.mov, parameterPath, matchingDecimation=2,
+                                                  referenceDecimation=referenceDecimation, verbose=False)
+            hl.translateHugeMovieByVasculature(self.inputPath, outputPath, parameterPath, matchingDecimation=2,
+                                               referenceDecimation=referenceDecimation, chunkLength=3, verbose=False,
+                                               threadNum=2)
+            movHugeT = np.load(outputPath)
+            assert(movHugeT.shape == movT.shape)
+            assert(movHugeT.dtype == self.mov.dtype)
+
+            # the combined transformation interpolates only once and fills the pixels outside of the input frame
+            # differently, so only the pixels well inside of the input frame are compared, within 2% of the range
+            footprint = hl.translateMovieByVasculature(np.ones(self.mov.shape[1:], dtype=np.float32), parameterPath,
+                                                       matchingDecimation=2, referenceDecimation=referenceDecimation,
+                                                       verbose=False)
+            isInside = ni.binary_erosion(footprint > 0.999, iterations=2)
+            assert(np.sum(isInside) > 0)
+            assert(np.amax(np.abs(movHugeT[:, isInside] - movT[:, isInside])) < 2.)
+
+    def test_regression_detrend(self):
+        rng = np.random.RandomState(1)
+        global_signal = np.cumsum(rng.randn(50))
+        mov = 1000. + global_signal[:, None, None] * rng.rand(6, 7) + rng.randn(50, 6, 7)
+        mov = mov.astype(np.float32)
+        roi = np.zeros((6, 7)); roi[1:4, 2:5] = 1.; roi[2, 3] = 2.
+
+        mov_new0, trend0, slopes0, rvalues0 = regression_detrend_loop(mov, roi)
+        for chunk_size in [7, 1000]:
+            mov_new, trend, slopes, rvalues = hl.regression_detrend(mov, roi, verbose=False, chunk_size=chunk_size)
+            assert(mov_new.dtype == np.float32 and slopes.dtype == np.float32 and rvalues.dtype == np.float32)
+            assert(np.allclose(trend, trend0, rtol=1e-6))
+            assert(np.allclose(slopes, slopes0, atol=1e-4))
+            assert(np.allclose(rvalues, rvalues0, atol=1e-4))
+            # the trend is around 1000, so the float32 rounding of the slopes is amplified in the detrended movie
+            assert(np.allclose(mov_new, mov_new0, rtol=0., atol=5e-2))
+
+        with h5py.File(os.path.join(self.tmpFolder, 'movie.hdf5'), 'w') as f:
+            dset = f.create_dataset('movie', data=mov)
+            mov_new1, _, slopes1, _ = hl.regression_detrend(dset, roi, verbose=False, chunk_size=7)
+        assert(np.allclose(mov_new1, mov_new, rtol=0., atol=1e-3) and np.allclose(slopes1, slopes))
+
+    def test_translateHugeMovieByVasculature_chunkLength(self):
+        parameterPath = self.saveParams(1.2, 10.)
+        outputPath = os.path.join(self.tmpFolder, 'output.npy')
+        hl.translateHugeMovieByVasculature(self.inputPath, outputPath, parameterPath, chunkLength=3, verbose=False)
+        movT = np.load(outputPath)
+
+        # the automatic chunk length should be at least one frame even if the available memory is tiny
+        for availableMemory, chunkLength in [(1, 1), (None, 4), (10 ** 12, 4)]:
+            stdout = io.StringIO()
+            with mock.patch.object(ft, 'get_available_memory', return_value=availableMemory), \
+                    contextlib.redirect_stdout(stdout):
+                hl.translateHugeMovieByVasculature(self.inputPath, outputPath, parameterPath, verbose=True,
+                                                   threadNum=2)
+            assert(' x ' + str(chunkLength) + ' frame(s)' in stdout.getvalue())
+            assert(np.array_equal(np.load(outputPath), movT))
+
+
+if __name__ == "__main__":
+    unittest.main()
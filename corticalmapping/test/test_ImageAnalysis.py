@@ -1,10 +1,78 @@
 __author__ = 'junz'
 
+import os
+import copyreg
+import pickle
+import shutil
+import tempfile
+import threading
+import h5py
 import numpy as np
+import scipy.ndimage as ni
 import corticalmapping.core.ImageAnalysis as ia
+import corticalmapping.core.FileTools as ft
 import unittest
 
 
+def temporal_filter_movie_loop(mov, Fs, Flow, Fhigh, mode='box'):
+    '''
+    full complex fft with a per-pixel filtering loop, reference of ia.temporal_filter_movie
+    '''
+    frameNum = mov.shape[0]
+    freqs = np.fft.fftfreq(frameNum, d=(1. / float(Fs)))
+    filterArray = np.ones(frameNum)
+    for i in range(frameNum):
+        if ((freqs[i] > 0) and (freqs[i] < Flow) or (freqs[i] > Fhigh)) or \
+           ((freqs[i] < 0) and (freqs[i] > -Flow) or (freqs[i] < -Fhigh)):
+            filterArray[i] = 0
+    if mode == '1/f':
+        filterArray[1:] = filterArray[1:] / abs(freqs[1:])
+        filterArray[0] = 0
+        filterArray = (filterArray - np.amin(filterArray)) / (np.amax(filterArray) - np.amin(filterArray))
+    elif mode == 'box':
+        filterArray[0] = 0
+    if Flow == 0:
+        filterArray[0] = 1
+    movFFT = np.fft.fft(mov, axis=0)
+    for i in range(mov.shape[1]):
+        for j in range(mov.shape[2]):
+            movFFT[:, i, j] = movFFT[:, i, j] * filterArray
+    return np.real(np.fft.ifft(movFFT, axis=0))
+
+
+def boxcartime_dff_loop(data, window, fs):
+    '''
+    per-pixel fftconvolve boxcar average, reference of ia.boxcartime_dff (only for even window length in frames)
+    '''
+    import scipy.signal as sig
+    win = int(np.ceil(float(window) / (float(fs) / 1000.)))
+    kernal = np.ones(win, dtype=('float'))
+    padsize = data.shape[0] + win * 2
+    mov_pad = np.zeros([padsize], dtype=('float'))
+    mov_dff = np.zeros([data.shape[0] - win, data.shape[1], data.shape[2]])
+    for y in range(data.shape[1]):
+        for x in range(data.shape[2]):
+            mov_pad[win:(padsize - win)] = data[:, y, x]
+            mov_ave = sig.fftconvolve(mov_pad, kernal) / win
+            mov_ave = mov_ave[win * 2:1 + mov_ave.shape[0] - win * 2]
+            mov_dff[:, y, x] = (data[(win // 2):data.shape[0] - (win // 2), y, x] - mov_ave) / mov_ave
+    return mov_dff
+
+
+def get_average_movie_loop(mov, frameTS, onsetTimes, chunkDur):
+    '''
+    sum of chunks found by argmin for each onset, reference of ia.get_average_movies
+    '''
+    chunkFrameDur = int(np.ceil(chunkDur / np.mean(np.diff(frameTS))))
+    chunks = []
+    for onset in onsetTimes:
+        if onset >= frameTS[0] and onset + chunkDur <= frameTS[-1]:
+            onsetFrameInd = int(np.argmin(np.abs(frameTS - onset)))
+            if onsetFrameInd + chunkFrameDur <= mov.shape[0]:
+                chunks.append(mov[onsetFrameInd:onsetFrameInd + chunkFrameDur, :, :].astype(np.float64))
+    return np.array(chunks)
+
+
 class TestImageAnalysis(unittest.TestCase):
 
     def setup(self):
@@ -31,6 +99,241 @@ class TestImageAnalysis(unittest.TestCase):
         assert(trace4[2] == 58)
 
 
+    def test_get_traces_batch(self):
+        mov = np.random.rand(25, 6, 7)
+        mask1 = np.zeros((6, 7)); mask1[2, 2] = 1; mask1[1, 1] = 1
+        mask2 = np.zeros((6, 7)); mask2[3:5, 2:6] = 2.; mask2[3, 3] = 0.5
+        traces = ia.get_traces_batch(mov, {'roi1': mask1, 'roi2': mask2},
+                                     mask_mode={'roi1': 'binary', 'roi2': 'weighted'}, loading_frame_num=10)
+        assert(np.allclose(traces['trace_roi1'], ia.get_trace(mov, mask1, maskMode='binary')))
+        assert(np.allclose(traces['trace_roi2'], ia.get_trace(mov, mask2, maskMode='weighted')))
+
+    def test_ChunkReader(self):
+        mov = np.random.rand(23, 6, 7)
+        tmpFolder = tempfile.mkdtemp()
+        try:
+            with h5py.File(os.path.join(tmpFolder, 'movie.hdf5'), 'w') as f:
+                dset = f.create_dataset('movie', data=mov)
+                for array_like in [mov, dset]:
+                    for chunk_length in [1, 5, 23, 100]:
+                        chunks = list(ft.ChunkReader(array_like, chunk_length=chunk_length, dtype=np.float32,
+                                                     prefetch_num=1, spatial_slice=(slice(1, 4), slice(2, 7))))
+                        assert([(start, end) for start, end, _ in chunks] ==
+                               [(start, min(start + chunk_length, 23)) for start in range(0, 23, chunk_length)])
+                        for start, end, chunk in chunks:
+                            assert(chunk.dtype == np.float32)
+                            assert(np.array_equal(chunk, mov[start:end, 1:4, 2:7].astype(np.float32)))
+        finally:
+            shutil.rmtree(tmpFolder)
+
+    def test_ChunkReader_stop(self):
+        mov = np.random.rand(50, 3, 3)
+        thread_num = threading.active_count()
+
+        # the reader thread blocked on a full queue should exit when the iteration stops early
+        for chunk_start, _, _ in ft.ChunkReader(mov, chunk_length=2, prefetch_num=1):
+            if chunk_start >= 4: break
+        assert(threading.active_count() == thread_num)
+
+        # exceptions in the reader thread are raised in the consumer and the reader thread exits
+        self.assertRaises(IndexError, list, ft.ChunkReader(mov, chunk_length=2, spatial_slice=(0, 0, 0)))
+        assert(threading.active_count() == thread_num)
+
+    def test_get_trace_binaryslicer(self):
+        mov = np.random.rand(25, 6, 7)
+        mask1 = np.zeros((6, 7)); mask1[2, 2] = 1; mask1[1, 1] = 1
+        mask2 = np.zeros((6, 7)); mask2[3:5, 2:6] = 2.; mask2[3, 3] = 0.5
+        for mask_mode in ['weighted', 'binary']:
+            if mask_mode == 'binary':
+                mask1, mask2 = (mask1 > 0).astype(np.float64), (mask2 > 0).astype(np.float64)
+            for mask in [mask1, mask2]:
+                trace = ia.get_trace(mov, mask, maskMode=mask_mode)
+                assert(np.allclose(ia.get_trace_binaryslicer(mov, mask, mask_mode=mask_mode, loading_frame_num=7),
+                                   trace))
+                assert(np.allclose(ia.get_trace_binaryslicer2(mov, mask, mask_mode=mask_mode, loading_frame_num=7),
+                                   trace))
+            traces = ia.get_trace_binaryslicer3(mov, {'roi1': mask1, 'roi2': mask2}, mask_mode=mask_mode,
+                                                loading_frame_num=7)
+            assert(np.allclose(traces['trace_roi1'], ia.get_trace(mov, mask1, maskMode=mask_mode)))
+            assert(np.allclose(traces['trace_roi2'], ia.get_trace(mov, mask2, maskMode=mask_mode)))
+
+    def test_get_traces_from_mask_matrix(self):
+        mov = np.random.rand(25, 6, 7)
+        masks = {}
+        for i in range(5):
+            mask = np.zeros((6, 7))
+            mask[np.random.rand(6, 7) > 0.7] = np.random.rand() + 0.5
+            mask[i, i] = 1.
+            masks.update({'roi' + str(i): mask})
+        for mask_mode in ['weighted', 'binary']:
+            if mask_mode == 'binary':
+                masks = dict((key, (mask > 0).astype(np.float64)) for key, mask in masks.items())
+            keys, mask_matrix = ia.get_mask_matrix(masks, mask_mode=mask_mode)
+            traces = ia.get_traces_from_mask_matrix(mov, mask_matrix)
+            assert(traces.shape == (5, 25))
+            for i, key in enumerate(keys):
+                assert(np.allclose(traces[i], ia.get_trace(mov, masks[key], maskMode=mask_mode)))
+
+    def test_temporal_filter_movie(self):
+        for frameNum in [40, 41]:
+            mov = np.random.rand(frameNum, 5, 6)
+            for mode in ['box', '1/f']:
+                for Flow, Fhigh in [(0., 3.), (0.5, 3.), (1., 100.)]:
+                    movF = temporal_filter_movie_loop(mov, 10., Flow, Fhigh, mode=mode)
+                    movF64 = ia.temporal_filter_movie(mov, 10., Flow, Fhigh, mode=mode, dtype=np.float64,
+                                                      pixelBlockSize=7)
+                    assert(movF64.dtype == np.float64)
+                    assert(np.allclose(movF64, movF, rtol=0., atol=1e-12))
+                    movF32 = ia.temporal_filter_movie(mov, 10., Flow, Fhigh, mode=mode)
+                    assert(movF32.dtype == np.float32)
+                    assert(np.allclose(movF32, movF, rtol=0., atol=1e-5))
+
+    def test_temporal_filter_movie_output(self):
+        mov = np.random.rand(40, 5, 6)
+        movF = temporal_filter_movie_loop(mov, 10., 0.5, 3.)
+        tmpFolder = tempfile.mkdtemp()
+        try:
+            with h5py.File(os.path.join(tmpFolder, 'movie.hdf5'), 'w') as f:
+                dset = f.create_dataset('movie', data=mov)
+                output = f.create_dataset('movie_filtered', shape=mov.shape, dtype=np.float64)
+                ia.temporal_filter_movie(dset, 10., 0.5, 3., dtype=np.float64, pixelBlockSize=12, output=output)
+                assert(np.allclose(output[()], movF, rtol=0., atol=1e-12))
+        finally:
+            shutil.rmtree(tmpFolder)
+
+    def test_boxcartime_dff(self):
+        data = np.random.rand(30, 5, 6) + 1.
+
+        # exposure 125 ms, windows of 4 and 8 frames
+        for window in [0.5, 1.]:
+            dff = ia.boxcartime_dff(data, window, 125., pixelBlockSize=7)
+            assert(np.allclose(dff, boxcartime_dff_loop(data, window, 125.)))
+
+        # odd window length (3 frames), frame i + 1 is normalized by the mean of frames [i + 1, i + 3]
+        dff = ia.boxcartime_dff(data, 0.375, 125.)
+        assert(dff.shape == (27, 5, 6))
+        for i in range(27):
+            baseline = np.mean(data[i + 1:i + 4], axis=0)
+            assert(np.allclose(dff[i], (data[i + 1] - baseline) / baseline))
+
+        output = np.zeros((22, 5, 6), dtype=np.float32)
+        assert(ia.boxcartime_dff(data, 1., 125., output=output) is output)
+        assert(np.allclose(output, boxcartime_dff_loop(data, 1., 125.), atol=1e-6))
+
+    def test_get_onset_frame_indices(self):
+        frameTS = np.arange(20) * 0.5 + 3.
+        # onsets at frames, half way between frames (ties) and outside of the movie
+        onsetTimes = np.concatenate((frameTS, frameTS + 0.25, np.random.rand(20) * 14., [-1., 100.]))
+        onsetInd = ia.get_onset_frame_indices(frameTS, onsetTimes)
+        assert(np.array_equal(onsetInd, [np.argmin(np.abs(frameTS - onset)) for onset in onsetTimes]))
+
+    def test_get_average_movies(self):
+        mov = np.random.rand(60, 4, 5)
+        frameTS = np.arange(60) * 0.1 + 0.03
+        onsetTimes = {'A': np.array([0., 0.5, 1.2, 2.05, 5.5]),  # the first and last onsets are excluded
+                      'B': np.random.rand(8) * 5.,
+                      'C': np.array([3.1])}
+        chunkDurs = {'A': 0.6, 'B': 0.35, 'C': 1.}
+
+        for loadingFrameNum in [1, 7, 1000]:
+            aveMovs, ns, sems = ia.get_average_movies(mov, frameTS, onsetTimes, chunkDurs, isReturnSEM=True,
+                                                      loadingFrameNum=loadingFrameNum, verbose=False)
+            for cond in onsetTimes.keys():
+                chunks = get_average_movie_loop(mov, frameTS, onsetTimes[cond], chunkDurs[cond])
+                assert(ns[cond] == chunks.shape[0])
+                assert(aveMovs[cond].dtype == np.float32)
+                assert(np.allclose(aveMovs[cond], np.mean(chunks, axis=0), atol=1e-6))
+                if ns[cond] > 1:
+                    sem = np.std(chunks, axis=0, ddof=1) / np.sqrt(ns[cond])
+                    assert(np.allclose(sems[cond], sem, atol=1e-6))
+                else:
+                    assert(np.array_equal(sems[cond], np.zeros(chunks.shape[1:], dtype=np.float32)))
+            assert(ns['A'] == 3)
+
+        aveMov, n = ia.get_average_movie(mov, frameTS, onsetTimes['B'], chunkDurs['B'], isReturnN=True)
+        assert(np.allclose(aveMov, np.mean(get_average_movie_loop(mov, frameTS, onsetTimes['B'], chunkDurs['B']),
+                                           axis=0), atol=1e-6))
+        assert(n == ns['B'])
+
+    def test_normalize_movie_chunked(self):
+        mov = (np.random.rand(25, 6, 7) + 0.5).astype(np.float32)
+        baselinePic = np.random.rand(6, 7).astype(np.float32) + 0.5
+        for baselineType, currBaselinePic in [('mean', None), ('median', None), ('mean', baselinePic)]:
+            aveImage, dFMov, dFoverFMov = ia.normalize_movie(mov, baselinePic=currBaselinePic,
+                                                             baselineType=baselineType)
+            for outputType, normMov in [('dF', dFMov), ('dFoverF', dFoverFMov)]:
+                for chunkLength in [1, 7, 1000]:
+                    aveImage1, normMov1 = ia.normalize_movie_chunked(mov, baselinePic=currBaselinePic,
+                                                                     baselineType=baselineType, outputType=outputType,
+                                                                     chunkLength=chunkLength)
+                    assert(normMov1.dtype == np.float32)
+                    assert(np.allclose(aveImage1, aveImage, rtol=1e-6))
+                    assert(np.allclose(normMov1, normMov, rtol=1e-5, atol=1e-6))
+
+                # in-place normalization
+                movCopy = np.array(mov)
+                _, normMov2 = ia.normalize_movie_chunked(movCopy, baselinePic=currBaselinePic,
+                                                         baselineType=baselineType, outputType=outputType,
+                                                         output=movCopy, chunkLength=7)
+                assert(normMov2 is movCopy)
+                assert(np.allclose(normMov2, normMov, rtol=1e-5, atol=1e-6))
+
+        tmpFolder = tempfile.mkdtemp()
+        try:
+            with h5py.File(os.path.join(tmpFolder, 'movie.hdf5'), 'w') as f:
+                dset = f.create_dataset('movie', data=mov)
+                aveImage, _, dFoverFMov = ia.normalize_movie(mov, baselineType='median')
+                aveImage1, normMov1 = ia.normalize_movie_chunked(dset, baselineType='median', chunkLength=7)
+                assert(np.array_equal(aveImage1, aveImage))
+                assert(np.allclose(normMov1, dFoverFMov, rtol=1e-5, atol=1e-6))
+        finally:
+            shutil.rmtree(tmpFolder)
+
+    def test_get_masks_compact(self):
+        labeled = np.zeros((10, 12), dtype=np.int32)
+        labeled[1:3, 2:6] = 1
+        labeled[5:9, 7:10] = 2
+        labeled[6, 1] = 3
+        masks = ia.get_masks(labeled, minArea=2, labelLength=2)
+        compact_masks = ia.get_masks(labeled, minArea=2, labelLength=2, isCompact=True)
+        assert(list(masks.keys()) == list(compact_masks.keys()) == ['00', '01'])
+        for key, mask in masks.items():
+            assert(np.array_equal(mask, compact_masks[key].get_binary_mask()))
+        assert(compact_masks['00'].get_area() == 12)
+        assert(compact_masks['00'].localMask.shape == (4, 3))
+
+        labeled[labeled == 2] = 4  # label 2 is now empty
+        masks = ia.get_masks(labeled, isSort=False, labelLength=1)
+        assert(sorted(masks.keys()) == ['1', '2', '3', '4'])
+        assert(np.sum(masks['2']) == 0)
+
+    def test_CompactMask_get_local_mask(self):
+        labeled = np.zeros((20, 16), dtype=np.int32)
+        labeled[1:4, 2:5] = 1; labeled[2, 5] = 1
+        labeled[12:15, 9:16] = 2
+        for mask in ia.get_masks(labeled, isCompact=True).values():
+            fullMask = mask.get_binary_mask()
+            for padding in (1, 2, 5):
+                localMask, boundingBox = mask.get_local_mask(padding=padding)
+                assert(localMask.dtype == np.bool_)
+                assert(np.sum(localMask) == mask.get_area())
+                assert(np.array_equal(localMask, fullMask[boundingBox]))
+                # dilation within the extended bounding box is the same as the dilation of the full frame mask
+                dilated = np.zeros(fullMask.shape, dtype=np.bool_)
+                dilated[boundingBox] = ni.binary_dilation(localMask, iterations=padding)
+                assert(np.array_equal(dilated, ni.binary_dilation(fullMask, iterations=padding)))
+            localMask, boundingBox = mask.get_local_mask()
+            assert(boundingBox == mask.boundingBox and np.array_equal(localMask, mask.localMask))
+        self.assertRaises(ValueError, mask.get_local_mask, -1)
+
+    def test_rigid_transform_cv2_3d(self):
+        mov = np.random.rand(7, 20, 30).astype(np.float32)
+        offsets = np.array([[i % 3, -i] for i in range(7)])
+        movT = ia.rigid_transform_cv2_3d(mov, offset=offsets, outputShape=(25, 25), chunkLength=3, threadNum=2)
+        assert(movT.shape == (7, 25, 25) and movT.dtype == np.float32)
+        for i in range(7):
+            assert(np.array_equal(movT[i], ia.rigid_transform_cv2_2d(mov[i], offset=offsets[i], outputShape=(25, 25))))
+
     def test_ROI_binary_overlap(self):
         roi1 = np.zeros((10, 10))
         roi1[4:8, 3:7] = 1
@@ -40,6 +343,41 @@ class TestImageAnalysis(unittest.TestCase):
         roi2 = ia.ROI(roi2)
         assert(roi1.binary_overlap(roi2) == 6)
 
+    def test_WeightedROI_from_pixel_indices(self):
+        mov = np.arange(36, dtype=np.float32).reshape((4, 3, 3))
+        mask = np.zeros((3, 3), dtype=np.float32)
+        mask[0, 1] = 1; mask[2, 2] = 3
+        roi1 = ia.WeightedROI(mask)
+        roi2 = ia.WeightedROI.from_pixel_indices([8, 1], [3., 1.], (3, 3))
+        assert(np.array_equal(roi1.pixelIndices, roi2.pixelIndices))
+        assert(np.array_equal(roi1.get_weighted_mask(), roi2.get_weighted_mask()))
+        assert(np.array_equal(roi2.get_weighted_trace(mov), [6.25, 15.25, 24.25, 33.25]))
+
+    def test_ROI_unpickle_old_state(self):
+        # ROIs pickled before the flat pixel index storage hold (row indices, column indices) in their __dict__
+        class OldPickle(object):
+            def __init__(self, cls, state):
+                self.cls = cls; self.state = state
+            def __reduce__(self):
+                return copyreg._reconstructor, (self.cls, object, None), self.state
+
+        mask = np.zeros((5, 4), dtype=np.float32)
+        mask[1, 3] = 2; mask[3, 0] = 5; mask[4, 2] = 1
+        oldState = {'dimension': (5, 4), 'pixels': np.where(mask != 0), 'pixelSizeX': 0.5, 'pixelSizeY': 0.5,
+                    'pixelSizeUnit': 'um'}
+        roi = pickle.loads(pickle.dumps(OldPickle(ia.ROI, oldState)))
+        assert(np.array_equal(roi.pixelIndices, [7, 12, 18]))
+        assert(roi.dimension == (5, 4))
+        assert(roi.pixelSizeUnit == 'um')
+
+        oldState['weights'] = mask[np.where(mask != 0)]
+        roi = pickle.loads(pickle.dumps(OldPickle(ia.WeightedROI, oldState)))
+        assert(np.array_equal(roi.get_weighted_mask(), mask))
+
+        roi2 = pickle.loads(pickle.dumps(roi))
+        assert(np.array_equal(roi2.pixelIndices, roi.pixelIndices))
+        assert(np.array_equal(roi2.weights, roi.weights))
+
 
 if __name__ == "__main__":
     TestImageAnalysis.test_getTrace()
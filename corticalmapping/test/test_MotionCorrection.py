@@ -0,0 +1,189 @@
+__author__ = 'junz'
+
+import os
+import shutil
+import functools
+import tempfile
+import numpy as np
+import scipy.ndimage as ni
+import h5py
+import tifffile as tf
+import corticalmapping.core.ImageAnalysis as ia
+import corticalmapping.MotionCorrection as mc
+import unittest
+
+
+class TestMotionCorrection(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.img = ni.gaussian_filter(rng.rand(256, 256) * 255, 3)
+        self.noise = [rng.randn(256, 256) * 5 for i in range(2)]
+        self.shifts = rng.randint(-2, 3, (10, 2))
+        self.mov = np.array([ni.shift(self.img[:64, :64], shift, order=0, mode='wrap') + rng.randn(64, 64)
+                             for shift in self.shifts]).astype(np.float32)
+        self.alignParams = {'badFrameDistanceThr': 1e9, 'maxDisplacement': 6, 'alignFunc': mc.phaseCorrelation}
+
+    def test_phaseCorrelation_integer(self):
+        imgRef = self.img + self.noise[0]
+        imgMat = ni.shift(self.img, (4, -7), order=1, mode='wrap') + self.noise[1]
+        offset, hitLimitFlag = mc.phaseCorrelation(imgMat, imgRef, maxDisplacement=10)
+        assert(np.array_equal(offset, [7, -4]))
+        assert(hitLimitFlag == [0, 0])
+
+    def test_phaseCorrelation_subpixel(self):
+        imgMat = np.real(np.fft.ifft2(ni.fourier_shift(np.fft.fft2(self.img), (4.3, -7.6))))
+        offset, _ = mc.phaseCorrelation(imgMat, self.img, maxDisplacement=10, upsampleFactor=10)
+        assert(np.allclose(offset, [7.6, -4.3]))
+
+    def test_alignSingleMovieLoop_resume(self):
+        rng = np.random.RandomState(1)
+        img = self.img[:64, :64]
+        mov = np.array([ni.shift(img, rng.uniform(-3, 3, 2), order=1) + rng.randn(64, 64) * 5
+                        for i in range(12)]).astype(np.float32)
+        params = {'iterations': 4, 'badFrameDistanceThr': 1e9, 'maxDisplacement': 6,
+                  'alignFunc': functools.partial(mc.phaseCorrelation, upsampleFactor=10)}
+        offsets, alignedMov, meanFrame = mc.alignSingleMovieLoop(mov, **params)
+
+        # interrupt the alignment in the second or the third iteration, then resume from the checkpoint
+        for interruptedIteration in (2, 3):
+            checkpointPath = os.path.join(tempfile.mkdtemp(), 'checkpoint.pkl')
+            alignSingleMovie = mc.alignSingleMovie
+            calls = []
+            def interruptedAlignSingleMovie(*args, **kwargs):
+                calls.append(0)
+                if len(calls) == interruptedIteration: raise KeyboardInterrupt
+                return alignSingleMovie(*args, **kwargs)
+            mc.alignSingleMovie = interruptedAlignSingleMovie
+            try: self.assertRaises(KeyboardInterrupt, mc.alignSingleMovieLoop, mov, checkpointPath=checkpointPath, **params)
+            finally: mc.alignSingleMovie = alignSingleMovie
+            assert(mc.ft.loadFile(checkpointPath)['iteration'] == interruptedIteration - 1)
+
+            offsets2, alignedMov2, meanFrame2 = mc.alignSingleMovieLoop(mov, checkpointPath=checkpointPath, **params)
+            assert(np.array_equal(offsets, offsets2))
+            assert(np.array_equal(alignedMov, alignedMov2))
+            assert(np.array_equal(meanFrame, meanFrame2))
+            assert(not os.path.isfile(checkpointPath))
+            os.rmdir(os.path.dirname(checkpointPath))
+
+    def test_alignSingleMovieLoop_single_iteration(self):
+        offsets, alignedMov, meanFrame = mc.alignSingleMovieLoop(self.mov, iterations=1, **self.alignParams)
+        offsets2, alignedMov2, meanFrame2 = mc.alignSingleMovie(self.mov, self.mov[-1], alignOrder=-1, **self.alignParams)
+        assert(isinstance(offsets, list))
+        assert(np.array_equal(offsets, offsets2))
+        assert(np.array_equal(alignedMov, alignedMov2))
+        assert(np.array_equal(meanFrame, meanFrame2))
+
+    def getTiledFrame(self, tileShifts, tileSize=48):
+        # frame of 2 x 2 tiles cut from self.img, each tile is displaced by its own [xShift, yShift] from the reference
+        # self.img[20:20 + 2 * tileSize, 20:20 + 2 * tileSize]
+        frame = np.empty((2 * tileSize, 2 * tileSize))
+        for i in range(2):
+            for j in range(2):
+                xShift, yShift = tileShifts[i, j]
+                rowStart = 20 + i * tileSize + yShift; colStart = 20 + j * tileSize + xShift
+                frame[i * tileSize:(i + 1) * tileSize, j * tileSize:(j + 1) * tileSize] = \
+                    self.img[rowStart:rowStart + tileSize, colStart:colStart + tileSize]
+        return frame
+
+    def test_getTileStarts(self):
+        assert(np.array_equal(mc.getTileStarts(100, tileSize=48, tileOverlap=16), [0, 32, 52]))
+        assert(np.array_equal(mc.getTileStarts(96, tileSize=48, tileOverlap=0), [0, 48]))
+        assert(np.array_equal(mc.getTileStarts(40, tileSize=48, tileOverlap=16), [0]))
+        self.assertRaises(ValueError, mc.getTileStarts, 100, tileSize=48, tileOverlap=48)
+
+    def test_alignSingleMoviePiecewise(self):
+        imgRef = self.img[20:116, 20:116].astype(np.float32)
+        tileShifts = np.array([[[1, 2], [-2, 0]], [[0, -1], [3, 1]]])
+        tileParams = {'tileSize': 48, 'tileOverlap': 0, 'maxTileDisplacement': 6}
+        # pixels far enough from the tile centers and the frame edges are shifted by the offset of a single tile
+        cornerRegions = [(slice(5, 24), slice(5, 24)), (slice(5, 24), slice(72, 91)),
+                         (slice(72, 91), slice(5, 24)), (slice(72, 91), slice(72, 91))]
+
+        frame = self.getTiledFrame(tileShifts)
+        tileOffsets = mc.getTileOffsets(frame, imgRef, alignFunc=mc.phaseCorrelation, **tileParams)
+        assert(np.array_equal(tileOffsets, tileShifts))
+        correctedFrame = mc.applyTileOffsets(frame, tileOffsets, tileSize=48, tileOverlap=0)
+        assert(correctedFrame.shape == frame.shape and correctedFrame.dtype == frame.dtype)
+        for region in cornerRegions: assert(np.allclose(correctedFrame[region], imgRef[region], atol=1e-3))
+
+        allTileShifts = np.array([tileShifts, tileShifts + 2, tileShifts[::-1] - 1])
+        mov = np.array([self.getTiledFrame(shifts) for shifts in allTileShifts]).astype(np.float32)
+        offsets, tileOffsets, alignedMov, meanFrame = \
+            mc.alignSingleMoviePiecewise(mov, imgRef, badFrameDistanceThr=1e9, alignFunc=mc.phaseCorrelation,
+                                         **tileParams)
+        assert(tileOffsets.shape == (3, 2, 2, 2))
+        assert(np.array_equal(np.array(offsets)[:, None, None, :] + tileOffsets, allTileShifts))
+        for region in cornerRegions: assert(np.allclose(alignedMov[(slice(None),) + region], imgRef[region], atol=1e-2))
+        assert(np.allclose(meanFrame, np.mean(alignedMov, axis=0)))
+
+    def test_CorrectedMovie(self):
+        offsets = np.array(self.shifts)
+        offsets[3] = [0, 0]
+        correctedMov = ia.rigid_transform_cv2_3d(self.mov, offset=offsets)
+        view = mc.CorrectedMovie(self.mov, offsets, chunkLength=3)
+        assert(view.shape == self.mov.shape and view.dtype == self.mov.dtype and len(view) == 10)
+
+        for i in [0, 3, 9, -1, -10, np.int64(4)]:
+            assert(np.array_equal(view[i], correctedMov[i]))
+        for key in [slice(None), slice(2, 9), slice(-4, None), slice(None, None, -2), slice(8, 1, -3), [7, 0, -2, 3],
+                    np.array([True, False] * 5), (slice(1, 8), slice(5, 20), 7), (-2, 10, slice(None, None, 2))]:
+            assert(np.array_equal(view[key], correctedMov[key]))
+        assert(view[5:5].shape == (0, 64, 64))
+        self.assertRaises(IndexError, view.__getitem__, 10)
+        self.assertRaises(IndexError, view.__getitem__, -11)
+
+    def test_alignMultipleTiffs_processNum(self):
+        tempFolder = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(tempFolder, 'movie1.tif'), os.path.join(tempFolder, 'movie2.tif')]
+            tf.imsave(paths[0], self.mov)
+            tf.imsave(paths[1], np.roll(self.mov[::-1], (2, -1), axis=(1, 2)))
+            results = [mc.alignMultipleTiffs(paths, iterations=2, verbose=False, processNum=processNum,
+                                             **self.alignParams) for processNum in (1, 2)]
+            for (offset, offset2) in zip(results[0][0], results[1][0]): assert(np.array_equal(offset, offset2))
+            assert(np.array_equal(results[0][1], results[1][1]))
+            assert(not np.array_equal(results[0][0][0], results[0][0][1]))
+        finally:
+            shutil.rmtree(tempFolder)
+
+    def test_alignSingleMovieStreaming(self):
+        imgRef = self.mov[-1]
+        offsets, alignedMov, meanFrame = mc.alignSingleMovie(self.mov, imgRef, alignOrder=1, **self.alignParams)
+        assert(np.array_equal(offsets[-1], [0, 0]))
+        assert(np.array_equal(np.array(offsets)[:, ::-1], self.shifts[-1] - self.shifts))
+
+        tempFolder = tempfile.mkdtemp()
+        try:
+            for fileName in ['corrected.npy', 'corrected.hdf5']:
+                savePath = os.path.join(tempFolder, fileName)
+                offsets2, meanFrame2 = mc.alignSingleMovieStreaming(self.mov, imgRef, savePath=savePath, chunkLength=3,
+                                                                    **self.alignParams)
+                assert(np.array_equal(offsets2, offsets))
+                assert(np.allclose(meanFrame2, meanFrame))
+                if fileName[-4:] == '.npy': alignedMov2 = np.load(savePath)
+                else:
+                    with h5py.File(savePath, 'r') as f: alignedMov2 = f['corrected'][()]
+                assert(alignedMov2.dtype == self.mov.dtype)
+                assert(np.array_equal(alignedMov2, alignedMov))
+        finally:
+            shutil.rmtree(tempFolder)
+
+    def test_alignMultipleTiffs_streaming(self):
+        tempFolder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempFolder, 'movie.tif')
+            tf.imsave(path, self.mov)
+            offsets, meanFrame = mc.alignMultipleTiffs([path], iterations=1, output=True, isStreaming=True,
+                                                       chunkLength=4, verbose=False, **self.alignParams)
+            offsets2, meanFrame2 = mc.alignSingleMovieStreaming(self.mov, self.mov[-1], **self.alignParams)
+            assert(np.array_equal(offsets[0], offsets2))
+            assert(np.allclose(meanFrame, meanFrame2))
+            assert(np.array_equal(np.load(os.path.join(tempFolder, 'movie_corrected.npy')),
+                                  ia.rigid_transform_cv2_3d(self.mov, offset=offsets2)))
+        finally:
+            shutil.rmtree(tempFolder)
+
+
+if __name__ == "__main__":
+    unittest.main()
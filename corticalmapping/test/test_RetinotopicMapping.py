@@ -0,0 +1,296 @@
+__author__ = 'junz'
+
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import scipy.ndimage as ni
+from itertools import combinations
+import corticalmapping.core.FileTools as ft
+import corticalmapping.core.ImageAnalysis as ia
+import corticalmapping.RetinotopicMapping as rm
+import unittest
+
+
+def get_trial():
+    '''
+    a small synthetic trial with two areas of opposite visual sign
+    '''
+    y, x = np.mgrid[0:120, 0:160].astype(np.float64)
+    altPosMap = (y - 60) * 0.5
+    aziPosMap = np.where(x < 80, x * 0.5, (160 - x) * 0.5)
+    params = {'phaseMapFilterSigma': 1,
+              'signMapFilterSigma': 3,
+              'signMapThr': 0.3,
+              'eccMapFilterSigma': 5.,
+              'splitLocalMinCutStep': 10.,
+              'mergeOverlapThr': 0.05,
+              'closeIter': 3,
+              'openIter': 3,
+              'dilationIter': 5,
+              'borderWidth': 1,
+              'smallPatchThr': 100,
+              'visualSpacePixelSize': 0.5,
+              'visualSpaceCloseIter': 15,
+              'splitOverlapThr': 1.1}
+    return rm.RetinotopicMappingTrial(mouseID='test', dateRecorded=20160101, trialNum='1', mouseType='wt',
+                                      visualStimType='KSstim', visualStimBackground='gray', imageExposureTime=0.1,
+                                      altPosMap=altPosMap, aziPosMap=aziPosMap, altPowerMap=None, aziPowerMap=None,
+                                      vasculatureMap=np.zeros((120, 160)), params=params)
+
+
+def generate_phase_map_fft(movie, cycles, isReverse=False, isFilter=False, sigma=3.):
+    '''
+    phase and power maps from the full fft of the movie, reference of rm.generatePhaseMap and rm.generatePhaseMap2
+    '''
+    if isReverse:
+        movie = np.amax(movie) - movie
+    spectrumMovie = np.fft.fft(movie, axis=0)
+    powerMovie = (np.abs(spectrumMovie) * 2.) / np.size(movie, 0)
+    powerMap = np.abs(powerMovie[cycles, :, :])
+    phaseMap = -1 * np.angle(spectrumMovie)[cycles, :, :]
+    if isFilter:
+        meanPower = np.mean(powerMovie, axis=0)
+        stdPower = np.std(powerMovie, axis=0)
+        for i in np.arange(powerMap.shape[0]):
+            for j in np.arange(powerMap.shape[1]):
+                if powerMap[i, j] < meanPower[i, j] + sigma * stdPower[i, j]:
+                    phaseMap[i, j] = np.nan
+    return phaseMap % (2 * np.pi), powerMap
+
+
+def is_same_phase(phaseMap1, phaseMap2):
+    if not np.array_equal(np.isnan(phaseMap1), np.isnan(phaseMap2)):
+        return False
+    phaseDiff = np.angle(np.exp(1j * (phaseMap1 - phaseMap2)))
+    return np.allclose(phaseDiff[~np.isnan(phaseDiff)], 0., atol=1e-8)
+
+
+def get_visual_space_loop(patch, altMap, aziMap, altRange=(-40., 60.), aziRange=(-20., 120.), visualFieldOrigin=None,
+                          pixelSize=1., closeIter=None):
+    '''
+    per-pixel binning of visual locations, reference of rm.Patch.getVisualSpace
+    '''
+    if visualFieldOrigin:
+        altMap = altMap - visualFieldOrigin[0]
+        aziMap = aziMap - visualFieldOrigin[1]
+    altAxis = np.arange(altRange[0], altRange[1], pixelSize)
+    aziAxis = np.arange(aziRange[0], aziRange[1], pixelSize)
+    visualSpace = np.zeros((len(altAxis), len(aziAxis)), dtype=np.uint8)
+    patchArray = patch.array
+    for i in range(patchArray.shape[0]):
+        for j in range(patchArray.shape[1]):
+            if patchArray[i, j]:
+                corAlt = altMap[i, j]
+                corAzi = aziMap[i, j]
+                if (corAlt >= altRange[0]) & (corAlt <= altRange[1]) & (corAzi >= aziRange[0]) & (corAzi <= aziRange[1]):
+                    indAlt = (corAlt - altRange[0]) // pixelSize
+                    indAzi = (corAzi - aziRange[0]) // pixelSize
+                    visualSpace[int(indAlt), int(indAzi)] = 1
+    if closeIter is not None and closeIter >= 1:
+        visualSpace = ni.binary_closing(visualSpace, iterations=closeIter)
+    return visualSpace, altAxis, aziAxis
+
+
+def get_random_patches(patchNum=12, shape=(40, 40), seed=0):
+    '''
+    rectangular patches at random positions and with random signs, some of them overlap
+    '''
+    rng = np.random.RandomState(seed)
+    patches = {}
+    for i in range(patchNum):
+        array = np.zeros(shape, dtype=np.int8)
+        row, col = rng.randint(0, shape[0] - 3), rng.randint(0, shape[1] - 3)
+        array[row:row + rng.randint(1, 8), col:col + rng.randint(1, 8)] = 1
+        patches.update({'patch' + str(i).zfill(2): rm.Patch(array, rng.choice([-1, 1]))})
+    return patches
+
+
+def adjacent_pairs_loop(patches, borderWidth=2, isSameSign=True):
+    '''
+    pairwise adjacency check, reference of rm.PatchAdjacencyGraph
+    '''
+    pairKeyList = []
+    for key1, key2 in combinations(list(patches.keys()), 2):
+        if ia.is_adjacent(patches[key1].array, patches[key2].array, borderWidth=borderWidth) and \
+                ((not isSameSign) or patches[key1].sign == patches[key2].sign):
+            pairKeyList.append((key1, key2))
+    return pairKeyList
+
+
+def count_stage_calls(trial):
+    '''
+    wrap the stage methods of a trial to record the names of the stages being processed
+    '''
+    calls = []
+    for stageName, methodName, _, _, _ in rm.PROCESSING_STAGES:
+        def method(isPlot=False, stageName=stageName, func=getattr(trial, methodName)):
+            calls.append(stageName)
+            return func(isPlot=isPlot)
+        setattr(trial, methodName, method)
+    return calls
+
+
+class TestRetinotopicMapping(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpFolder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpFolder)
+
+    def test_getSingleHarmonic(self):
+        mov = np.random.RandomState(0).rand(30, 5, 6).astype(np.float32)
+        spectrum = np.fft.fft(mov.astype(np.float64), axis=0)
+        spectrumR = np.fft.fft(np.amax(mov) - mov.astype(np.float64), axis=0)
+        for harmonic in [0, 1, 3]:
+            for chunkLength in [1, 7, 100]:
+                assert(np.allclose(rm.getSingleHarmonic(mov, harmonic, chunkLength=chunkLength), spectrum[harmonic]))
+                assert(np.allclose(rm.getSingleHarmonic(mov, harmonic, isReverse=True, chunkLength=chunkLength),
+                                   spectrumR[harmonic]))
+
+    def test_generatePhaseMap(self):
+        # two cycles with random phase and amplitude at each pixel
+        phases = np.random.RandomState(1).rand(5, 6) * 2 * np.pi
+        amplitudes = np.random.RandomState(3).rand(5, 6)
+        t = np.arange(40)[:, None, None] * 2 * np.pi * 2 / 40.
+        mov = amplitudes * np.cos(t - phases) + np.random.RandomState(2).rand(40, 5, 6)
+
+        movPath = os.path.join(self.tmpFolder, 'movie.hdf5')
+        with h5py.File(movPath, 'w') as f:
+            f.create_dataset('movie', data=mov)
+
+        with h5py.File(movPath, 'r') as f:
+            for isReverse in [False, True]:
+                phaseMap, powerMap = generate_phase_map_fft(mov, 2, isReverse=isReverse)
+                for movie in [mov, f['movie']]:
+                    phaseMap2, powerMap2 = rm.generatePhaseMap2(movie, 2, isReverse=isReverse, chunkLength=7)
+                    assert(is_same_phase(phaseMap2, phaseMap))
+                    assert(np.allclose(powerMap2, powerMap))
+                    phaseMap1, powerMap1 = rm.generatePhaseMap(movie, cycles=2, isReverse=isReverse, chunkLength=7)
+                    assert(is_same_phase(phaseMap1, phaseMap))
+                    assert(np.allclose(powerMap1, powerMap))
+
+                # some pixels are filtered out and some are not
+                for sigma in [1., 2.]:
+                    phaseMapF, powerMapF = generate_phase_map_fft(mov, 2, isReverse=isReverse, isFilter=True,
+                                                                  sigma=sigma)
+                    phaseMap1, powerMap1 = rm.generatePhaseMap(mov, cycles=2, isReverse=isReverse, isFilter=True,
+                                                               sigma=sigma)
+                    assert(is_same_phase(phaseMap1, phaseMapF))
+                    assert(np.allclose(powerMap1, powerMapF))
+
+    def test_getVisualSpace(self):
+        rng = np.random.RandomState(0)
+        # smooth maps partly outside of the visual space, with some nan pixels
+        altMap = ni.gaussian_filter(rng.rand(40, 40), 2) * 600. - 280.
+        aziMap = ni.gaussian_filter(rng.rand(40, 40), 2) * 800. - 330.
+        altMap[rng.rand(40, 40) < 0.05] = np.nan
+        patches = get_random_patches(patchNum=5, seed=0)
+
+        for visualFieldOrigin in [None, (5., -5.)]:
+            for pixelSize in [0.5, 1., 3.]:
+                for closeIter in [None, 0, 2]:
+                    visualSpaces, altAxis, aziAxis = rm.getVisualSpaces(patches, altMap, aziMap,
+                                                                        visualFieldOrigin=visualFieldOrigin,
+                                                                        pixelSize=pixelSize, closeIter=closeIter)
+                    for key, patch in patches.items():
+                        visualSpace0, altAxis0, aziAxis0 = get_visual_space_loop(patch, altMap, aziMap,
+                                                                                 visualFieldOrigin=visualFieldOrigin,
+                                                                                 pixelSize=pixelSize,
+                                                                                 closeIter=closeIter)
+                        visualSpace1, altAxis1, aziAxis1 = patch.getVisualSpace(altMap, aziMap,
+                                                                                visualFieldOrigin=visualFieldOrigin,
+                                                                                pixelSize=pixelSize,
+                                                                                closeIter=closeIter)
+                        assert(np.array_equal(visualSpace1, visualSpace0))
+                        assert(np.array_equal(altAxis1, altAxis0) and np.array_equal(aziAxis1, aziAxis0))
+                        assert(np.array_equal(visualSpaces[key], visualSpace0))
+                    assert(np.array_equal(altAxis, altAxis0) and np.array_equal(aziAxis, aziAxis0))
+
+        # locations exactly at the upper limits are ignored
+        patch = rm.Patch(np.ones((2, 2), dtype=np.int8), 1)
+        visualSpace, _, _ = patch.getVisualSpace(np.array([[60., 0.], [10., 10.]]), np.array([[0., 120.], [10., 10.]]))
+        assert(np.sum(visualSpace) == 1 and visualSpace[50, 30] == 1)
+
+    def test_PatchAdjacencyGraph(self):
+        for seed in range(3):
+            patches = get_random_patches(seed=seed)
+            for borderWidth in [2, 3, 4]:
+                graph = rm.PatchAdjacencyGraph(patches, borderWidth=borderWidth)
+                assert(graph.getPairs(isSameSign=False) ==
+                       adjacent_pairs_loop(patches, borderWidth=borderWidth, isSameSign=False))
+                assert(rm.adjacentPairs(patches, borderWidth=borderWidth) ==
+                       adjacent_pairs_loop(patches, borderWidth=borderWidth))
+
+                # local update after merging two patches
+                key1, key2 = list(patches.keys())[:2]
+                mergedPatch = rm.Patch(patches[key1].array + patches[key2].array, patches[key1].sign)
+                graph.mergePatches(key1, key2, 'merged', mergedPatch)
+                newPatches = dict((key, patch) for key, patch in patches.items() if key not in (key1, key2))
+                newPatches.update({'merged': mergedPatch})
+                assert(sorted(graph.getPairs(isSameSign=False)) ==
+                       sorted(adjacent_pairs_loop(newPatches, borderWidth=borderWidth, isSameSign=False)))
+
+                # local update after removing a patch
+                graph.removePatch('patch05')
+                newPatches.pop('patch05')
+                assert(sorted(graph.getPairs(isSameSign=False)) ==
+                       sorted(adjacent_pairs_loop(newPatches, borderWidth=borderWidth, isSameSign=False)))
+
+    def test_PatchAdjacencyGraph_borderWidth(self):
+        patches = get_random_patches()
+        for borderWidth in [0, 1]:
+            self.assertRaises(ValueError, rm.PatchAdjacencyGraph, patches, borderWidth=borderWidth)
+
+    def test_processTrial_cache(self):
+        trial = get_trial()
+        calls = count_stage_calls(trial)
+        stageNames = [stage[0] for stage in rm.PROCESSING_STAGES]
+
+        trial.processTrial()
+        assert(calls == stageNames)
+        finalPatches = trial.finalPatches
+
+        del calls[:]
+        trial.processTrial()
+        assert(calls == [])
+        assert(trial.finalPatches is finalPatches)
+
+        trial.params['mergeOverlapThr'] = 0.1
+        trial.processTrial()
+        assert(calls == ['mergePatches'])
+
+        # only the latest result of each stage is kept
+        assert(sorted(trial.stageCache.keys()) == sorted(stageNames))
+        trial.params['mergeOverlapThr'] = 0.05
+        trial.processTrial()
+        assert(calls == ['mergePatches', 'mergePatches'])
+        assert(sorted(trial.stageCache.keys()) == sorted(stageNames))
+
+    def test_processTrial_cachePath(self):
+        trialPath = os.path.join(self.tmpFolder, 'trial.pkl')
+        ft.saveFile(trialPath, get_trial().generateTrialDict())
+
+        cachePath = rm.getStageCachePath(trialPath)
+
+        # the stage cache is only kept in memory by default
+        trial, _ = rm.loadTrial(trialPath)
+        trial.processTrial()
+        assert(os.listdir(self.tmpFolder) == ['trial.pkl'])
+
+        trial, _ = rm.loadTrial(trialPath)
+        trial.processTrial(cachePath=cachePath)
+        assert(os.path.isfile(cachePath))
+
+        trial, _ = rm.loadTrial(trialPath)
+        calls = count_stage_calls(trial)
+        trial.params['mergeOverlapThr'] = 0.1
+        trial.processTrial(cachePath=cachePath)
+        assert(calls == ['mergePatches'])
+        assert(sorted(trial.finalPatches.keys()) == ['patch01', 'patch02'])
+
+
+if __name__ == "__main__":
+    unittest.main()
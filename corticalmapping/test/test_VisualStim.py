@@ -0,0 +1,314 @@
+__author__ = 'junz'
+
+import os
+import glob
+import random
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import h5py
+import corticalmapping.VisualStim as vs
+import corticalmapping.core.FileTools as ft
+import unittest
+
+currFolder = os.path.dirname(os.path.realpath(__file__))
+
+# movies generated by Stim.generate_movie before the frames were rendered on demand (one frame at a time by
+# render_frame), from the stimuli in get_stims with np.random and random seeded by 0. the noise movies of NoiseKSstim
+# and FlashingNoise were generated with np.random seeded by the first np.random.randint(0, 2**31 - 1) after seeding by
+# 0, which is the seed they draw in prepare_frames
+REFERENCE_PATH = os.path.join(currFolder, 'data', 'visual_stim_movies.hdf5')
+
+
+def get_monitor(**kwargs):
+    params = {'resolution': (120, 160), 'dis': 15., 'monWcm': 40., 'monHcm': 30., 'C2Tcm': 15., 'C2Acm': 20.,
+              'monTilt': 10., 'downSampleRate': 10}
+    params.update(kwargs)
+    return vs.Monitor(**params)
+
+
+def get_stims(mon):
+    ind = vs.Indicator(mon, width_cm=5., height_cm=5.)
+    gap = {'preGapDur': 0.05, 'postGapDur': 0.05}
+    return {'UniformContrast': vs.UniformContrast(mon, ind, duration=0.1, color=0.5, **gap),
+            'KSstim': vs.KSstim(mon, ind, stepWidth=5., flickerFrame=4, direction='L2R', **gap),
+            'NoiseKSstim': vs.NoiseKSstim(mon, ind, stepWidth=5., direction='B2U', **gap),
+            'ObliqueKSstim': vs.ObliqueKSstim(mon, ind, stepWidth=5., flickerFrame=4, direction='U2B', **gap),
+            'FlashingNoise': vs.FlashingNoise(mon, ind, iteration=2, flashFrameNum=2, **gap),
+            'GaussianNoise': vs.GaussianNoise(mon, ind, stepWidth=5., sweepSigma=5., **gap),
+            'FlashingCircle': vs.FlashingCircle(mon, ind, center=(80., 0.), radius=15., iteration=2, flashFrame=3,
+                                                **gap),
+            'SparseNoise': vs.SparseNoise(mon, ind, gridSpace=(20., 20.), probeSize=(10., 10.), probeFrameNum=2,
+                                          **gap),
+            'DriftingGratingCircle': vs.DriftingGratingCircle(mon, ind, center=(80., 0.), dire_list=(0., np.pi / 2),
+                                                              con_list=(0.8,), size_list=(20.,), blockDur=0.25,
+                                                              midGapDur=0.05, iteration=1, **gap),
+            'KSstimAllDir': vs.KSstimAllDir(mon, ind, stepWidth=10., flickerFrame=4, **gap),
+            'ObliqueKSstimAllDir': vs.ObliqueKSstimAllDir(mon, ind, stepWidth=10., flickerFrame=4, **gap)}
+
+
+def generate_movie(stim):
+    np.random.seed(0)
+    random.seed(0)
+    return stim.generate_movie()[0]
+
+
+def circle_mask_loop(map_x, map_y, center, radius):
+    # per pixel reference of vs.circle_mask
+    circle_mask = np.zeros(map_x.shape, dtype=np.uint8)
+    for (i, j), value in np.ndenumerate(circle_mask):
+        if vs.ia.distance((map_x[i, j], map_y[i, j]), center) <= radius:
+            circle_mask[i, j] = 1
+    return circle_mask
+
+
+def remap_loop(mon):
+    # per pixel reference of vs.Monitor.remap
+    degCorX = np.zeros(mon.linCorX.shape, dtype=np.float16)
+    degCorY = np.zeros(mon.linCorX.shape, dtype=np.float16)
+    for j in range(degCorX.shape[1]):
+        degCorX[:, j] = (180.0 / np.pi) * np.arctan(mon.linCorX[0, j] / mon.dis)
+        dis2 = np.sqrt(np.square(mon.dis) + np.square(mon.linCorX[0, j]))
+        for i in range(degCorX.shape[0]):
+            degCorY[i, j] = (180.0 / np.pi) * np.arctan(mon.linCorY[i, 0] / dis2)
+    return degCorX + 90 - mon.monTilt, degCorY
+
+
+def lookup_table_loop(mon):
+    # argmin reference of vs.Monitor.generate_Lookup_table
+    degDis = np.tan(np.pi / 180) * mon.dis
+    degNoWarpCorX = mon.linCorX / degDis
+    degNoWarpCorY = mon.linCorY / degDis
+    degCorX = mon.degCorX + mon.monTilt - 90
+    lookupI = np.zeros(degCorX.shape, dtype=np.int32)
+    lookupJ = np.zeros(degCorX.shape, dtype=np.int32)
+    for j in range(lookupI.shape[1]):
+        lookupJ[:, j] = np.argmin(np.abs(degNoWarpCorX[0, :] - degCorX[0, j]))
+        for i in range(lookupI.shape[0]):
+            lookupI[i, j] = np.argmin(np.abs(degNoWarpCorY[:, lookupJ[0, j]] - mon.degCorY[i, j]))
+    return lookupI, lookupJ
+
+
+class TestVisualStim(unittest.TestCase):
+
+    def setUp(self):
+        self.mon = get_monitor()
+        self.stims = get_stims(self.mon)
+
+    def test_nearest_indices(self):
+        values = np.array([3., 1., 2., 1., 5., 2.5])
+        queries = np.array([[-1., 1., 1.5], [2.25, 4., 10.]])
+        indices = vs._nearest_indices(values, queries)
+        assert(np.array_equal(indices, [[np.argmin(np.abs(values - q)) for q in row] for row in queries]))
+        assert(np.array_equal(vs._nearest_indices([7.], queries), np.zeros((2, 3))))
+
+    def test_remap(self):
+        for visualField in ('right', 'left'):
+            for monTilt in (0., 30., 45.):
+                mon = get_monitor(visualField=visualField, monTilt=monTilt)
+                degCorX, degCorY = remap_loop(mon)
+                assert(np.array_equal(mon.degCorX, degCorX))
+                assert(np.array_equal(mon.degCorY, degCorY))
+                lookupI, lookupJ = mon.generate_Lookup_table()
+                lookupIRef, lookupJRef = lookup_table_loop(mon)
+                assert(lookupI.dtype == np.int32 and lookupJ.dtype == np.int32)
+                assert(np.array_equal(lookupI, lookupIRef))
+                assert(np.array_equal(lookupJ, lookupJRef))
+
+    def test_monitor_cache(self):
+        cacheFolder = tempfile.mkdtemp()
+        try:
+            mon = get_monitor(cacheFolder=cacheFolder)
+            lookupI, lookupJ = mon.generate_Lookup_table()
+            cachePath = mon._get_cache_path()
+            assert(os.listdir(cacheFolder) == [os.path.basename(cachePath)])
+
+            # same geometry, the maps are loaded from the cache
+            mon2 = get_monitor(cacheFolder=cacheFolder)
+            lookupI2, lookupJ2 = mon2.generate_Lookup_table()
+            assert(mon2._get_cache_path() == cachePath)
+            assert(np.array_equal(mon2.degCorX, mon.degCorX) and mon2.degCorX.dtype == mon.degCorX.dtype)
+            assert(np.array_equal(mon2.degCorY, mon.degCorY) and mon2.degCorY.dtype == mon.degCorY.dtype)
+            assert(np.array_equal(lookupI2, lookupI) and np.array_equal(lookupJ2, lookupJ))
+
+            cache = ft.loadFile(cachePath)
+            cache['lookupI'] = lookupI + 1
+            ft.saveFile(cachePath, cache)
+            assert(np.array_equal(get_monitor(cacheFolder=cacheFolder).generate_Lookup_table()[0], lookupI + 1))
+
+            # different geometries miss the cache
+            for kwargs in ({'dis': 20.}, {'visualField': 'left'}):
+                mon3 = get_monitor(cacheFolder=cacheFolder, **kwargs)
+                assert(mon3._get_cache_path() != cachePath)
+                degCorX, degCorY = remap_loop(mon3)
+                assert(np.array_equal(mon3.degCorX, degCorX) and np.array_equal(mon3.degCorY, degCorY))
+                lookupI3, lookupJ3 = mon3.generate_Lookup_table()
+                assert(np.array_equal(lookupI3, lookup_table_loop(mon3)[0]))
+            assert(len(os.listdir(cacheFolder)) == 3)
+        finally:
+            shutil.rmtree(cacheFolder)
+
+    def test_circle_mask(self):
+        for map_x, map_y in ((self.mon.degCorX, self.mon.degCorY), (self.mon.linCorX, self.mon.linCorY)):
+            for center, radius in (((80., 0.), 15.), ((map_x[5, 7], map_y[5, 7]), 10.), ((0., 0.), 0.)):
+                mask = vs.circle_mask(map_x, map_y, center, radius, is_cache=False)
+                assert(mask.dtype == np.uint8)
+                assert(np.array_equal(mask, circle_mask_loop(map_x, map_y, center, radius)))
+
+    def test_circle_mask_cache(self):
+        vs.clear_circle_mask_cache()
+        map_x, map_y = self.mon.degCorX, self.mon.degCorY
+        radii = np.arange(vs.CIRCLE_MASK_CACHE_SIZE + 1) + 1.
+        for radius in radii[:vs.CIRCLE_MASK_CACHE_SIZE]: vs.circle_mask(map_x, map_y, (80., 0.), radius)
+        assert(len(vs._CIRCLE_MASK_CACHE) == vs.CIRCLE_MASK_CACHE_SIZE)
+
+        # a hit makes the first mask the most recent one, so the second mask is evicted by a new mask
+        mask = vs.circle_mask(map_x, map_y, (80., 0.), radii[0])
+        mask[:] = 1
+        vs.circle_mask(map_x, map_y, (80., 0.), radii[-1])
+        cachedRadii = [key[3] for key in vs._CIRCLE_MASK_CACHE.keys()]
+        assert(len(cachedRadii) == vs.CIRCLE_MASK_CACHE_SIZE)
+        assert(radii[1] not in cachedRadii)
+        assert(cachedRadii[-2:] == [radii[0], radii[-1]])
+
+        # the cached mask is not changed by modifying a returned mask
+        for radius in radii[[0, 1, -1]]:
+            mask = vs.circle_mask(map_x, map_y, (80., 0.), radius)
+            assert(np.array_equal(mask, circle_mask_loop(map_x, map_y, (80., 0.), radius)))
+        assert(list(vs._CIRCLE_MASK_CACHE.keys())[-1][3] == radii[-1])
+
+        # different maps with the same values do not share cached masks
+        mask = vs.circle_mask(map_x.copy(), map_y.copy(), (80., 0.), radii[-1])
+        assert(np.array_equal(mask, circle_mask_loop(map_x, map_y, (80., 0.), radii[-1])))
+        assert(len(vs._CIRCLE_MASK_CACHE) == vs.CIRCLE_MASK_CACHE_SIZE)
+        vs.clear_circle_mask_cache()
+        assert(len(vs._CIRCLE_MASK_CACHE) == 0)
+
+    def test_generate_movie(self):
+        with h5py.File(REFERENCE_PATH, 'r') as f:
+            for stimName in f.keys():
+                mov = generate_movie(self.stims[stimName])
+                assert(mov.dtype == np.float16)
+                assert(np.array_equal(mov, f[stimName][()]))
+
+    def test_generate_movie_uniform_contrast(self):
+        stim = self.stims['UniformContrast']
+        mov = generate_movie(stim)
+        gap = np.zeros((12, 16), dtype=np.float16); gap[0:2, 14:16] = -1.
+        display = np.ones((12, 16), dtype=np.float16) * 0.5; display[0:2, 14:16] = 1.
+        assert(mov.shape == (12, 12, 16))
+        assert(np.array_equal(mov[:3], np.array([gap] * 3)))
+        assert(np.array_equal(mov[3:9], np.array([display] * 6)))
+        assert(np.array_equal(mov[9:], np.array([gap] * 3)))
+
+    def test_frame_buffer(self):
+        for stimName, stim in self.stims.items():
+            mov = generate_movie(stim)
+            frameNum = mov.shape[0]
+            for displayOrder in (1, -1):
+                ds = vs.DisplaySequence(logdir=tempfile.gettempdir(), displayIteration=2, displayOrder=displayOrder,
+                                        isTriggered=False, isSyncPulse=False)
+                frameIndices = list(range(frameNum))[::displayOrder] * 2
+                assert(list(ds._get_display_frame_indices(frameNum)) == frameIndices)
+                frameBuffer = vs.FrameBuffer(stim, ds._get_display_frame_indices(frameNum), bufferSize=5)
+                try:
+                    frames = np.array([frameBuffer.get() for i in frameIndices])
+                finally:
+                    frameBuffer.close()
+                assert(np.array_equal(frames, mov[frameIndices]))
+
+    def test_frame_buffer_close(self):
+        stim = self.stims['KSstim']
+        stim.prepare_frames()
+        frameBuffer = vs.FrameBuffer(stim, iter(range(stim.get_frame_num())), bufferSize=2)
+        frameBuffer.get()
+        frameBuffer.close()
+        assert(not frameBuffer._thread.is_alive())
+
+    def test_generate_movie_by_index(self):
+        for stimName, stim in self.stims.items():
+            mov = generate_movie(stim)
+            np.random.seed(0)
+            random.seed(0)
+            frameBank, frameIndices, log = stim.generate_movie_by_index()
+            assert(frameBank.dtype == np.float16)
+            assert(frameIndices.dtype == np.uint32)
+            assert(len(frameIndices) == mov.shape[0])
+            assert(np.array_equal(frameBank[frameIndices], mov))
+
+            # frames with the same key are rendered only once
+            frameKeys = [stim.get_frame_key(i) for i in range(len(frameIndices))]
+            assert(frameBank.shape[0] == len(set(frameKeys)))
+
+        frameBank, frameIndices, _ = self.stims['UniformContrast'].generate_movie_by_index()
+        assert(frameBank.shape[0] == 2)
+        assert(np.array_equal(frameIndices, [0] * 3 + [1] * 6 + [0] * 3))
+
+    def test_is_rebuildable(self):
+        assert(all(stim.is_rebuildable() for stim in self.stims.values()))
+
+    def test_rebuild_noise(self):
+        for stimName in ['NoiseKSstim', 'FlashingNoise']:
+            mov, log = self.stims[stimName].generate_movie()
+            noiseSeed = log['stimulation']['noiseSeed']
+            assert(isinstance(noiseSeed, int))
+
+            # the noise is drawn again every time the frames are prepared
+            assert(not np.array_equal(self.stims[stimName].generate_movie()[0], mov))
+
+            # the frames are rebuilt from the logged seed, without changing the state of numpy random number generator
+            stim = get_stims(self.mon)[stimName]
+            stim.seed = noiseSeed
+            np.random.seed(1)
+            assert(np.array_equal(stim.generate_movie()[0], mov))
+            assert(np.random.randint(0, 2**31 - 1) == np.random.RandomState(1).randint(0, 2**31 - 1))
+
+    def _save_log(self, stim, isLazy=False, isSaveFrameBank=False):
+        logFolder = tempfile.mkdtemp()
+        try:
+            ds = vs.DisplaySequence(logdir=os.path.join(logFolder, 'log'), isTriggered=False, isSyncPulse=False,
+                                    isSaveFrameBank=isSaveFrameBank)
+            ds.set_stim(stim, isLazy=isLazy)
+            ds.displayLength = 1.
+            ds.keepDisplay = True
+            ds.save_log()
+            logPaths = glob.glob(os.path.join(logFolder, '*', '*.pkl'))
+            assert(len(logPaths) == 1)
+            return ds, ft.loadFile(logPaths[0])['presentation']
+        finally:
+            shutil.rmtree(logFolder)
+
+    def test_save_log(self):
+        # rebuildable stimulus, the unique frames are not saved by default
+        ds, presentation = self._save_log(self.stims['KSstim'])
+        assert('sequence' not in presentation)
+        assert(np.array_equal(presentation['sequenceIndices'], ds.sequenceIndices))
+
+        ds, presentation = self._save_log(self.stims['KSstim'], isSaveFrameBank=True)
+        assert(np.array_equal(presentation['sequence'], ds.sequence))
+        assert(np.array_equal(presentation['sequenceIndices'], ds.sequenceIndices))
+
+        # the frames of random noise are rebuilt from the logged seed, the unique frames are saved only if asked
+        for stimName in ['FlashingNoise', 'NoiseKSstim']:
+            ds, presentation = self._save_log(self.stims[stimName])
+            assert('sequence' not in presentation)
+            assert(np.array_equal(presentation['sequenceIndices'], ds.sequenceIndices))
+
+            ds, presentation = self._save_log(self.stims[stimName], isSaveFrameBank=True)
+            assert(np.array_equal(presentation['sequence'], ds.sequence))
+
+        # lazy display, there are no unique frames in memory to be saved
+        ds, presentation = self._save_log(self.stims['KSstim'], isLazy=True)
+        assert('sequence' not in presentation)
+        assert(presentation['sequenceIndices'] is None)
+
+        # the frames of a stimulus that can not be rebuilt are saved by default and can not be displayed lazily
+        with mock.patch.object(vs.UniformContrast, 'is_rebuildable', return_value=False):
+            ds, presentation = self._save_log(self.stims['UniformContrast'])
+            assert(np.array_equal(presentation['sequence'], ds.sequence))
+            self.assertRaises(ValueError, self._save_log, self.stims['UniformContrast'], isLazy=True)
+
+
+if __name__ == "__main__":
+    unittest.main()